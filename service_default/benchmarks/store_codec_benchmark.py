@@ -0,0 +1,91 @@
+"""
+Compares the store codecs on a synthetic store of 10k users with Decimal portfolios.
+
+    python -m benchmarks.store_codec_benchmark [users]
+"""
+import random
+import sys
+import tempfile
+import time
+from decimal import Decimal
+from pathlib import Path
+from hsbot.persistence_layer import JsonFileBackend, TrackedCollection, TrackedDict, TrackedList
+from hsbot.store_codec import get_codec
+
+try:
+    from solders.pubkey import Pubkey
+
+    def random_pubkey():
+        return Pubkey.new_unique()
+except ImportError:
+    def random_pubkey():
+        return ''.join(random.choices('123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz', k=44))
+
+CODECS = [
+    ('json', 0),
+    ('binary', 0),
+    ('binary', 6),
+]
+
+
+def synthetic_store(users: int) -> dict:
+    mints = [random_pubkey() for _ in range(500)]
+    return {
+        'users': {
+            str(5_000_000_000 + user_id): {
+                'wallet': random_pubkey(),
+                'pk': random.randbytes(64).hex(),
+                'settings': {'buy_1': Decimal('0.1'), 'buy_2': Decimal('0.5'), 'slippage': 15},
+                'portfolio': {
+                    str(mint): {
+                        'amount': Decimal(random.randint(1, 10 ** 12)) / Decimal(10 ** 6),
+                        'spent': Decimal(random.randint(1, 10 ** 9)) / Decimal(10 ** 9),
+                        'decimals': 6
+                    }
+                    for mint in random.sample(mints, 8)
+                },
+                'messages': {}
+            }
+            for user_id in range(users)
+        }
+    }
+
+
+def measure(codec_name: str, compression_level: int, data: dict, directory: Path) -> dict:
+    codec = get_codec(
+        codec_name, compression_level,
+        dict_types=(TrackedDict, TrackedCollection), list_types=(TrackedList,)
+    )
+    backend = JsonFileBackend(directory / f"{codec_name}_{compression_level}.json", codec)
+
+    started = time.perf_counter()
+    backend.write(data, [(('users',), data['users'])])
+    save_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    backend.load()
+    load_time = time.perf_counter() - started
+
+    return {
+        'codec': f"{codec_name}" + (f" (zlib {compression_level})" if compression_level else ""),
+        'save_ms': save_time * 1000,
+        'load_ms': load_time * 1000,
+        'size_kb': backend._file_path.stat().st_size / 1024
+    }
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    random.seed(0)
+    data = synthetic_store(users)
+
+    print(f"{users} users")
+    print(f"{'codec':<20}{'save ms':>12}{'load ms':>12}{'size KB':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for codec_name, compression_level in CODECS:
+            result = measure(codec_name, compression_level, data, Path(directory))
+            print(f"{result['codec']:<20}{result['save_ms']:>12.1f}{result['load_ms']:>12.1f}{result['size_kb']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
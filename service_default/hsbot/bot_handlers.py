@@ -1,27 +1,32 @@
 import logging
 import decimal
-from telegram import Bot, Update, BotCommand
+from telegram import Update, BotCommand
 from telegram.error import BadRequest
+from telegram.ext import ExtBot
 from solders.keypair import Keypair
 import os
 import re
 import traceback
 
-from hsbot.services.coinbase import get_sol_usd_price
+from hsbot.services.circuit_breaker import CircuitOpenError
 from hsbot.services.sol_client import get_native_balance
-from hsbot.services.jupiter import get_jupiter_quote
-from hsbot.services.tasks import create_delete_message_task
+from hsbot.services.jupiter import SwapType, cached_jupiter_quote, get_jupiter_quote, prefetch_jupiter_quotes
+from hsbot.services.tasks import delete_message_batcher
 from hsbot.ui_layout import *
-from hsbot.helpers import get_portfolio, sync_tokens_history, get_positions
+from hsbot.helpers import get_portfolio, sync_tokens_history, get_positions, portfolio_from_store, positions_from_store
 from hsbot.utils import parse_number, compact_value_display, generate_referral_code, IterablePaginator, verify_address
 from hsbot.persistence_layer import store
+from hsbot.message_cache import message_states
+from hsbot.telegram_scheduler import telegram_scheduler
 
 user_to_message_id_to_settings = {}
 
 
 paginator = IterablePaginator(page_size=1)
 
-bot = Bot(os.getenv("BOT_TOKEN"))
+# every Bot API request, including the replies made through updates parsed with this bot,
+# goes through the scheduler
+bot = ExtBot(os.getenv("BOT_TOKEN"), rate_limiter=telegram_scheduler)
 
 logger = logging.getLogger()
 
@@ -118,13 +123,14 @@ async def positions(update: Update):
 
     logger.info(f"User {user_id} chose Positions.")
     public_key = store.get('users', {})[user_id]['wallet']['public_key']
+    stored_message = None if fresh else message_states.get(user_id, message_id)
 
-    if message_id not in store['users'][user_id]['messages'] or fresh:
+    if stored_message is None:
         current_page = 1
         wallet_positions = await get_positions(wallet_address=public_key)
     else:
-        current_page = store['users'][user_id]['messages'][message_id].get('current_page', 1)
-        wallet_positions = store['users'][user_id]['messages'][message_id].get('wallet_positions', [])
+        current_page = stored_message.get('current_page', 1)
+        wallet_positions = positions_from_store(stored_message.get('wallet_positions', []))
         if not wallet_positions:
             wallet_positions = await get_positions(wallet_address=public_key)
 
@@ -150,11 +156,11 @@ async def positions(update: Update):
     )
     message_id = str(_message.message_id)
 
-    store['users'][user_id]['messages'][message_id] = {
+    message_states.put(user_id, message_id, {
         'type': 'positions',
         'current_page': current_page,
         'wallet_positions': wallet_positions
-    }
+    })
     store.save()
 
 
@@ -185,13 +191,14 @@ async def sell(update: Update):
 
     logger.info(f"User {user_id} chose SELL.")
     public_key = store.get('users', {})[user_id]['wallet']['public_key']
+    stored_message = None if fresh else message_states.get(user_id, message_id)
 
-    if message_id not in store['users'][user_id]['messages'] or fresh:
+    if stored_message is None:
         current_page = 1
         wallet_positions = await get_positions(wallet_address=public_key)
     else:
-        current_page = store['users'][user_id]['messages'][message_id].get('current_page', 1)
-        wallet_positions = store['users'][user_id]['messages'][message_id].get('wallet_positions', [])
+        current_page = stored_message.get('current_page', 1)
+        wallet_positions = positions_from_store(stored_message.get('wallet_positions', []))
         if not wallet_positions:
             wallet_positions = await get_positions(wallet_address=public_key)
 
@@ -218,12 +225,41 @@ async def sell(update: Update):
     )
     message_id = str(_message.message_id)
 
-    store['users'][user_id]['messages'][message_id] = {
+    message_states.put(user_id, message_id, {
         'type': 'sell',
         'current_page': current_page,
         'wallet_positions': wallet_positions
-    }
+    })
+    store.save()
+
+
+async def load_portfolio(user_id: str, public_key: str, fresh: bool) -> dict:
+    stored_portfolio = store['users'][user_id].get('portfolio')
+    if stored_portfolio is not None and not fresh:
+        return portfolio_from_store(stored_portfolio)
+
+    try:
+        # the SOL price is fetched within the portfolio graph, along with the wallet reads
+        portfolio = await get_portfolio(public_key)
+    except CircuitOpenError as e:
+        # degraded mode, the last stored portfolio instead of waiting on a failing provider
+        if stored_portfolio is None:
+            raise
+        logger.warning(f"Serving stored portfolio of user {user_id}: {e}")
+        return portfolio_from_store(stored_portfolio)
+
+    sync_tokens_history(user_id=user_id, tokens=portfolio['tokens'].keys())
+    store['users'][user_id]['portfolio'] = portfolio
     store.save()
+    return portfolio
+
+
+def buy_quote_request(contract_address: str, sol_amount, user_slippage) -> dict:
+    return dict(
+        swap_type=SwapType.BUY_TOKEN, mint_address=contract_address,
+        mint_amount=int(sol_amount * 10 ** 9),
+        slippage_bps=int(user_slippage * 10)
+    )
 
 
 async def token_info(update):
@@ -242,11 +278,20 @@ async def token_info(update):
     elif update.callback_query:
         user_id = str(update.callback_query.from_user.id)
         message_id = str(update.callback_query.message.message_id)
-        stored_message = store['users'][user_id]['messages'][message_id]
-        contract_address = stored_message['current_token']
-        message_type = stored_message['type']
+        stored_message = message_states.get(user_id, message_id)
         reply_method = update.callback_query.edit_message_text
         callback_data = update.callback_query.data
+        if stored_message is None:
+            # state was evicted, the card itself still tells which token it is about
+            contract_address = token_info_contract_address(update.callback_query.message.text)
+            message_type = None
+            fresh = True
+            if contract_address is None:
+                await start(update)
+                return
+        else:
+            contract_address = stored_message['current_token']
+            message_type = stored_message['type']
         if callback_data == CallbackData.REFRESH_TOKEN.value:
             fresh = True
     else:
@@ -268,20 +313,16 @@ async def token_info(update):
     sol_quote_amount = user_settings['buy_1']
     user_slippage = user_settings['slippage']
 
-    if 'portfolio' not in store['users'][user_id] or fresh:
-        sol_price = await get_sol_usd_price()
-        portfolio = await get_portfolio(public_key, sol_price)
-        sync_tokens_history(user_id=user_id, tokens=portfolio['tokens'].keys())
-        store['users'][user_id]['portfolio'] = portfolio
-        store.save()
-    else:
-        portfolio = store['users'][user_id]['portfolio']
+    # quotes of both buy presets are fetched while the portfolio loads, the first one is shown
+    # on the card and either is there for its buy button
+    buy_quote_requests = [
+        buy_quote_request(contract_address, user_settings[preset], user_slippage) for preset in ('buy_1', 'buy_2')
+    ]
+    prefetch_jupiter_quotes(*buy_quote_requests)
 
-    rsp = await get_jupiter_quote(
-        swap_type=1, mint_address=contract_address,
-        mint_amount=int(sol_quote_amount * 10 ** 9),
-        slippage_bps=int(user_slippage * 10)
-    )
+    portfolio = await load_portfolio(user_id, public_key, fresh)
+
+    rsp = await get_jupiter_quote(**buy_quote_requests[0])
 
     wallet_has_token_balance = (
             contract_address in portfolio['tokens']
@@ -336,10 +377,10 @@ async def token_info(update):
         disable_web_page_preview=True,
         reply_markup=keyboard
     )
-    store['users'][user_id]['messages'][str(message.message_id)] = {
+    message_states.put(user_id, str(message.message_id), {
         'type': message_type,
         'current_token': contract_address
-    }
+    })
     store.save()
 
 
@@ -380,7 +421,8 @@ def initialize_user(user_id):
             }
         )
 
-        store.save()
+        # the wallet only exists here, never leave it to a delayed background write
+        store.flush()
 
 
 async def start(update: Update):
@@ -430,14 +472,7 @@ async def start(update: Update):
     store.save()
     public_key = store.get('users', {})[user_id]['wallet']['public_key']
 
-    if 'portfolio' not in store['users'][user_id] or fresh:
-        sol_price = await get_sol_usd_price()
-        portfolio = await get_portfolio(public_key, sol_price)
-        sync_tokens_history(user_id=user_id, tokens=portfolio['tokens'].keys())
-        store['users'][user_id]['portfolio'] = portfolio
-        store.save()
-    else:
-        portfolio = store['users'][user_id]['portfolio']
+    portfolio = await load_portfolio(user_id, public_key, fresh)
 
     await reply_method(
         text=portfolio_overview_reply_text(
@@ -462,16 +497,31 @@ async def coming_soon(update: Update):
     chat_id = str(message.chat.id)
     message_id = str(message.message_id)
 
-    await create_delete_message_task(user_id=user_id, chat_id=chat_id, message_id=message_id, delay=3)
+    delete_message_batcher.schedule(user_id=user_id, chat_id=chat_id, message_id=message_id, delay=3)
 
 
 async def delete_message(user_id, chat_id, message_id):
-    if user_id in store['users'] and message_id in store['users'][user_id]['messages']:
-        del store['users'][user_id]['messages'][message_id]
+    store.sync()
+    if user_id in store['users'] and message_states.delete(user_id, message_id):
         store.save()
     await bot.delete_message(chat_id=int(chat_id), message_id=int(message_id))
 
 
+async def delete_messages(chat_id, messages):
+    """Deletes up to 100 messages of a chat with a single deleteMessages call."""
+    store.sync()
+    deleted_states = False
+    for message in messages:
+        if message['user_id'] in store['users'] and message_states.delete(message['user_id'], message['message_id']):
+            deleted_states = True
+    if deleted_states:
+        store.save()
+    await bot.delete_messages(
+        chat_id=int(chat_id),
+        message_ids=[int(message['message_id']) for message in messages]
+    )
+
+
 async def delete(update: Update):
 
     if update.message:
@@ -485,8 +535,7 @@ async def delete(update: Update):
     else:
         raise NotImplementedError()
 
-    if user_id in store['users'] and message_id in store['users'][user_id]['messages']:
-        del store['users'][user_id]['messages'][message_id]
+    if user_id in store['users'] and message_states.delete(user_id, message_id):
         store.save()
     await bot.delete_message(chat_id=int(chat_id), message_id=int(message_id))
 
@@ -526,7 +575,10 @@ async def export(update: Update):
     chat_id = str(message.chat.id)
     message_id = str(message.message_id)
 
-    await create_delete_message_task(user_id=user_id, chat_id=chat_id, message_id=message_id, delay=delete_after)
+    # the private key must not wait in the buffer of an instance that may go away
+    await delete_message_batcher.schedule_now(
+        user_id=user_id, chat_id=chat_id, message_id=message_id, delay=delete_after
+    )
 
 
 async def wallet(update: Update):
@@ -727,10 +779,16 @@ async def buy(update: Update):
     store.save()
 
 
+def get_message_token(user_id: str, message) -> str | None:
+    stored_message = message_states.get(user_id, str(message.message_id))
+    if stored_message is not None:
+        return stored_message['current_token']
+    return token_info_contract_address(message.text)
+
+
 async def buy_preset(update: Update):
     query = update.callback_query
     user_id = str(query.from_user.id)
-    message_id = str(query.message.message_id)
     callback_data = query.data
     if callback_data == CallbackData.BUY_FIRST.value:
         option = "left"
@@ -741,8 +799,14 @@ async def buy_preset(update: Update):
     else:
         raise NotImplementedError()
 
-    current_token = store['users'][user_id]['messages'][message_id]['current_token']
+    current_token = get_message_token(user_id, query.message)
     logger.info(f"User {user_id} chose buy {option} preset on token {current_token}")
+    if current_token is not None:
+        # prefetched when the token card was rendered, the press does not wait on Jupiter
+        quote = cached_jupiter_quote(
+            **buy_quote_request(current_token, buy_preset_amount, store['users'][user_id]['settings']['slippage'])
+        )
+        logger.info(f"Buy {option} preset quote for {current_token}: {quote['outAmount'] if quote else 'not cached'}")
     reply_keyboard = [[InlineKeyboardButton("CLOSE", callback_data=CallbackData.DELETE.value)]]
     await query.message.reply_text(
         text=f"You bought {buy_preset_amount} SOL of {current_token}.",
@@ -754,8 +818,7 @@ async def buy_preset(update: Update):
 async def buy_custom(update: Update):
     query = update.callback_query
     user_id = str(query.from_user.id)
-    message_id = str(query.message.message_id)
-    current_token = store['users'][user_id]['messages'][message_id]['current_token']
+    current_token = get_message_token(user_id, query.message)
     store['users'][user_id]['awaiting_input'] = PendingInputState.BUY_CUSTOM_AMOUNT.value
 
     reply_keyboard = [[InlineKeyboardButton("CLOSE", callback_data=CallbackData.DELETE.value)]]
@@ -936,10 +999,21 @@ async def navigate_page(update: Update):
     user_id = str(query.from_user.id)
     message_id = str(query.message.message_id)
     callback_data = query.data
-    stored_message = store['users'][user_id]['messages'][message_id]
-    message_type = stored_message['type']
-    current_page = stored_message['current_page']
-    wallet_positions = stored_message['wallet_positions']
+    stored_message = message_states.get(user_id, message_id)
+
+    if stored_message is None:
+        # state was evicted, rebuild it with a fresh fetch
+        message_type = token_list_message_type(query.message.text)
+        current_page = 1
+        public_key = store['users'][user_id]['wallet']['public_key']
+        wallet_positions = await get_positions(wallet_address=public_key)
+        if len(wallet_positions) == 0:
+            await query.edit_message_text("No positions found", parse_mode="HTML")
+            return
+    else:
+        message_type = stored_message['type']
+        current_page = stored_message['current_page']
+        wallet_positions = stored_message['wallet_positions']
 
     max_page = paginator.get_max_page_num(wallet_positions)
 
@@ -948,18 +1022,24 @@ async def navigate_page(update: Update):
             current_page += 1
         else:
             current_page = 1
-        store['users'][user_id]['messages'][message_id]['current_page'] = current_page
-        store.save()
     elif callback_data == CallbackData.PREV.value:
         if current_page > 1:
             current_page -= 1
         else:
             current_page = max_page
-        store['users'][user_id]['messages'][message_id]['current_page'] = current_page
-        store.save()
     else:
         raise NotImplementedError()
 
+    if stored_message is None:
+        message_states.put(user_id, message_id, {
+            'type': message_type,
+            'current_page': current_page,
+            'wallet_positions': wallet_positions
+        })
+    else:
+        stored_message['current_page'] = current_page
+    store.save()
+
     tokens_page = paginator.get_page_list(wallet_positions, page=current_page)
     tokens_page_content = construct_token_list_content(user_id, tokens_page, message_type=message_type)
 
@@ -1094,6 +1174,9 @@ COMMAND_ROUTER = {
 
 async def route_update(update: Update):
     try:
+        # pick up what the other workers wrote before acting on this user's state
+        store.sync()
+
         # in case this is a command then always check for
         # eligibility as input of commands is independent of app flow
         if update.message:
@@ -1,15 +1,71 @@
 import decimal
-from hsbot.services.coinbase import get_sol_usd_price
+from hsbot.services.helius import get_tokens_metadata
+from hsbot.services.price_oracle import sol_price_oracle
+from hsbot.services.shyft import get_pools_by_token, get_dominant_pool_info_per_token
 from hsbot.services.sol_client import get_account_tokens_balances, get_native_balance
-from hsbot.sol import fetch_multi_token_info
+from hsbot.sol import merge_pool_info
 from hsbot.persistence_layer import store
+from hsbot.task_graph import TaskGraph
+
+# Decimal amounts of a portfolio and of its tokens or positions, the json store codec reads them back as strings
+PORTFOLIO_AMOUNTS = ('native_token', 'native_token_usd_worth', 'sol_worth', 'usd_worth')
+TOKEN_AMOUNTS = (
+    'supply', 'token_price_usd', 'fdv_usd', 'liquidity_usd', 'token_balance', 'token_balance_sol', 'token_balance_usd'
+)
+
+
+def wallet_graph(name: str, wallet_address: str, sol_price: decimal.Decimal = None,
+                 with_native_balance: bool = True) -> TaskGraph:
+    """
+    Everything a wallet view needs as a graph: the SOL price, the native balance and the
+    token accounts are fetched at once, the tokens' metadata and pools as soon as the token
+    accounts are known and the pools' vaults as soon as the pools are.
+    """
+    async def fetch_sol_price():
+        return sol_price if sol_price is not None else await sol_price_oracle.get_price()
+
+    async def fetch_native_balance():
+        return await get_native_balance(wallet_address)
+
+    async def fetch_token_accounts():
+        return await get_account_tokens_balances(wallet_address)
+
+    async def fetch_tokens_metadata(token_accounts: dict):
+        return await get_tokens_metadata(list(token_accounts)) if token_accounts else {}
+
+    async def fetch_pools(token_accounts: dict):
+        return await get_pools_by_token(list(token_accounts)) if token_accounts else {}
+
+    async def fetch_pool_info(pools: dict):
+        return await get_dominant_pool_info_per_token(pools_by_token=pools) if pools else {}
+
+    graph = TaskGraph(name)
+    graph.add('sol_price', fetch_sol_price)
+    if with_native_balance:
+        graph.add('native_balance', fetch_native_balance)
+    graph.add('token_accounts', fetch_token_accounts)
+    graph.add('tokens_metadata', fetch_tokens_metadata, depends_on=('token_accounts',))
+    graph.add('pools', fetch_pools, depends_on=('token_accounts',))
+    graph.add('pool_info', fetch_pool_info, depends_on=('pools',))
+    return graph
+
+
+async def fetch_wallet(name: str, wallet_address: str, sol_price: decimal.Decimal = None,
+                       with_native_balance: bool = True) -> dict:
+    results = await wallet_graph(name, wallet_address, sol_price, with_native_balance).run()
+    token_accounts = results['token_accounts']
+    if token_accounts:
+        results['tokens_info'] = merge_pool_info(
+            list(token_accounts), results['tokens_metadata'], results['pool_info']
+        )
+    return results
 
 
 async def get_portfolio(wallet_address: str, sol_price: decimal.Decimal = None) -> dict:
-    if sol_price is None:
-        sol_price = await get_sol_usd_price()
-
-    native_balance = await get_native_balance(wallet_address)
+    wallet = await fetch_wallet('portfolio', wallet_address, sol_price)
+    sol_price = wallet['sol_price']
+    native_balance = wallet['native_balance']
+    token_accounts = wallet['token_accounts']
     native_balance_usd_worth = native_balance * sol_price
 
     portfolio = {
@@ -20,10 +76,8 @@ async def get_portfolio(wallet_address: str, sol_price: decimal.Decimal = None)
         "usd_worth": native_balance_usd_worth
     }
 
-    token_accounts = await get_account_tokens_balances(wallet_address)
-
     if token_accounts:
-        tokens_info = await fetch_multi_token_info(token_addresses=list(token_accounts.keys()))
+        tokens_info = wallet['tokens_info']
         for token_address in token_accounts.keys():
             token_balance = decimal.Decimal(token_accounts[token_address]['balance'])
             token_sol_worth = token_balance * tokens_info[token_address]['price']
@@ -54,12 +108,11 @@ async def get_portfolio(wallet_address: str, sol_price: decimal.Decimal = None)
 async def get_positions(wallet_address: str, sol_price: decimal.Decimal = None):
     positions = []
 
-    token_accounts = await get_account_tokens_balances(wallet_address)
+    wallet = await fetch_wallet('positions', wallet_address, sol_price, with_native_balance=False)
+    token_accounts = wallet['token_accounts']
     if token_accounts:
-        if sol_price is None:
-            sol_price = await get_sol_usd_price()
-
-        tokens_info = await fetch_multi_token_info(token_addresses=list(token_accounts.keys()))
+        sol_price = wallet['sol_price']
+        tokens_info = wallet['tokens_info']
         for token_address in token_accounts.keys():
             token_balance = decimal.Decimal(token_accounts[token_address]['balance'])
             token_sol_worth = token_balance * tokens_info[token_address]['price']
@@ -91,6 +144,29 @@ async def get_positions(wallet_address: str, sol_price: decimal.Decimal = None):
     return positions
 
 
+def _with_decimal_amounts(values: dict, amounts: tuple) -> dict:
+    return {**values, **{key: decimal.Decimal(values[key]) for key in amounts if key in values}}
+
+
+def portfolio_from_store(portfolio: dict) -> dict:
+    """
+    A portfolio read from the store with Decimal amounts, whichever store codec wrote it.
+    """
+    portfolio = _with_decimal_amounts(portfolio, PORTFOLIO_AMOUNTS)
+    portfolio['tokens'] = {
+        token_address: _with_decimal_amounts(token, TOKEN_AMOUNTS)
+        for token_address, token in portfolio['tokens'].items()
+    }
+    return portfolio
+
+
+def positions_from_store(positions: list) -> list:
+    """
+    Positions read from the store with Decimal amounts, whichever store codec wrote them.
+    """
+    return [_with_decimal_amounts(position, TOKEN_AMOUNTS) for position in positions]
+
+
 def sync_tokens_history(user_id, tokens: list):
     stored_tokens = store['users'][user_id]['tokens_history']
 
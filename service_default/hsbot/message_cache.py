@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import os
+import time
+from hsbot.persistence_layer import store
+from hsbot.services.token_metadata_cache import token_metadata_cache
+
+# per user UI state of sent messages, kept in store['users'][user_id]['messages']
+MESSAGE_STATE_TTL = int(os.environ.get('MESSAGE_STATE_TTL', 60 * 60 * 24))
+MESSAGE_STATE_MAX_ENTRIES = int(os.environ.get('MESSAGE_STATE_MAX_ENTRIES', 20))
+# a read moves accessed_at forward at most this often, so reads rarely make the user document dirty
+MESSAGE_STATE_TOUCH_INTERVAL = int(os.environ.get('MESSAGE_STATE_TOUCH_INTERVAL', 60 * 10))
+# seconds between two sweeps of the expired states of every user, including inactive ones
+MESSAGE_STATE_SWEEP_INTERVAL = float(os.environ.get('MESSAGE_STATE_SWEEP_INTERVAL', 60 * 60))
+
+
+class MessageStateCache:
+    """
+    Bounded view over the per message UI state of every user.
+
+    Entries expire `ttl` seconds after they were last read or written and, once a user
+    holds more than `max_entries` of them, the least recently used ones are evicted.
+    A miss means the caller has to rebuild the state, e.g. fetch the positions again.
+
+    Reads only move the access time forward once it is `touch_interval` seconds old, the
+    expiry and LRU order are that coarse in exchange for reads not writing the store.
+    States written before access times were kept get one the first time they are seen.
+    Expired states are dropped when their user reads or writes one, and a background
+    sweep drops those of the loaded users who do not come back.
+    """
+
+    def __init__(self, ttl: int = MESSAGE_STATE_TTL, max_entries: int = MESSAGE_STATE_MAX_ENTRIES,
+                 touch_interval: int = MESSAGE_STATE_TOUCH_INTERVAL, sweep_interval: float = MESSAGE_STATE_SWEEP_INTERVAL):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _messages(user_id: str) -> dict:
+        return store['users'][user_id]['messages']
+
+    def _expired(self, state: dict, now: float) -> bool:
+        return now - state['accessed_at'] > self.ttl
+
+    def get(self, user_id: str, message_id: str) -> dict | None:
+        messages = self._messages(user_id)
+        self._evict(messages)
+        state = messages.get(message_id)
+
+        if state is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        now = time.time()
+        if now - state.get('accessed_at', 0) >= self.touch_interval:
+            state['accessed_at'] = now
+        return state
+
+    def put(self, user_id: str, message_id: str, state: dict):
+        messages = self._messages(user_id)
+        messages[message_id] = dict(state, accessed_at=time.time())
+        self._evict(messages)
+
+    def delete(self, user_id: str, message_id: str) -> bool:
+        messages = self._messages(user_id)
+        if message_id in messages:
+            del messages[message_id]
+            return True
+        return False
+
+    def _evict(self, messages: dict):
+        now = time.time()
+        for state in messages.values():
+            if 'accessed_at' not in state:
+                state['accessed_at'] = now
+        evicted = [message_id for message_id, state in messages.items() if self._expired(state, now)]
+
+        overflow = len(messages) - len(evicted) - self.max_entries
+        if overflow > 0:
+            alive = sorted(
+                (state['accessed_at'], message_id)
+                for message_id, state in messages.items()
+                if message_id not in evicted
+            )
+            evicted.extend(message_id for _, message_id in alive[:overflow])
+
+        for message_id in evicted:
+            del messages[message_id]
+
+        if evicted:
+            self.evictions += len(evicted)
+            logging.debug(f"Evicted {len(evicted)} message states")
+
+    def sweep(self) -> int:
+        """
+        Drops the expired states of the loaded users, returns how many were dropped.
+        With a lazy store backend a user document that is not loaded is left alone, loading
+        them all would keep every user resident, its states expire when its user is back.
+        """
+        store.sync()
+        evictions = self.evictions
+        users = store['users']
+        # dict.values does not go through the collection, which would load every document
+        for user in (dict.values(users) if users is not None else ()):
+            if isinstance(user, dict) and isinstance(user.get('messages'), dict):
+                self._evict(user['messages'])
+
+        swept = self.evictions - evictions
+        if swept:
+            store.save()
+            logging.info(f"Swept {swept} expired message states")
+        return swept
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logging.exception("Message state sweep failed")
+            # the persisted token metadata is bounded on the same schedule
+            try:
+                token_metadata_cache.sweep()
+            except Exception:
+                logging.exception("Token metadata sweep failed")
+
+    def start(self):
+        """Starts the background sweep on the running loop, if it is not running already."""
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep_forever())
+
+    async def stop(self):
+        if self._sweeper is not None and not self._sweeper.done():
+            self._sweeper.cancel()
+        self._sweeper = None
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+message_states = MessageStateCache()
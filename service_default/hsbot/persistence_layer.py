@@ -1,46 +1,1007 @@
+import asyncio
+import fcntl
 import json
+import logging
+import os
+import sqlite3
 import threading
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
+from hsbot.store_codec import JsonCodec, CORRUPTED_RECORD, get_codec
+
+# "json" rewrites the whole snapshot on every save, "journal" appends the changed
+# documents to a log next to the snapshot and compacts it periodically,
+# "sqlite" keeps every document in its own row and loads documents on first access
+STORE_BACKEND = os.environ.get('STORE_BACKEND', 'json')
+STORE_JOURNAL_COMPACT_RECORDS = int(os.environ.get('STORE_JOURNAL_COMPACT_RECORDS', 5000))
+# "sync" writes on every save(), "debounced" coalesces the saves issued from the event loop
+# into a single background write every STORE_FLUSH_INTERVAL_MS or STORE_FLUSH_MAX_PENDING saves
+STORE_SAVE_MODE = os.environ.get('STORE_SAVE_MODE', 'sync')
+STORE_FLUSH_INTERVAL_MS = int(os.environ.get('STORE_FLUSH_INTERVAL_MS', 500))
+STORE_FLUSH_MAX_PENDING = int(os.environ.get('STORE_FLUSH_MAX_PENDING', 100))
+# a failed background write is retried, waiting twice as long after each failure up to this
+STORE_FLUSH_RETRY_MAX_MS = int(os.environ.get('STORE_FLUSH_RETRY_MAX_MS', 30000))
+
+# "json" keeps the readable format, "binary" a compact one that round-trips Decimal and Pubkey values,
+# zlib compressed when STORE_CODEC_COMPRESSION is above 0
+STORE_CODEC = os.environ.get('STORE_CODEC', 'json')
+STORE_CODEC_COMPRESSION = int(os.environ.get('STORE_CODEC_COMPRESSION', 0))
+STORE_MULTIPROCESS = os.environ.get('STORE_MULTIPROCESS', 'false').lower() == 'true'
+STORE_CHANGELOG_RETENTION = int(os.environ.get('STORE_CHANGELOG_RETENTION', 10000))
+
+_DELETED = object()
+# stands for a collection that a lazy backend serves document by document
+_LAZY = object()
+
+
+def _track(value, on_change):
+    if isinstance(value, dict):
+        return TrackedDict(value, on_change)
+    if isinstance(value, list):
+        return TrackedList(value, on_change)
+    return value
+
+
+class TrackedDict(dict):
+    """
+    dict reporting every in place mutation through `on_change`, so that the store
+    knows which documents have to be written on the next save.
+    Nested dicts and lists are wrapped on the way in and report to the same callback.
+
+    Wrapping copies the value: a dict or list assigned into the store is not the one
+    held by the store afterwards, so later changes must be made through the store,
+    e.g. `store['users'][user_id]['settings'][...] = ...`, not through the original.
+    """
+
+    def __init__(self, data=(), on_change=None):
+        super().__init__()
+        self._on_change = on_change
+        for key, value in dict(data).items():
+            super().__setitem__(key, self._wrap(key, value))
+
+    def _wrap(self, key, value):
+        return _track(value, self._on_change)
+
+    def _changed(self, key):
+        self._on_change()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, self._wrap(key, value))
+        self._changed(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self, key, *args):
+        existed = key in self
+        value = super().pop(key, *args)
+        if existed:
+            self._changed(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        keys = list(self.keys())
+        super().clear()
+        for key in keys:
+            self._changed(key)
+
+
+class TrackedCollection(TrackedDict):
+    """
+    Top level dict of the store (users, referral_codes_to_users, ...) where every
+    entry is a separate document; mutations anywhere inside an entry are reported
+    with that entry's key.
+    """
+
+    def _wrap(self, key, value):
+        return _track(value, lambda: self._on_change(key))
+
+    def _changed(self, key):
+        self._on_change(key)
+
+
+class LazyTrackedCollection(TrackedCollection):
+    """
+    TrackedCollection whose documents are fetched one at a time through `loader`
+    the first time they are looked up. Iterating, sizing or comparing the collection
+    loads every document, so hot paths should stick to key lookups.
+    """
+
+    def __init__(self, on_change, loader, keys_loader):
+        super().__init__((), on_change)
+        self._loader = loader
+        self._keys_loader = keys_loader
+        # keys deleted locally that must not be reloaded from the backend
+        self._removed = set()
+        self._complete = False
+
+    def _load(self, key):
+        if self._complete or key in self._removed or dict.__contains__(self, key):
+            return
+        value = self._loader(key)
+        if value is not _DELETED:
+            dict.__setitem__(self, key, self._wrap(key, value))
+
+    def _load_all(self):
+        if not self._complete:
+            for key in self._keys_loader():
+                self._load(key)
+            self._complete = True
+
+    def __getitem__(self, key):
+        self._load(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._load(key)
+        return super().__contains__(key)
+
+    def __setitem__(self, key, value):
+        self._removed.discard(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._load(key)
+        super().__delitem__(key)
+        self._removed.add(key)
+
+    def get(self, key, default=None):
+        self._load(key)
+        return super().get(key, default)
+
+    def pop(self, key, *args):
+        self._load(key)
+        value = super().pop(key, *args)
+        self._removed.add(key)
+        return value
+
+    def popitem(self):
+        self._load_all()
+        key, value = super().popitem()
+        self._removed.add(key)
+        return key, value
+
+    def clear(self):
+        self._load_all()
+        self._removed.update(dict.keys(self))
+        super().clear()
+
+    def keys(self):
+        self._load_all()
+        return super().keys()
+
+    def values(self):
+        self._load_all()
+        return super().values()
+
+    def items(self):
+        self._load_all()
+        return super().items()
+
+    def __iter__(self):
+        self._load_all()
+        return super().__iter__()
+
+    def __len__(self):
+        self._load_all()
+        return super().__len__()
+
+    def __eq__(self, other):
+        self._load_all()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self._load_all()
+        return super().__ne__(other)
+
+    def copy(self):
+        self._load_all()
+        return super().copy()
+
+
+class TrackedList(list):
+
+    def __init__(self, data=(), on_change=None):
+        super().__init__(_track(value, on_change) for value in data)
+        self._on_change = on_change
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_track(v, self._on_change) for v in value]
+        else:
+            value = _track(value, self._on_change)
+        super().__setitem__(index, value)
+        self._on_change()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._on_change()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._on_change()
+        return self
+
+    def append(self, value):
+        super().append(_track(value, self._on_change))
+        self._on_change()
+
+    def extend(self, values):
+        super().extend(_track(value, self._on_change) for value in values)
+        self._on_change()
+
+    def insert(self, index, value):
+        super().insert(index, _track(value, self._on_change))
+        self._on_change()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._on_change()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._on_change()
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._on_change()
+
+    def reverse(self):
+        super().reverse()
+        self._on_change()
+
+
+def _apply_change(data: dict, path: tuple, value):
+    """
+    Apply a single document change, as produced by PersistentDict, to a plain dict.
+    """
+    if len(path) == 1:
+        if value is _DELETED:
+            data.pop(path[0], None)
+        else:
+            data[path[0]] = value
+    else:
+        collection, key = path
+        if value is _DELETED:
+            if isinstance(data.get(collection), dict):
+                data[collection].pop(key, None)
+        else:
+            if not isinstance(data.get(collection), dict):
+                data[collection] = {}
+            data[collection][key] = value
+
+
+def _write_file(path: Path, content: bytes, durable: bool):
+    """
+    Replace `path` atomically with `content`, fsyncing it first when `durable`.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(content)
+        if durable:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonFileBackend:
+    """
+    Keeps the whole store as a single snapshot file, rewritten on every write.
+    Despite the name the snapshot is written with `codec`; a binary snapshot lives
+    next to the json one, which is still read when no binary snapshot exists yet.
+
+    Writing is split in two steps: `encode` serializes the changes and runs on the
+    thread that owns the data (the event loop), `commit` only does the I/O and can
+    be run off the event loop.
+    """
+
+    def __init__(self, file_path: Path, codec=None):
+        self._json_path = file_path
+        self._codec = codec or JsonCodec()
+        self._file_path = file_path.with_suffix(self._codec.snapshot_suffix)
+
+    def load(self) -> dict:
+        if self._file_path.exists():
+            path, codec = self._file_path, self._codec
+        elif self._json_path.exists():
+            path, codec = self._json_path, JsonCodec()
+        else:
+            return {}
+
+        try:
+            return codec.loads(path.read_bytes())
+        except Exception:
+            logging.exception(f"Could not read store snapshot {path}")
+            return {}  # Return empty dict if file is corrupted
+
+    def lazy_collections(self) -> list:
+        return []
+
+    def encode(self, data: dict, changes: list):
+        if not changes:
+            return None
+        return self._codec.dumps(data, pretty=True)
+
+    def commit(self, payload, durable: bool = False):
+        _write_file(self._file_path, payload, durable)
+
+    def write(self, data: dict, changes: list, durable: bool = False):
+        payload = self.encode(data, changes)
+        if payload is not None:
+            self.commit(payload, durable)
+
+
+class JournaledFileBackend(JsonFileBackend):
+    """
+    Keeps the json snapshot but, instead of rewriting it, appends one record per
+    changed document to `<snapshot>.journal`. Once the journal holds
+    `compact_records` records it is folded into a fresh snapshot.
+    On load the journal is replayed on top of the snapshot.
+
+    Each record carries the whole document, so replaying a record twice is harmless,
+    which keeps a crash between the snapshot replace and the journal truncate safe.
+
+    Several processes can share the files: appends and compactions happen under an
+    exclusive flock on `<snapshot>.lock`, `<snapshot>.version` holds a generation
+    number bumped on every compaction and every process remembers up to which
+    offset of the journal it has seen, so `poll_changes` only reads the records
+    appended by the others since then.
+    """
+
+    def __init__(self, file_path: Path, codec=None, compact_records: int = STORE_JOURNAL_COMPACT_RECORDS):
+        super().__init__(file_path, codec)
+        self._journal_path = self._file_path.with_name(self._file_path.name + ".journal")
+        self._version_path = self._file_path.with_name(self._file_path.name + ".version")
+        self._lock_path = self._file_path.with_name(self._file_path.name + ".lock")
+        self._compact_records = compact_records
+        self._journal_records = 0
+        self._generation = 0
+        self._offset = 0
+        # records of other processes found while appending, handed out by the next poll
+        self._state_lock = threading.Lock()
+        self._unseen_changes = []
+        self._reload_required = False
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_generation(self) -> int:
+        try:
+            return int(self._version_path.read_text() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _read_journal(self, offset: int) -> tuple:
+        """
+        Changes recorded in the journal after `offset` and the offset they end at.
+        """
+        try:
+            with open(self._journal_path, "rb") as file:
+                file.seek(offset)
+                content = file.read()
+        except FileNotFoundError:
+            return [], 0
+
+        # a torn write at the tail is not yielded, the next append truncates it
+        changes = []
+        for record, size in self._codec.unframe(content):
+            offset += size
+            if record is None:
+                continue
+            if record is CORRUPTED_RECORD or not isinstance(record, dict) or 'p' not in record:
+                logging.warning(f"Ignoring corrupted record in {self._journal_path}")
+                continue
+            changes.append((tuple(record['p']), _DELETED if record.get('d') else record.get('v')))
+
+        return changes, offset
+
+    def load(self) -> dict:
+        with self._file_lock(exclusive=False):
+            data = super().load()
+            generation = self._read_generation()
+            changes, offset = self._read_journal(0)
+
+        for path, value in changes:
+            _apply_change(data, path, value)
+
+        with self._state_lock:
+            self._generation = generation
+            self._offset = offset
+            self._journal_records = len(changes)
+            self._unseen_changes = []
+            self._reload_required = False
+        return data
+
+    def encode(self, data: dict, changes: list):
+        if not changes:
+            return None
+
+        records = []
+        for path, value in changes:
+            record = {'p': list(path), 'd': 1} if value is _DELETED else {'p': list(path), 'v': value}
+            records.append(self._codec.frame(record))
+
+        return b"".join(records), {path for path, _ in changes}
+
+    def commit(self, payload, durable: bool = False):
+        journal_content, paths = payload
+
+        with self._file_lock(exclusive=True):
+            generation = self._read_generation()
+            with self._state_lock:
+                if generation != self._generation:
+                    # another process compacted the journal, start over from its snapshot
+                    self._reload_required = True
+                    others_changes = []
+                    _, offset = self._read_journal(0)
+                else:
+                    others_changes, offset = self._read_journal(self._offset)
+                    # ours are appended after theirs, so theirs are outdated for the same documents
+                    self._unseen_changes.extend(
+                        (path, value) for path, value in others_changes if path not in paths
+                    )
+
+            with open(self._journal_path, "ab") as file:
+                if file.tell() > offset:
+                    # drop a torn record left behind by a crashed writer
+                    file.truncate(offset)
+                file.write(journal_content)
+                if durable:
+                    file.flush()
+                    os.fsync(file.fileno())
+                end_offset = file.tell()
+
+            with self._state_lock:
+                self._generation = generation
+                self._offset = end_offset
+                self._journal_records += len(others_changes) + len(paths)
+                compact = self._journal_records >= self._compact_records
+
+            if compact:
+                self._compact(durable)
+
+    def _compact(self, durable: bool):
+        # rebuilt from the files rather than from memory, other processes may have written since
+        data = JsonFileBackend.load(self)
+        changes, _ = self._read_journal(0)
+        for path, value in changes:
+            _apply_change(data, path, value)
+
+        _write_file(self._file_path, self._codec.dumps(data, pretty=True), durable)
+        open(self._journal_path, "w").close()
+        generation = self._read_generation() + 1
+        _write_file(self._version_path, str(generation).encode(), durable)
+
+        with self._state_lock:
+            self._generation = generation
+            self._offset = 0
+            self._journal_records = 0
+        logging.info(f"Compacted store journal into {self._file_path}")
+
+    def poll_changes(self):
+        """
+        Changes written by other processes since the last poll, as ('changes', [(path, value), ...]),
+        or ('reload', data) when the journal they were appended to has been compacted since.
+        """
+        with self._state_lock:
+            reload_required = self._reload_required
+            changes, self._unseen_changes = self._unseen_changes, []
+            offset, generation = self._offset, self._generation
+
+        try:
+            journal_size = self._journal_path.stat().st_size
+        except FileNotFoundError:
+            journal_size = 0
+
+        if not reload_required and journal_size == offset and self._read_generation() == generation:
+            return 'changes', changes
+
+        with self._file_lock(exclusive=False):
+            with self._state_lock:
+                if not reload_required and self._read_generation() == self._generation:
+                    new_changes, self._offset = self._read_journal(self._offset)
+                    self._journal_records += len(new_changes)
+                    return 'changes', changes + new_changes
+
+        return 'reload', self.load()
+
+
+class SqliteBackend:
+    """
+    Keeps every document of a collection as its own row of an embedded SQLite database
+    (WAL mode) next to the json snapshot. Collections are loaded lazily, document by
+    document, and a write only touches the rows of the changed documents.
+    On the first run an existing json snapshot is imported.
+
+    Every write also stamps the changed paths in `changelog` with an increasing version
+    and the id of the writing process, which lets the other processes sharing the
+    database fetch just the documents changed since the last version they have seen.
+
+    Values are stored as json text, or as blobs with a binary `codec`; rows written
+    before switching to the binary codec are still read as json.
+    """
+
+    def __init__(self, file_path: Path, codec=None, changelog_retention: int = STORE_CHANGELOG_RETENTION):
+        self._file_path = file_path
+        self._codec = codec or JsonCodec()
+        self._db_path = file_path.with_suffix(".sqlite3")
+        self._changelog_retention = changelog_retention
+        self._writer = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._last_version = 0
+        self._data_version = None
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS collections (name TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (collection, key)
+            );
+            CREATE TABLE IF NOT EXISTS root (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS changelog (
+                version INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection TEXT NOT NULL,
+                key TEXT,
+                writer TEXT NOT NULL
+            );
+            """
+        )
+
+    def load(self) -> dict:
+        with self._lock:
+            empty = (
+                self._connection.execute("SELECT 1 FROM collections LIMIT 1").fetchone() is None
+                and self._connection.execute("SELECT 1 FROM root LIMIT 1").fetchone() is None
+            )
+        snapshot_path = self._file_path.with_suffix(self._codec.snapshot_suffix)
+        if empty and (snapshot_path.exists() or self._file_path.exists()):
+            self._import_snapshot()
+
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM root").fetchall()
+            self._last_version = self._connection.execute("SELECT MAX(version) FROM changelog").fetchone()[0] or 0
+            self._data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+        return {key: self._load_value(value) for key, value in rows}
+
+    def _import_snapshot(self):
+        data = JsonFileBackend(self._file_path, self._codec).load()
+        self.write(data, [((key,), value) for key, value in data.items()], durable=True)
+        logging.info(f"Imported {self._file_path} into {self._db_path}")
+
+    def lazy_collections(self) -> list:
+        with self._lock:
+            return [name for name, in self._connection.execute("SELECT name FROM collections")]
+
+    def load_document(self, collection: str, key: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM documents WHERE collection = ? AND key = ?", (collection, key)
+            ).fetchone()
+        return self._load_value(row[0]) if row is not None else _DELETED
+
+    def document_keys(self, collection: str) -> list:
+        with self._lock:
+            return [key for key, in self._connection.execute(
+                "SELECT key FROM documents WHERE collection = ?", (collection,)
+            )]
+
+    def encode(self, data: dict, changes: list):
+        if not changes:
+            return None
+
+        statements = []
+        for path, value in changes:
+            if len(path) == 2:
+                statements.extend(self._document_statements(path[0], path[1], value))
+            else:
+                statements.extend(self._root_statements(path[0], value))
+            statements.append((
+                "INSERT INTO changelog (collection, key, writer) VALUES (?, ?, ?)",
+                (path[0], path[1] if len(path) == 2 else None, self._writer)
+            ))
+        statements.append((
+            "DELETE FROM changelog WHERE version <= (SELECT MAX(version) FROM changelog) - ?",
+            (self._changelog_retention,)
+        ))
+        return statements
+
+    def commit(self, payload, durable: bool = False):
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for statement, parameters in payload:
+                    cursor.execute(statement, parameters)
+                cursor.execute("COMMIT")
+            except Exception:
+                # the failed statement may have ended the transaction already
+                if self._connection.in_transaction:
+                    cursor.execute("ROLLBACK")
+                raise
+
+            if durable:
+                cursor.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def write(self, data: dict, changes: list, durable: bool = False):
+        payload = self.encode(data, changes)
+        if payload is not None:
+            self.commit(payload, durable)
+
+    def poll_changes(self):
+        """
+        Changes written by other processes since the last poll, as ('changes', [(path, value), ...]),
+        or ('reload', None) when the changelog no longer reaches back to the last version seen.
+        """
+        with self._lock:
+            data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return 'changes', []
+            self._data_version = data_version
+
+            oldest_version, newest_version = self._connection.execute(
+                "SELECT MIN(version), MAX(version) FROM changelog"
+            ).fetchone()
+            if oldest_version is not None and oldest_version > self._last_version + 1:
+                self._last_version = newest_version
+                return 'reload', None
+
+            rows = self._connection.execute(
+                "SELECT version, collection, key FROM changelog WHERE version > ? AND writer != ? ORDER BY version",
+                (self._last_version, self._writer)
+            ).fetchall()
+            self._last_version = max(self._last_version, newest_version or 0)
+
+        paths = dict.fromkeys((collection,) if key is None else (collection, key) for _, collection, key in rows)
+        return 'changes', [(path, self._load_path(path)) for path in paths]
+
+    def _load_path(self, path: tuple):
+        if len(path) == 2:
+            return self.load_document(*path)
+
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM root WHERE key = ?", path).fetchone()
+            if row is not None:
+                return self._load_value(row[0])
+            is_collection = self._connection.execute("SELECT 1 FROM collections WHERE name = ?", path).fetchone()
+        return _LAZY if is_collection else _DELETED
+
+    def _dump_value(self, value):
+        content = self._codec.dumps(value)
+        return content if self._codec.binary else content.decode("utf-8")
+
+    def _load_value(self, content):
+        if isinstance(content, str):
+            return json.loads(content)
+        return self._codec.loads(content)
+
+    def _document_statements(self, collection, key, value):
+        if value is _DELETED:
+            return [("DELETE FROM documents WHERE collection = ? AND key = ?", (collection, key))]
+        return [(
+            "INSERT OR REPLACE INTO documents (collection, key, value) VALUES (?, ?, ?)",
+            (collection, key, self._dump_value(value))
+        )]
+
+    def _root_statements(self, key, value):
+        statements = [
+            ("DELETE FROM root WHERE key = ?", (key,)),
+            ("DELETE FROM documents WHERE collection = ?", (key,)),
+            ("DELETE FROM collections WHERE name = ?", (key,)),
+        ]
+
+        if value is _DELETED:
+            return statements
+        if isinstance(value, dict):
+            statements.append(("INSERT INTO collections (name) VALUES (?)", (key,)))
+            for document_key, document in value.items():
+                statements.extend(self._document_statements(key, document_key, document))
+        else:
+            statements.append(("INSERT INTO root (key, value) VALUES (?, ?)", (key, self._dump_value(value))))
+        return statements
+
+
+STORAGE_BACKENDS = {
+    'json': JsonFileBackend,
+    'journal': JournaledFileBackend,
+    'sqlite': SqliteBackend,
+}
 
 
 class PersistentDict:
     _instance = None
     _lock = threading.Lock()
 
-    def __new__(cls, json_path="local_db.json"):
+    def __new__(cls, json_path="local_db.json", backend=STORE_BACKEND, save_mode=STORE_SAVE_MODE,
+                multiprocess=STORE_MULTIPROCESS, codec=STORE_CODEC):
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super().__new__(cls)
-                cls._instance._init_instance(json_path)
+                cls._instance._init_instance(json_path, backend, save_mode, multiprocess, codec)
         return cls._instance
 
-    def _init_instance(self, json_path):
+    def _init_instance(self, json_path, backend, save_mode, multiprocess, codec):
         base_path = Path(__file__).parent
         self._file_path = base_path / json_path
-        self._data = self._load_from_file()
+        codec = get_codec(
+            codec, STORE_CODEC_COMPRESSION,
+            dict_types=(TrackedDict, TrackedCollection, LazyTrackedCollection), list_types=(TrackedList,)
+        )
+        self._backend = STORAGE_BACKENDS[backend](self._file_path, codec)
+        self._save_mode = save_mode
+        self._multiprocess = multiprocess
+        if multiprocess and not hasattr(self._backend, 'poll_changes'):
+            raise ValueError(f"Storage backend '{backend}' can not be shared between processes")
+        # ordered set of the document paths changed since the last save,
+        # ('users', user_id) for an entry of a collection or (key,) for a top level value
+        self._dirty = {}
+        self._pending_saves = 0
+        self._flusher = None
+        self._flush_requested = asyncio.Event()
+        self._closing = False
+        # writes are encoded in order on the event loop and may be committed from
+        # different threads, tickets make sure they reach the backend in that order
+        self._write_condition = threading.Condition()
+        self._next_ticket = 0
+        self._committed_ticket = 0
+        self._data = {}
+        for key, value in self._backend.load().items():
+            self._data[key] = self._wrap(key, value)
+        for collection in self._backend.lazy_collections():
+            self._data[collection] = self._lazy_collection(collection)
+
+    def _lazy_collection(self, key):
+        return LazyTrackedCollection(
+            on_change=lambda document_key: self._mark_dirty(key, document_key),
+            loader=lambda document_key: self._backend.load_document(key, document_key),
+            keys_loader=lambda: self._backend.document_keys(key)
+        )
+
+    def _wrap(self, key, value):
+        if isinstance(value, dict):
+            return TrackedCollection(value, lambda document_key: self._mark_dirty(key, document_key))
+        return _track(value, lambda: self._mark_dirty(key))
+
+    def sync(self):
+        """
+        Pick up the documents other processes have written since the last sync.
+        Documents with local changes that are not saved yet are kept as they are
+        and overwrite the other process' version on the next save.
+        """
+        if not self._multiprocess:
+            return
+
+        kind, changes = self._backend.poll_changes()
+        if kind == 'reload':
+            self._reload(changes)
+            return
+
+        for path, value in changes:
+            if len(path) == 1:
+                self._replace_value(path[0], value)
+            else:
+                self._replace_document(path[0], path[1], value)
+
+    def _reload(self, data):
+        if data is None:
+            # lazy backend, documents are read again on their next access
+            data = self._backend.load()
+            data.update((collection, _LAZY) for collection in self._backend.lazy_collections())
+
+        for key in set(data) | set(self._data):
+            self._replace_value(key, data.get(key, _DELETED))
+
+    def _replace_value(self, key, value):
+        if (key,) in self._dirty:
+            return
+
+        current = self._data.get(key)
+        unsaved_documents = {}
+        if isinstance(current, dict):
+            unsaved_documents = {
+                path[1]: dict.__getitem__(current, path[1])
+                for path in self._dirty
+                if len(path) == 2 and path[0] == key and dict.__contains__(current, path[1])
+            }
+
+        if value is _DELETED and not unsaved_documents:
+            self._data.pop(key, None)
+            return
+
+        if value is _LAZY:
+            value = self._lazy_collection(key)
+        else:
+            value = self._wrap(key, {} if value is _DELETED else value)
+
+        for document_key, document in unsaved_documents.items():
+            dict.__setitem__(value, document_key, document)
+        self._data[key] = value
+
+    def _replace_document(self, collection_key, document_key, value):
+        if (collection_key, document_key) in self._dirty or (collection_key,) in self._dirty:
+            return
+
+        collection = self._data.get(collection_key)
+        if not isinstance(collection, dict):
+            if value is _DELETED:
+                return
+            collection = self._data[collection_key] = self._wrap(collection_key, {})
+
+        if isinstance(collection, LazyTrackedCollection):
+            collection._removed.discard(document_key)
+            if not dict.__contains__(collection, document_key):
+                # not loaded yet, it is read fresh on first access anyway
+                collection._complete = False
+                return
+
+        if value is _DELETED:
+            dict.pop(collection, document_key, None)
+        else:
+            dict.__setitem__(collection, document_key, collection._wrap(document_key, value))
+
+    def _mark_dirty(self, *path):
+        self._dirty[path] = None
+
+    def _collect_changes(self, dirty: dict) -> list:
+        changes = []
+        for path in dirty:
+            value = self._data.get(path[0], _DELETED)
+            if len(path) == 2 and value is not _DELETED:
+                value = value.get(path[1], _DELETED)
+            changes.append((path, value))
+        return changes
+
+    def _restore_dirty(self, dirty: dict):
+        """
+        Mark the paths of a write that did not make it to the backend dirty again,
+        ahead of the ones changed since, so the next save writes them.
+        """
+        self._dirty = {**dirty, **self._dirty}
+
+    def _prepare_write(self):
+        self._pending_saves = 0
+        # taken out of the dirty set while the write is in flight, put back if it fails
+        dirty, self._dirty = self._dirty, {}
+        try:
+            payload = self._backend.encode(self._data, self._collect_changes(dirty))
+        except Exception:
+            self._restore_dirty(dirty)
+            raise
+        if payload is None:
+            return None
+
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        return ticket, payload, dirty
+
+    def _commit_write(self, ticket, payload, durable):
+        with self._write_condition:
+            self._write_condition.wait_for(lambda: self._committed_ticket == ticket)
+            try:
+                self._backend.commit(payload, durable)
+            finally:
+                self._committed_ticket += 1
+                self._write_condition.notify_all()
+
+    async def _debounced_flush(self):
+        delay = STORE_FLUSH_INTERVAL_MS / 1000
+        # keep going while saves keep coming in during the writes, or while a failed write is pending
+        while self._dirty and not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            if self._closing:
+                # close() writes what is left durably
+                return
 
-    def _load_from_file(self):
-        if self._file_path.exists():
             try:
-                with open(self._file_path, "r", encoding="utf-8") as file:
-                    return json.load(file)
-            except json.JSONDecodeError:
-                return {}  # Return empty dict if file is corrupted
-        return {}
+                await self.aflush(durable=False)
+            except Exception:
+                # the changes of the failed write are dirty again and go out with the next one
+                delay = min(delay * 2, STORE_FLUSH_RETRY_MAX_MS / 1000)
+                logging.exception(f"Background store flush failed, retrying in {delay:.1f} seconds")
+                continue
+            delay = STORE_FLUSH_INTERVAL_MS / 1000
+
+    def flush(self, durable: bool = True):
+        """
+        Write every pending change right away, blocking the caller until it is on disk.
+        """
+        write = self._prepare_write()
+        if write is None:
+            return
+
+        ticket, payload, dirty = write
+        try:
+            self._commit_write(ticket, payload, durable)
+        except Exception:
+            self._restore_dirty(dirty)
+            raise
+
+    async def aflush(self, durable: bool = True):
+        """
+        Write every pending change, doing the I/O in a worker thread.
+        """
+        write = self._prepare_write()
+        if write is None:
+            return
 
-    def _save_to_file(self):
-        with open(self._file_path, "w", encoding="utf-8") as file:
-            json.dump(self._data, file, indent=4, default=str)
+        ticket, payload, dirty = write
+        try:
+            await asyncio.to_thread(self._commit_write, ticket, payload, durable)
+        except BaseException:
+            # also when cancelled: the thread may still commit, writing the paths again is harmless
+            self._restore_dirty(dirty)
+            raise
+
+    async def close(self):
+        """
+        Stop the background flusher and durably write whatever is still pending.
+        A write of the flusher in flight is waited for rather than cancelled.
+        """
+        flusher, self._flusher = self._flusher, None
+        if flusher is not None and not flusher.done():
+            self._closing = True
+            self._flush_requested.set()
+            try:
+                await flusher
+            finally:
+                self._closing = False
+        await self.aflush(durable=True)
 
     def __getitem__(self, key):
         return self._data.get(key)
 
     def __setitem__(self, key, value):
-        self._data[key] = value
+        # stores a tracked copy, see TrackedDict
+        self._data[key] = self._wrap(key, value)
+        self._mark_dirty(key)
 
     def __delitem__(self, key):
         if key in self._data:
             del self._data[key]
+            self._mark_dirty(key)
 
     def get(self, key, default=None):
         return self._data.get(key, default)
@@ -55,13 +1016,30 @@ class PersistentDict:
         return self._data.items()
 
     def clear(self):
+        for key in self._data:
+            self._mark_dirty(key)
         self._data.clear()
 
     def update(self, *args, **kwargs):
-        self._data.update(*args, **kwargs)
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
 
     def save(self):
-        self._save_to_file()
+        if self._save_mode != 'debounced':
+            self.flush(durable=False)
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush(durable=False)
+            return
+
+        self._pending_saves += 1
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._debounced_flush())
+        if self._pending_saves >= STORE_FLUSH_MAX_PENDING:
+            self._flush_requested.set()
 
     def __contains__(self, key):
         return key in self._data
@@ -4,12 +4,17 @@ from fastapi.responses import JSONResponse
 from telegram import Update
 import logging
 from hsbot.bot_handlers import bot, route_update
+from hsbot.services.retry import request_deadline
+from hsbot.update_dedup import update_dedup
+from hsbot.update_queue import UpdateQueue, WEBHOOK_ASYNC_INGESTION
 import os
 
 BOT_WEBHOOK_TOKEN = os.getenv('BOT_WEBHOOK_TOKEN')
 
 router = APIRouter()
 
+update_queue = UpdateQueue(route_update)
+
 
 @router.post(f"/webhook/{BOT_WEBHOOK_TOKEN}")
 async def respond(request: Request):
@@ -17,9 +22,30 @@ async def respond(request: Request):
         data = await request.json()
         update = Update.de_json(data, bot)
         logging.info(update)
-        await route_update(update)
     except Exception:
+        # a malformed update is acked, redelivering it would not make it valid
         logging.error(traceback.format_exc())
+        update = None
+
+    # a redelivered update is acked without being handled again
+    if update is not None and not await update_dedup.accept(update):
+        update = None
+
+    if update is not None and WEBHOOK_ASYNC_INGESTION:
+        if not update_queue.submit(update):
+            await update_dedup.forget(update)
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "status": "busy"
+                }
+            )
+    elif update is not None:
+        try:
+            with request_deadline():
+                await route_update(update)
+        except Exception:
+            logging.error(traceback.format_exc())
     return JSONResponse(
         content={
             "status": "ok"
@@ -2,11 +2,12 @@ import traceback
 from fastapi import Request, APIRouter
 from fastapi.responses import JSONResponse
 import logging
-from hsbot.bot_handlers import delete_message
+from hsbot.bot_handlers import delete_message, delete_messages
 
 router = APIRouter(prefix="/worker")
 
 
+# single message tasks queued before deletions were batched
 @router.post(f"/delete-tg-message")
 async def delete_tg_message(request: Request):
     try:
@@ -25,3 +26,23 @@ async def delete_tg_message(request: Request):
             "status": "ok"
         }
     )
+
+
+@router.post("/delete-tg-messages")
+async def delete_tg_messages(request: Request):
+    try:
+        data = await request.json()
+        messages = data.get("messages", [])
+        await delete_messages(
+            chat_id=data.get("chat_id"),
+            messages=messages
+        )
+
+        logging.info(f"{len(messages)} messages deleted in chat {data.get('chat_id')}")
+    except Exception:
+        logging.error(traceback.format_exc())
+    return JSONResponse(
+        content={
+            "status": "ok"
+        }
+    )
@@ -0,0 +1,27 @@
+import decimal
+from .circuit_breaker import circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
+
+
+BINANCE_URL = "https://api.binance.com/api/v3"
+
+
+@retry_policy('binance')
+@circuit_breaker('binance')
+async def get_sol_usd_price():
+    url = f"{BINANCE_URL}/ticker/price"
+
+    await rate_limiter('binance').acquire()
+
+    client = get_http_client('binance')
+    response = await client.get(url, params={'symbol': 'SOLUSDT'})
+
+    response.raise_for_status()
+
+    payload = response.json()
+
+    if 'price' in payload:
+        return decimal.Decimal(payload['price'])
+    raise ValueError(f"Binance did not answer with a SOL price: {response.text[:200]}")
@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from .retry import is_transient
+
+# consecutive failures opening a circuit and seconds before a trial call is let through,
+# can be overridden per provider with CIRCUIT_<PROVIDER>_FAILURE_THRESHOLD and CIRCUIT_<PROVIDER>_RECOVERY_TIMEOUT
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RECOVERY_TIMEOUT = float(os.environ.get('CIRCUIT_RECOVERY_TIMEOUT', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a provider whose circuit is open.
+    """
+
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(f"Circuit of {provider} is open, retrying in {retry_in:.0f} seconds")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider after `failure_threshold` consecutive transient failures.
+
+    While open every call fails fast with CircuitOpenError, so callers can fall back to
+    cached data instead of waiting on the timeout. After `recovery_timeout` seconds the
+    circuit is half open and a single trial call goes through: its success closes the
+    circuit, its failure opens it again. Only timeouts, connection errors, 429 and 5xx
+    answers count as failures, a provider rejecting a request, e.g. with a 400 for an
+    illiquid token, is up and the error goes to the caller without touching the circuit.
+    """
+
+    def __init__(self, provider: str, failure_threshold: int, recovery_timeout: float):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.transitions = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        self.rejected = 0
+        self.failures = 0
+        self.successes = 0
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logging.warning(f"Circuit of {self.provider} went from {self.state} to {state}")
+        self.state = state
+        self.transitions[state] += 1
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+
+    def _before_call(self) -> bool:
+        """Returns whether the call is the half open trial call."""
+        if self.state == OPEN:
+            retry_in = self.opened_at + self.recovery_timeout - time.monotonic()
+            if retry_in > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.provider, retry_in)
+            self._transition(HALF_OPEN)
+
+        if self.state == HALF_OPEN:
+            if self._trial_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.provider, 0)
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def _on_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self._transition(CLOSED)
+
+    def _on_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self._transition(OPEN)
+
+    async def call(self, func, *args, **kwargs):
+        trial = self._before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_transient(e):
+                self._on_failure()
+            raise
+        else:
+            self._on_success()
+            return result
+        finally:
+            if trial:
+                self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'transitions': dict(self.transitions),
+            'rejected': self.rejected,
+            'failures': self.failures,
+            'successes': self.successes
+        }
+
+
+class CircuitBreakerFactory:
+    """
+    Process wide registry of circuit breakers, one per upstream provider.
+    """
+    _instances = {}
+
+    @staticmethod
+    def get_breaker(provider: str) -> CircuitBreaker:
+        if provider not in CircuitBreakerFactory._instances:
+            failure_threshold = int(os.environ.get(
+                f"CIRCUIT_{provider.upper()}_FAILURE_THRESHOLD", CIRCUIT_FAILURE_THRESHOLD
+            ))
+            recovery_timeout = float(os.environ.get(
+                f"CIRCUIT_{provider.upper()}_RECOVERY_TIMEOUT", CIRCUIT_RECOVERY_TIMEOUT
+            ))
+            CircuitBreakerFactory._instances[provider] = CircuitBreaker(provider, failure_threshold, recovery_timeout)
+
+        return CircuitBreakerFactory._instances[provider]
+
+    @staticmethod
+    def stats() -> dict:
+        return {provider: breaker.stats() for provider, breaker in CircuitBreakerFactory._instances.items()}
+
+
+def circuit_breaker(provider: str):
+    """
+    Decorates a coroutine function calling `provider` with the provider's circuit breaker.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await CircuitBreakerFactory.get_breaker(provider).call(func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,18 +1,28 @@
 import decimal
-import httpx
+from .circuit_breaker import circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
 
 
 COINBASE_URL = "https://api.coinbase.com/v2"
 
 
+@retry_policy('coinbase')
+@circuit_breaker('coinbase')
 async def get_sol_usd_price():
     url = f"{COINBASE_URL}/exchange-rates?currency=SOL"
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.get(url)
+    await rate_limiter('coinbase').acquire()
+
+    client = get_http_client('coinbase')
+    response = await client.get(url)
+
+    response.raise_for_status()
 
     payload = response.json().get("data", {})
 
     for target_currency, amount in payload.get("rates", {}).items():
         if target_currency == 'USD':
             return decimal.Decimal(amount)
+    raise ValueError(f"Coinbase did not answer with a SOL price: {response.text[:200]}")
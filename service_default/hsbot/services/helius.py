@@ -1,5 +1,13 @@
+import asyncio
+import logging
 import os
-import httpx
+from .circuit_breaker import CircuitOpenError, circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
+from .single_flight import coalesce
+from .sol_client import get_token_supply
+from .token_metadata_cache import token_metadata_cache
 
 project_id = os.environ.get('GCLOUD_PROJECT')
 
@@ -14,6 +22,8 @@ HELIUS_PARAMS = {
 }
 
 
+@retry_policy('helius.fetch_token_data')
+@circuit_breaker('helius')
 async def fetch_token_data(token_address: str):
     payload = {
         "jsonrpc": "2.0",
@@ -22,21 +32,37 @@ async def fetch_token_data(token_address: str):
         "params": {"id": token_address},
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.post(
-            HELIUS_RPC_URL,
-            json=payload,
-            headers=HEADERS,
-            params=HELIUS_PARAMS
-        )
+    await rate_limiter('helius').acquire()
+
+    client = get_http_client('helius')
+    response = await client.post(
+        HELIUS_RPC_URL,
+        json=payload,
+        headers=HEADERS,
+        params=HELIUS_PARAMS
+    )
 
     response.raise_for_status()
 
     return response.json()
 
 
+@coalesce('helius.get_token_metadata')
 async def get_token_metadata(token_address: str):
-    response_json = await fetch_token_data(token_address)
+    cached_metadata, supply_expired, _ = token_metadata_cache.lookup_many([token_address])
+    if cached_metadata:
+        return cached_metadata[token_address]
+    if supply_expired:
+        return (await refresh_tokens_supply(supply_expired))[token_address]
+
+    try:
+        response_json = await fetch_token_data(token_address)
+    except CircuitOpenError:
+        stale_metadata = token_metadata_cache.get(token_address, allow_stale=True)
+        if stale_metadata is None:
+            raise
+        logging.warning(f"Serving stale metadata of token {token_address}, Helius circuit is open")
+        return stale_metadata
 
     if 'result' in response_json:
         result = response_json['result']
@@ -44,7 +70,7 @@ async def get_token_metadata(token_address: str):
         token_metadata = result['content']['metadata']
         token_links = result['content']['links']
         symbol = token_metadata.get('symbol') or token_info.get('symbol')
-        return {
+        metadata = {
             'name': token_metadata.get('name'),
             'address': token_address,
             'icon': token_links.get('image'),
@@ -53,6 +79,8 @@ async def get_token_metadata(token_address: str):
             'symbol': symbol,
             'token_program_id': token_info.get('token_program')
         }
+        token_metadata_cache.put_many({token_address: metadata})
+        return dict(metadata)
     else:
         if 'error' in response_json and 'message' in response_json['error']:
             error_message = (f"Couldn't parse Helius getAsset response for token {token_address}. "
@@ -64,7 +92,9 @@ async def get_token_metadata(token_address: str):
         raise ValueError(error_message)
 
 
-async def get_tokens_supply(token_addresses: str):
+@retry_policy('helius.fetch_tokens_data')
+@circuit_breaker('helius')
+async def fetch_tokens_data(token_addresses: list) -> list:
     payload = {
       "jsonrpc": "2.0",
       "id": "1",
@@ -74,24 +104,30 @@ async def get_tokens_supply(token_addresses: str):
       }
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.post(
-            HELIUS_RPC_URL,
-            json=payload,
-            headers=HEADERS,
-            params=HELIUS_PARAMS
-        )
+    await rate_limiter('helius').acquire()
+
+    client = get_http_client('helius')
+    response = await client.post(
+        HELIUS_RPC_URL,
+        json=payload,
+        headers=HEADERS,
+        params=HELIUS_PARAMS
+    )
 
     response.raise_for_status()
     try:
-        response_result = response.json()['result']
+        return response.json()['result']
     except Exception as e:
-        logger.warning(f"Could not get tokens supply from Helius response"
-                       f"Response status: {response.status_code}. Response text: {response.text}"
-                       f"Exception: {e}"
-                       )
+        logging.warning(f"Could not get tokens data from Helius response"
+                        f"Response status: {response.status_code}. Response text: {response.text}"
+                        f"Exception: {e}"
+                        )
         raise e
 
+
+async def get_tokens_supply(token_addresses: str):
+    response_result = await fetch_tokens_data(token_addresses)
+
     supplies = {}
 
     for entry in response_result:
@@ -100,35 +136,53 @@ async def get_tokens_supply(token_addresses: str):
     return supplies
 
 
-async def get_tokens_metadata(token_addresses: str):
-    payload = {
-      "jsonrpc": "2.0",
-      "id": "1",
-      "method": "getAssetBatch",
-      "params": {
-        "ids": token_addresses
-      }
+async def refresh_tokens_supply(tokens_metadata: dict) -> dict:
+    """
+    Refreshes only the supply of cached tokens whose metadata is still fresh, with a
+    getTokenSupply call per token that the RPC client batches into one request.
+    A token whose supply can not be fetched keeps its cached supply.
+    """
+    supplies = await asyncio.gather(*(get_token_supply(token_address) for token_address in tokens_metadata))
+
+    refreshed_supplies = {}
+    for token_address, supply in zip(tokens_metadata, supplies):
+        if supply is not None:
+            refreshed_supplies[token_address] = int(supply.amount)
+
+    token_metadata_cache.put_supplies(refreshed_supplies)
+    return {
+        token_address: dict(metadata, supply=refreshed_supplies.get(token_address, metadata.get('supply')))
+        for token_address, metadata in tokens_metadata.items()
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.post(
-            HELIUS_RPC_URL,
-            json=payload,
-            headers=HEADERS,
-            params=HELIUS_PARAMS
-        )
 
-    response.raise_for_status()
+async def get_tokens_metadata(token_addresses: str):
+    # tokens with an expired supply only get their supply refreshed, the missing ones are requested whole
+    tokens_metadata, supply_expired, token_addresses = token_metadata_cache.lookup_many(token_addresses)
+
+    requests = []
+    if supply_expired:
+        requests.append(refresh_tokens_supply(supply_expired))
+    if token_addresses:
+        requests.append(fetch_tokens_metadata(token_addresses))
+
+    for fetched_metadata in await asyncio.gather(*requests):
+        tokens_metadata.update(fetched_metadata)
+    return tokens_metadata
+
+
+async def fetch_tokens_metadata(token_addresses: list) -> dict:
     try:
-        response_result = response.json()['result']
-    except Exception as e:
-        logger.warning(f"Could not get tokens supply from Helius response"
-                       f"Response status: {response.status_code}. Response text: {response.text}"
-                       f"Exception: {e}"
-                       )
-        raise e
+        response_result = await fetch_tokens_data(token_addresses)
+    except CircuitOpenError:
+        # degraded mode, expired metadata is better than none
+        stale_metadata, missing = token_metadata_cache.get_many(token_addresses, allow_stale=True)
+        if missing:
+            raise
+        logging.warning(f"Serving stale metadata of {len(stale_metadata)} tokens, Helius circuit is open")
+        return stale_metadata
 
-    tokens_metadata = {}
+    fetched_metadata = {}
 
     for entry in response_result:
         token_info = entry['token_info']
@@ -144,6 +198,7 @@ async def get_tokens_metadata(token_addresses: str):
             'symbol': symbol,
             'token_program_id': token_info.get('token_program')
         }
-        tokens_metadata[entry['id']] = metadata
+        fetched_metadata[entry['id']] = metadata
 
-    return tokens_metadata
+    token_metadata_cache.put_many(fetched_metadata)
+    return {address: dict(metadata) for address, metadata in fetched_metadata.items()}
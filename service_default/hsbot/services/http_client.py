@@ -0,0 +1,91 @@
+import logging
+import os
+import httpx
+
+# HTTP/2 needs the optional `h2` package (httpx[http2]), without it clients fall back to HTTP/1.1
+HTTP2_ENABLED = os.environ.get('HTTP2_ENABLED', 'false').lower() == 'true'
+
+# default pool and timeout settings, each can be overridden per provider with
+# HTTP_<PROVIDER>_TIMEOUT, HTTP_<PROVIDER>_CONNECT_TIMEOUT, HTTP_<PROVIDER>_MAX_CONNECTIONS,
+# HTTP_<PROVIDER>_MAX_KEEPALIVE and HTTP_<PROVIDER>_KEEPALIVE_EXPIRY
+DEFAULT_CONFIG = {
+    'timeout': 10.0,
+    'connect_timeout': 5.0,
+    'max_connections': 20,
+    'max_keepalive': 10,
+    'keepalive_expiry': 30.0,
+}
+
+PROVIDER_CONFIG = {
+    'helius': {'max_connections': 30, 'max_keepalive': 15},
+    'shyft': {'timeout': 15.0},
+    'jupiter': {'max_connections': 30, 'max_keepalive': 15},
+    'coinbase': {'max_connections': 5, 'max_keepalive': 2},
+    'binance': {'max_connections': 5, 'max_keepalive': 2},
+    'kraken': {'max_connections': 5, 'max_keepalive': 2},
+    'meteora': {'max_connections': 10, 'max_keepalive': 5},
+}
+
+
+def _http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logging.warning("HTTP2_ENABLED is set but the h2 package is missing, using HTTP/1.1")
+        return False
+    return True
+
+
+def provider_config(provider: str) -> dict:
+    config = dict(DEFAULT_CONFIG, **PROVIDER_CONFIG.get(provider, {}))
+    for name, default in config.items():
+        value = os.environ.get(f"HTTP_{provider.upper()}_{name.upper()}")
+        if value is not None:
+            config[name] = type(default)(value)
+    return config
+
+
+class HttpClientFactory:
+    """
+    Process wide registry of httpx clients, one keep-alive connection pool per upstream
+    provider, so requests reuse connections instead of paying a new TCP and TLS handshake.
+    """
+    _instances = {}
+    _http2 = None
+
+    @staticmethod
+    def get_client(provider: str) -> httpx.AsyncClient:
+        client = HttpClientFactory._instances.get(provider)
+        if client is None or client.is_closed:
+            if HttpClientFactory._http2 is None:
+                HttpClientFactory._http2 = _http2_available()
+
+            config = provider_config(provider)
+            client = httpx.AsyncClient(
+                http2=HttpClientFactory._http2,
+                timeout=httpx.Timeout(config['timeout'], connect=config['connect_timeout']),
+                limits=httpx.Limits(
+                    max_connections=config['max_connections'],
+                    max_keepalive_connections=config['max_keepalive'],
+                    keepalive_expiry=config['keepalive_expiry']
+                )
+            )
+            HttpClientFactory._instances[provider] = client
+
+        return client
+
+    @staticmethod
+    async def close_all():
+        clients = list(HttpClientFactory._instances.values())
+        HttpClientFactory._instances.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception:
+                logging.exception("Could not close http client")
+
+
+def get_http_client(provider: str) -> httpx.AsyncClient:
+    return HttpClientFactory.get_client(provider)
@@ -1,21 +1,141 @@
+import asyncio
+import copy
+import decimal
+import logging
+import os
+import time
+from collections import OrderedDict
 from enum import Enum
-import httpx
+from .circuit_breaker import CircuitOpenError, circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
+from .single_flight import coalesce
 
 JUPITER_API_BASE_URL = "https://api.jup.ag/swap/v1"
+JUPITER_PRICE_API_URL = "https://api.jup.ag/price/v2"
 SOL_NATIVE_ADDRESS = "So11111111111111111111111111111111111111112"
 
 HEADERS = {
         "Content-Type": "application/json"
 }
 
+# seconds a quote is reused for the same swap, short as the token card shows it as the current price
+JUPITER_QUOTE_TTL = float(os.environ.get('JUPITER_QUOTE_TTL', 5))
+# quotes up to this old are served while the Jupiter circuit is open,
+# and to a buy button pressed on a token card rendered since
+JUPITER_QUOTE_STALE_TTL = float(os.environ.get('JUPITER_QUOTE_STALE_TTL', 60))
+JUPITER_QUOTE_CACHE_SIZE = int(os.environ.get('JUPITER_QUOTE_CACHE_SIZE', 1000))
+
 
 class SwapType(Enum):
     BUY_TOKEN = 1
     SELL_TOKEN = 2
 
 
+class QuoteCache:
+    """
+    Short lived cache of Jupiter quotes keyed by
+    (swap type, mint, amount, slippage, platform fee, max accounts).
+    """
+
+    def __init__(self, ttl: float = JUPITER_QUOTE_TTL, stale_ttl: float = JUPITER_QUOTE_STALE_TTL,
+                 max_entries: int = JUPITER_QUOTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, allow_stale: bool = False) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > (self.stale_ttl if allow_stale else self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def put(self, key: tuple, quote: dict):
+        self._entries[key] = (time.monotonic(), copy.deepcopy(quote))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key: tuple) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and time.monotonic() - entry[0] <= self.ttl
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+jupiter_quote_cache = QuoteCache()
+
+
+def _quote_key(swap_type, mint_address: str, mint_amount: int, slippage_bps: int,
+               platform_fee_bps: int = 100, max_accounts: int = 50) -> tuple:
+    return SwapType(swap_type), mint_address, int(mint_amount), int(slippage_bps), platform_fee_bps, max_accounts
+
+
 async def get_jupiter_quote(swap_type: SwapType, mint_address: str, mint_amount: int, slippage_bps: int,
                             platform_fee_bps: int = 100, max_accounts: int = 50) -> dict:
+    key = _quote_key(swap_type, mint_address, mint_amount, slippage_bps, platform_fee_bps, max_accounts)
+
+    quote = jupiter_quote_cache.get(key)
+    if quote is None:
+        try:
+            quote = await request_jupiter_quote(*key)
+        except CircuitOpenError:
+            # degraded mode, a recent quote is still good enough to display
+            quote = jupiter_quote_cache.get(key, allow_stale=True)
+            if quote is None:
+                raise
+            logging.warning(f"Serving stale Jupiter quote for {key[1]}, Jupiter circuit is open")
+            return quote
+        jupiter_quote_cache.put(key, quote)
+    return quote
+
+
+def prefetch_jupiter_quotes(*quote_requests: dict):
+    """
+    Warms the quote cache in the background, each request holds the keyword arguments of
+    `get_jupiter_quote`. Quotes already cached are not requested again.
+    """
+    for quote_request in quote_requests:
+        if _quote_key(**quote_request) in jupiter_quote_cache:
+            continue
+        task = asyncio.ensure_future(get_jupiter_quote(**quote_request))
+        task.add_done_callback(_log_prefetch_failure)
+
+
+def cached_jupiter_quote(**quote_request) -> dict | None:
+    """
+    The quote of `quote_request` from the cache, without waiting on Jupiter: for a button
+    pressed on a token card, whose quotes were prefetched up to JUPITER_QUOTE_STALE_TTL
+    seconds ago. On a miss the quote is prefetched for the next press and None is returned.
+    """
+    quote = jupiter_quote_cache.get(_quote_key(**quote_request), allow_stale=True)
+    if quote is None:
+        prefetch_jupiter_quotes(quote_request)
+    return quote
+
+
+def _log_prefetch_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Jupiter quote prefetch failed: {task.exception()}")
+
+
+@coalesce('jupiter.request_jupiter_quote')
+@retry_policy('jupiter.request_jupiter_quote')
+@circuit_breaker('jupiter')
+async def request_jupiter_quote(swap_type: SwapType, mint_address: str, mint_amount: int, slippage_bps: int,
+                                platform_fee_bps: int = 100, max_accounts: int = 50) -> dict:
+    swap_type = SwapType(swap_type)
 
     if swap_type == SwapType.BUY_TOKEN:
         input_mint = SOL_NATIVE_ADDRESS
@@ -40,18 +160,23 @@ async def get_jupiter_quote(swap_type: SwapType, mint_address: str, mint_amount:
             }
         )
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.get(
-            f"{JUPITER_API_BASE_URL}/quote",
-            headers=HEADERS,
-            params=params
-        )
+    await rate_limiter('jupiter').acquire()
+
+    client = get_http_client('jupiter')
+    response = await client.get(
+        f"{JUPITER_API_BASE_URL}/quote",
+        headers=HEADERS,
+        params=params
+    )
 
     response.raise_for_status()
 
     return response.json()
 
 
+# building a swap is never retried blindly, the user retries it from the bot
+@retry_policy('jupiter.jupiter_swap', idempotent=False)
+@circuit_breaker('jupiter')
 async def jupiter_swap(jupiter_quote: dict, wallet_address: str, swap_priority_fees: int,
                        fees_account_address: str = None) -> dict:
 
@@ -69,14 +194,36 @@ async def jupiter_swap(jupiter_quote: dict, wallet_address: str, swap_priority_f
             }
         )
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.post(
-            f"{JUPITER_API_BASE_URL}/swap",
-            json=payload,
-            headers=HEADERS
-        )
+    await rate_limiter('jupiter').acquire()
+
+    client = get_http_client('jupiter')
+    response = await client.post(
+        f"{JUPITER_API_BASE_URL}/swap",
+        json=payload,
+        headers=HEADERS
+    )
 
     response.raise_for_status()
 
     return response.json()
 
+
+@retry_policy('jupiter_price')
+@circuit_breaker('jupiter_price')
+async def get_sol_usd_price():
+    await rate_limiter('jupiter').acquire()
+
+    client = get_http_client('jupiter')
+    response = await client.get(
+        JUPITER_PRICE_API_URL,
+        headers=HEADERS,
+        params={'ids': SOL_NATIVE_ADDRESS}
+    )
+
+    response.raise_for_status()
+
+    price_data = (response.json().get('data') or {}).get(SOL_NATIVE_ADDRESS)
+
+    if price_data and price_data.get('price'):
+        return decimal.Decimal(price_data['price'])
+    raise ValueError(f"Jupiter did not answer with a SOL price: {response.text[:200]}")
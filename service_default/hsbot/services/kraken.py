@@ -0,0 +1,28 @@
+import decimal
+from .circuit_breaker import circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
+
+
+KRAKEN_URL = "https://api.kraken.com/0/public"
+
+
+@retry_policy('kraken')
+@circuit_breaker('kraken')
+async def get_sol_usd_price():
+    url = f"{KRAKEN_URL}/Ticker"
+
+    await rate_limiter('kraken').acquire()
+
+    client = get_http_client('kraken')
+    response = await client.get(url, params={'pair': 'SOLUSD'})
+
+    response.raise_for_status()
+
+    payload = response.json()
+
+    for pair, ticker in payload.get("result", {}).items():
+        # last trade closed [price, lot volume]
+        return decimal.Decimal(ticker['c'][0])
+    raise ValueError(f"Kraken did not answer with a SOL price: {response.text[:200]}")
@@ -1,6 +1,9 @@
-import httpx
-import threading
-import time
+import decimal
+import struct
+from .circuit_breaker import circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
 
 API_URL = "https://dlmm-api.meteora.ag/"
 
@@ -8,50 +11,49 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-
-class RateLimiter:
-    def __init__(self, rate_limit: int, period: float):
-        self.rate_limit = rate_limit
-        self.period = period
-        self.lock = threading.Lock()
-        self.tokens = rate_limit
-        self.last_check = time.time()
-
-    def acquire(self):
-        """Wait until a request can be made within rate limits."""
-        with self.lock:
-            now = time.time()
-            elapsed = now - self.last_check
-
-            # Refill tokens based on elapsed time
-            if elapsed >= self.period:
-                self.tokens = self.rate_limit
-                self.last_check = now
-
-            # If no tokens are available, wait for next slot
-            if self.tokens == 0:
-                sleep_time = self.period - elapsed
-                if sleep_time > 0:
-                    logger.info(f"Rate limiting request, sleeping for {sleep_time} seconds")
-                    time.sleep(sleep_time)
-                self.tokens = self.rate_limit
-                self.last_check = time.time()
-
-            # Consume a token
-            self.tokens -= 1
-
-
-rate_limiter = RateLimiter(rate_limit=5, period=1)
-
-
+# LbPair account layout: 8 byte anchor discriminator, StaticParameters (32 bytes),
+# VariableParameters (32 bytes), bump_seed, bin_step_seed[2], pair_type, active_id i32, bin_step u16
+LB_PAIR_DISCRIMINATOR = bytes.fromhex('210b3162b565b10d')
+LB_PAIR_ACTIVE_ID_LAYOUT = struct.Struct('<iH')
+LB_PAIR_ACTIVE_ID_OFFSET = 76
+# leading bytes of an LbPair account holding everything the price is decoded from
+LB_PAIR_PRICE_DATA_LENGTH = LB_PAIR_ACTIVE_ID_OFFSET + LB_PAIR_ACTIVE_ID_LAYOUT.size
+BASIS_POINT_MAX = 10000
+
+
+def decode_lb_pair_active_bin(data: bytes) -> tuple | None:
+    """
+    Returns (active_id, bin_step) of a raw LbPair account, None if `data` is not an LbPair.
+    """
+    if len(data) < LB_PAIR_PRICE_DATA_LENGTH or data[:8] != LB_PAIR_DISCRIMINATOR:
+        return None
+    return LB_PAIR_ACTIVE_ID_LAYOUT.unpack_from(data, LB_PAIR_ACTIVE_ID_OFFSET)
+
+
+def get_lb_pair_price(data: bytes, token_x_decimals: int, token_y_decimals: int) -> decimal.Decimal | None:
+    """
+    Price of token X in token Y at the active bin of a raw LbPair account:
+    (1 + bin_step / 10000) ^ active_id, scaled from smallest units by the decimals of both tokens.
+    """
+    active_bin = decode_lb_pair_active_bin(data)
+    if active_bin is None:
+        return None
+
+    active_id, bin_step = active_bin
+    bin_price = (1 + decimal.Decimal(bin_step) / BASIS_POINT_MAX) ** active_id
+    return bin_price * decimal.Decimal(10) ** (token_x_decimals - token_y_decimals)
+
+
+@retry_policy('meteora')
+@circuit_breaker('meteora')
 async def get_meteora_dlmm_pair_address_price(pair_address: str):
-    rate_limiter.acquire()
+    await rate_limiter('meteora').acquire()
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.get(
-            f"{API_URL}pair/{pair_address}",
-            headers=HEADERS
-        )
+    client = get_http_client('meteora')
+    response = await client.get(
+        f"{API_URL}pair/{pair_address}",
+        headers=HEADERS
+    )
 
     response.raise_for_status()
 
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+import decimal
+import logging
+import os
+import time
+from . import binance, coinbase, jupiter, kraken
+
+# seconds between background refreshes
+SOL_PRICE_REFRESH_INTERVAL = float(os.environ.get('SOL_PRICE_REFRESH_INTERVAL', 15))
+# a price older than this is served as is while a refresh runs in the background
+SOL_PRICE_STALE_AFTER = float(os.environ.get('SOL_PRICE_STALE_AFTER', 30))
+# a price older than this is not served anymore unless every source fails
+SOL_PRICE_MAX_AGE = float(os.environ.get('SOL_PRICE_MAX_AGE', 300))
+SOL_PRICE_SOURCE_TIMEOUT = float(os.environ.get('SOL_PRICE_SOURCE_TIMEOUT', 3))
+
+# tried in order until one of them answers
+PRICE_SOURCES = (
+    ('coinbase', coinbase.get_sol_usd_price),
+    ('jupiter', jupiter.get_sol_usd_price),
+    ('binance', binance.get_sol_usd_price),
+    ('kraken', kraken.get_sol_usd_price),
+)
+
+
+class SolPriceOracle:
+    """
+    In-process SOL/USD price kept fresh by a background task.
+
+    Handlers read the last known price without touching the network: a price older than
+    `stale_after` is still returned but triggers a refresh in the background, only a
+    missing price or one older than `max_age` makes the caller wait for the refresh.
+    Every refresh walks `sources` in order and keeps the first price it gets.
+    """
+
+    def __init__(self, sources=PRICE_SOURCES, refresh_interval: float = SOL_PRICE_REFRESH_INTERVAL,
+                 stale_after: float = SOL_PRICE_STALE_AFTER, max_age: float = SOL_PRICE_MAX_AGE,
+                 source_timeout: float = SOL_PRICE_SOURCE_TIMEOUT):
+        self.sources = sources
+        self.refresh_interval = refresh_interval
+        self.stale_after = stale_after
+        self.max_age = max_age
+        self.source_timeout = source_timeout
+        self.price = None
+        self.source = None
+        self.updated_at = 0.0
+        self._refresh_task = None
+        self._refresher = None
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.updated_at if self.price is not None else float('inf')
+
+    async def get_price(self) -> decimal.Decimal:
+        self.start()
+
+        age = self.age
+        if age <= self.stale_after:
+            return self.price
+
+        if age <= self.max_age:
+            self._refresh_in_background()
+            return self.price
+
+        try:
+            return await self.refresh()
+        except Exception:
+            if self.price is None:
+                raise
+            logging.warning(f"Serving a SOL price {age:.0f} seconds old, every price source failed")
+            return self.price
+
+    @staticmethod
+    def _spawn(coro) -> asyncio.Task:
+        # refreshes are shared and outlive the request starting them, so they run without its deadline
+        return asyncio.get_running_loop().create_task(coro, context=contextvars.Context())
+
+    def _refresh_in_background(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = self._spawn(self._fetch())
+            self._refresh_task.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"SOL price refresh failed: {task.exception()}")
+
+    async def refresh(self) -> decimal.Decimal:
+        """Fetches the price now, sharing the refresh already in flight if there is one."""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = self._spawn(self._fetch())
+        return await asyncio.shield(self._refresh_task)
+
+    async def _fetch(self) -> decimal.Decimal:
+        errors = []
+        for name, fetch_price in self.sources:
+            try:
+                price = await asyncio.wait_for(fetch_price(), timeout=self.source_timeout)
+            except Exception as e:
+                errors.append(f"{name}: {e!r}")
+                continue
+
+            if price:
+                self.price = decimal.Decimal(price)
+                self.source = name
+                self.updated_at = time.monotonic()
+                return self.price
+            errors.append(f"{name}: no price")
+
+        raise ValueError(f"Could not get the SOL price from any source ({', '.join(errors)})")
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"SOL price refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """Starts the background refresh on the running loop, if it is not running already."""
+        if self._refresher is None or self._refresher.done():
+            self._refresher = self._spawn(self._refresh_forever())
+
+    async def stop(self):
+        for task in (self._refresher, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._refresher = None
+        self._refresh_task = None
+
+    def stats(self) -> dict:
+        return {
+            'price': self.price,
+            'source': self.source,
+            'age': self.age
+        }
+
+
+sol_price_oracle = SolPriceOracle()
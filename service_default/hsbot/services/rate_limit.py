@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import os
+import time
+
+# requests per second and burst size of every upstream, can be overridden with
+# RATE_LIMIT_<PROVIDER>_RATE and RATE_LIMIT_<PROVIDER>_BURST
+PROVIDER_BUDGETS = {
+    'meteora': {'rate': 5.0, 'burst': 5},
+    'helius': {'rate': 10.0, 'burst': 10},
+    'shyft': {'rate': 5.0, 'burst': 5},
+    'jupiter': {'rate': 10.0, 'burst': 10},
+    'coinbase': {'rate': 5.0, 'burst': 5},
+    'binance': {'rate': 5.0, 'burst': 5},
+    'kraken': {'rate': 1.0, 'burst': 2},
+    'solana_rpc': {'rate': 20.0, 'burst': 20},
+}
+DEFAULT_BUDGET = {'rate': 5.0, 'burst': 5}
+
+# waits longer than this (seconds) are logged
+RATE_LIMIT_SLOW_WAIT = float(os.environ.get('RATE_LIMIT_SLOW_WAIT', 1))
+
+
+class AsyncRateLimiter:
+    """
+    Token bucket holding up to `burst` tokens, refilled at `rate` tokens per second.
+
+    Waiters sleep on the event loop instead of blocking it and are served in arrival
+    order, the asyncio.Lock hands itself over first come first served, so a burst of
+    requests can not starve an earlier one. Budgets are per process.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waiting = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Wait until a request can be made within the budget."""
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                self._refill()
+                if self._tokens < 1:
+                    self.throttled += 1
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+                    self._refill()
+                self._tokens -= 1
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > RATE_LIMIT_SLOW_WAIT:
+            logging.info(f"Rate limited {self.name} request for {waited:.2f} seconds, {self.waiting} still waiting")
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.waiting,
+            'acquired': self.acquired,
+            'throttled': self.throttled,
+            'avg_wait': self.total_wait / self.acquired if self.acquired else 0.0,
+            'max_wait': self.max_wait
+        }
+
+
+class RateLimiterFactory:
+    """
+    Process wide registry of rate limiters, one budget per upstream provider.
+    """
+    _instances = {}
+
+    @staticmethod
+    def get_limiter(provider: str) -> AsyncRateLimiter:
+        if provider not in RateLimiterFactory._instances:
+            budget = PROVIDER_BUDGETS.get(provider, DEFAULT_BUDGET)
+            rate = float(os.environ.get(f"RATE_LIMIT_{provider.upper()}_RATE", budget['rate']))
+            burst = int(os.environ.get(f"RATE_LIMIT_{provider.upper()}_BURST", budget['burst']))
+            RateLimiterFactory._instances[provider] = AsyncRateLimiter(provider, rate, burst)
+
+        return RateLimiterFactory._instances[provider]
+
+    @staticmethod
+    def stats() -> dict:
+        return {provider: limiter.stats() for provider, limiter in RateLimiterFactory._instances.items()}
+
+
+def rate_limiter(provider: str) -> AsyncRateLimiter:
+    return RateLimiterFactory.get_limiter(provider)
@@ -0,0 +1,212 @@
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import functools
+import logging
+import os
+import random
+import time
+import httpx
+from retry_reloaded import ExponentialBackOff
+
+# attempts per call including the first one, and the bounds of the backoff between them,
+# can be overridden per policy with RETRY_<NAME>_ATTEMPTS, RETRY_<NAME>_BASE_DELAY and RETRY_<NAME>_MAX_DELAY
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.2))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 2))
+# seconds a webhook or worker request may spend on upstream calls, below the Telegram and App Engine budgets
+REQUEST_DEADLINE_SECONDS = float(os.environ.get('REQUEST_DEADLINE_SECONDS', 20))
+
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    """
+    Raised instead of calling or retrying an upstream once the request deadline has passed.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"Request deadline exceeded before calling {name}")
+        self.name = name
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: float = REQUEST_DEADLINE_SECONDS):
+    """
+    Bounds the upstream calls made within the block, tasks started in it inherit the deadline.
+    A deadline already set by an outer block is never extended.
+    """
+    deadline = time.monotonic() + seconds
+    outer_deadline = _deadline.get()
+    if outer_deadline is not None:
+        deadline = min(deadline, outer_deadline)
+
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_budget() -> float | None:
+    """Seconds left before the request deadline, None outside of a request."""
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error: Exception) -> bool:
+    """Timeouts, connection errors, 429 and 5xx answers are worth another try, anything else is not."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+class RetryPolicy:
+    """
+    Retries transient upstream failures with full jitter exponential backoff.
+
+    Each delay is drawn uniformly between 0 and the exponential backoff of the attempt, so
+    callers failing together do not retry together, and a Retry-After header is honoured
+    when the upstream sends one. Within a request deadline every attempt is cut at the
+    remaining budget and no retry is made when its delay would not leave time for it.
+    Non idempotent calls are attempted once.
+    """
+
+    def __init__(self, name: str, attempts: int, base_delay: float, max_delay: float, idempotent: bool = True):
+        self.name = name
+        self.attempts = attempts if idempotent else 1
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idempotent = idempotent
+        self.calls = 0
+        self.retries = 0
+        self.recovered = 0
+        self.exhausted = 0
+        self.deadline_exceeded = 0
+
+    def _backoff(self) -> ExponentialBackOff:
+        return ExponentialBackOff(base_delay=self.base_delay, max=self.max_delay)
+
+    def _delay(self, backoff: ExponentialBackOff, error: Exception) -> float:
+        delay = random.uniform(0, backoff.delay)
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = _retry_after(error.response)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
+
+    async def _attempt(self, func, args: tuple, kwargs: dict):
+        budget = remaining_budget()
+        if budget is None:
+            return await func(*args, **kwargs)
+        if budget <= 0:
+            self.deadline_exceeded += 1
+            raise DeadlineExceededError(self.name)
+        try:
+            return await asyncio.wait_for(func(*args, **kwargs), timeout=budget)
+        except TimeoutError:
+            if remaining_budget() > 0:
+                raise
+            self.deadline_exceeded += 1
+            raise DeadlineExceededError(self.name)
+
+    async def call(self, func, *args, **kwargs):
+        self.calls += 1
+        backoff = self._backoff()
+        attempt = 1
+        while True:
+            try:
+                result = await self._attempt(func, args, kwargs)
+            except Exception as e:
+                if attempt >= self.attempts or not is_transient(e):
+                    if attempt > 1:
+                        self.exhausted += 1
+                    raise
+
+                delay = self._delay(backoff, e)
+                budget = remaining_budget()
+                if budget is not None and delay >= budget:
+                    self.exhausted += 1
+                    logging.warning(f"Not retrying {self.name}, {budget:.2f} seconds left of the request deadline: {e!r}")
+                    raise
+
+                logging.info(f"Retrying {self.name} in {delay:.2f} seconds after attempt {attempt}: {e!r}")
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                if attempt > 1:
+                    self.recovered += 1
+                return result
+
+    def stats(self) -> dict:
+        return {
+            'idempotent': self.idempotent,
+            'calls': self.calls,
+            'retries': self.retries,
+            'recovered': self.recovered,
+            'exhausted': self.exhausted,
+            'deadline_exceeded': self.deadline_exceeded
+        }
+
+
+class RetryPolicyFactory:
+    """
+    Process wide registry of retry policies, one per decorated upstream call.
+    """
+    _instances = {}
+
+    @staticmethod
+    def get_policy(name: str, idempotent: bool = True) -> RetryPolicy:
+        if name not in RetryPolicyFactory._instances:
+            env_name = name.upper().replace('.', '_')
+            attempts = int(os.environ.get(f"RETRY_{env_name}_ATTEMPTS", RETRY_ATTEMPTS))
+            base_delay = float(os.environ.get(f"RETRY_{env_name}_BASE_DELAY", RETRY_BASE_DELAY))
+            max_delay = float(os.environ.get(f"RETRY_{env_name}_MAX_DELAY", RETRY_MAX_DELAY))
+            RetryPolicyFactory._instances[name] = RetryPolicy(name, attempts, base_delay, max_delay, idempotent)
+
+        return RetryPolicyFactory._instances[name]
+
+    @staticmethod
+    def stats() -> dict:
+        return {name: policy.stats() for name, policy in RetryPolicyFactory._instances.items()}
+
+
+def retry_policy(name: str, idempotent: bool = True):
+    """
+    Decorates a coroutine function calling an upstream with the retry policy `name`.
+
+    Put it above `circuit_breaker` so every attempt counts towards the breaker, once the
+    circuit opens the CircuitOpenError is not transient and ends the retries. Calls with
+    side effects, such as building a swap, must pass idempotent=False.
+    """
+    def decorator(func):
+        policy = RetryPolicyFactory.get_policy(name, idempotent)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await policy.call(func, *args, **kwargs)
+
+        wrapper.retry_policy = policy
+        return wrapper
+
+    return decorator
@@ -1,12 +1,19 @@
+import asyncio
 import decimal
 import logging
+import time
+from collections import OrderedDict
 from typing import Dict, List
-import httpx
+from .circuit_breaker import circuit_breaker
+from .http_client import get_http_client
+from .rate_limit import rate_limiter
+from .retry import retry_policy
+from .single_flight import coalesce
 import os
 from enum import Enum
 from datetime import datetime, timedelta, UTC
-from .meteora_dlmm import get_meteora_dlmm_pair_address_price
-from .sol_client import get_accounts_in_concurrent_batches
+from .meteora_dlmm import LB_PAIR_PRICE_DATA_LENGTH, get_meteora_dlmm_pair_address_price, get_lb_pair_price
+from .sol_client import get_accounts_in_concurrent_batches, get_raw_accounts_in_concurrent_batches
 
 
 SHYFT_API_KEY = os.environ.get('SHYFT_API_KEY')
@@ -21,6 +28,17 @@ SHYFT_PARAMS = {
     'api_key': SHYFT_API_KEY
 }
 
+# seconds a token's pools are served from the registry before an incremental refresh
+POOL_REGISTRY_TTL = int(os.environ.get('POOL_REGISTRY_TTL', 60))
+# pools not updated for this long are dropped, the original 24h `_updatedAt` window
+POOL_REGISTRY_MAX_AGE = int(os.environ.get('POOL_REGISTRY_MAX_AGE', 60 * 60 * 24))
+POOL_REGISTRY_OVERLAP = int(os.environ.get('POOL_REGISTRY_OVERLAP', 60))
+POOL_REGISTRY_SIZE = int(os.environ.get('POOL_REGISTRY_SIZE', 5000))
+# Meteora DLMM price requests in flight at once while ranking pools
+DLMM_PRICE_CONCURRENCY = int(os.environ.get('DLMM_PRICE_CONCURRENCY', 5))
+# price through the Meteora API the DLMM pools whose LbPair account could not be decoded
+DLMM_PRICE_API_FALLBACK = os.environ.get('DLMM_PRICE_API_FALLBACK', 'true').lower() == 'true'
+
 
 class Protocols(Enum):
     RAYDIUM_V4 = "Raydium_V4"
@@ -30,13 +48,22 @@ class Protocols(Enum):
     METEORA_DLMM = "Meteora_DLMM"
 
 
-async def get_pools_by_token(tokens: str | List[str]) -> Dict[str, List[Dict]]:
-
-    pool_last_updated_at = (datetime.now(tz=UTC) - timedelta(seconds=60 * 60 * 24)).isoformat()
+# same order the query response is parsed in, more dominant protocols first
+PROTOCOLS_BY_DOMINANCE = (
+    Protocols.RAYDIUM_V4,
+    Protocols.WHIRLPOOL,
+    Protocols.RAYDIUM_CLMM,
+    Protocols.METEORA_DLMM,
+    Protocols.METEORA_AMM,
+)
 
-    if isinstance(tokens, str):
-        tokens = [tokens]
 
+@retry_policy('shyft')
+@circuit_breaker('shyft')
+async def query_pools_by_token(tokens: List[str], pool_last_updated_at: str) -> Dict[str, List[Dict]]:
+    """
+    Asks Shyft for the SOL pools of `tokens` updated after `pool_last_updated_at` (iso format).
+    """
     query = """
         query MyCombinedQuery(
             $raydium_v4_where: Raydium_LiquidityPoolv4_bool_exp,
@@ -175,13 +202,17 @@ async def get_pools_by_token(tokens: str | List[str]) -> Dict[str, List[Dict]]:
         }
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        response = await client.post(
-            SHYFT_GRAPHQL_URL,
-            json={"query": query, "variables": variables},
-            headers=HEADERS,
-            params=SHYFT_PARAMS
-        )
+    await rate_limiter('shyft').acquire()
+
+    client = get_http_client('shyft')
+    response = await client.post(
+        SHYFT_GRAPHQL_URL,
+        json={"query": query, "variables": variables},
+        headers=HEADERS,
+        params=SHYFT_PARAMS
+    )
+
+    response.raise_for_status()
 
     data = response.json()['data']
 
@@ -221,6 +252,196 @@ async def get_pools_by_token(tokens: str | List[str]) -> Dict[str, List[Dict]]:
     return pools_by_token
 
 
+class PoolRegistry:
+    """
+    Caches the pools discovered per token so most lookups skip the Shyft query.
+
+    A token's pools are served from the registry for `ttl` seconds. Once due, the
+    token is refreshed incrementally: only pools updated since its last successful
+    fetch are requested, minus `overlap` seconds for indexing lag and clock skew.
+    As with the original 24h `_updatedAt` window, pools not returned for `max_age`
+    seconds are dropped. Cached CLMM/Whirlpool `sqrt_price` values are as old as
+    the last fetch that returned the pool, which is why `ttl` is short.
+    If an incremental refresh fails, the cached pools are served.
+    """
+
+    def __init__(self, ttl: int = POOL_REGISTRY_TTL, max_age: int = POOL_REGISTRY_MAX_AGE,
+                 overlap: int = POOL_REGISTRY_OVERLAP, max_entries: int = POOL_REGISTRY_SIZE):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.overlap = overlap
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.full_fetches = 0
+        self.incremental_fetches = 0
+
+    def _store(self, tokens: List[str], pools_by_token: Dict[str, List[Dict]], synced_at: datetime):
+        now = time.monotonic()
+        for token in tokens:
+            entry = self._entries.get(token)
+            if entry is None:
+                entry = self._entries[token] = {'pools': {}}
+            for pool in pools_by_token.get(token, []):
+                entry['pools'][pool['pub_key']] = {'pool': pool, 'seen_at': now}
+            entry['pools'] = {
+                pub_key: seen_pool for pub_key, seen_pool in entry['pools'].items()
+                if now - seen_pool['seen_at'] <= self.max_age
+            }
+            entry['fetched_at'] = now
+            entry['synced_at'] = synced_at
+            self._entries.move_to_end(token)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, tokens: List[str], updated_after: datetime, incremental: bool):
+        synced_at = datetime.now(tz=UTC)
+        try:
+            pools_by_token = await query_pools_by_token(tokens, updated_after.isoformat())
+        except Exception:
+            if not incremental:
+                raise
+            logging.exception(f"Incremental pool refresh failed, serving cached pools for {len(tokens)} tokens")
+            return
+
+        self._store(tokens, pools_by_token, synced_at)
+
+    async def get_pools(self, tokens: List[str]) -> Dict[str, List[Dict]]:
+        now = time.monotonic()
+        missing = []
+        due = []
+        for token in dict.fromkeys(tokens):
+            entry = self._entries.get(token)
+            if entry is None or now - entry['fetched_at'] > self.max_age:
+                missing.append(token)
+            elif now - entry['fetched_at'] > self.ttl:
+                due.append(token)
+            else:
+                self.hits += 1
+
+        fetches = []
+        if missing:
+            self.full_fetches += 1
+            window_start = datetime.now(tz=UTC) - timedelta(seconds=self.max_age)
+            fetches.append(self._fetch(missing, window_start, incremental=False))
+        if due:
+            self.incremental_fetches += 1
+            synced_at = min(self._entries[token]['synced_at'] for token in due)
+            fetches.append(self._fetch(due, synced_at - timedelta(seconds=self.overlap), incremental=True))
+        if fetches:
+            await asyncio.gather(*fetches)
+
+        protocol_order = {protocol.value: index for index, protocol in enumerate(PROTOCOLS_BY_DOMINANCE)}
+        pools_by_token = {}
+        for token in tokens:
+            entry = self._entries.get(token, {'pools': {}})
+            pools = [seen_pool['pool'] for seen_pool in entry['pools'].values()]
+            pools.sort(key=lambda pool: protocol_order[pool['protocol']])
+            pools_by_token[token] = [dict(pool) for pool in pools]
+        return pools_by_token
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'full_fetches': self.full_fetches,
+            'incremental_fetches': self.incremental_fetches
+        }
+
+
+pool_registry = PoolRegistry()
+
+
+@coalesce(
+    'shyft.get_pools_by_token',
+    key=lambda tokens: (tokens,) if isinstance(tokens, str) else tuple(sorted(tokens))
+)
+async def get_pools_by_token(tokens: str | List[str]) -> Dict[str, List[Dict]]:
+    if isinstance(tokens, str):
+        tokens = [tokens]
+
+    return await pool_registry.get_pools(tokens)
+
+
+def _dlmm_token_price(pool: Dict, lb_pair_data: bytes, token_decimals: int) -> decimal.Decimal | None:
+    """
+    Token price in SOL of a DLMM pool from its raw LbPair account, which prices token X in token Y.
+    """
+    if pool['base_mint'] == SOL_NATIVE_ADDRESS:
+        sol_price = get_lb_pair_price(lb_pair_data, token_x_decimals=9, token_y_decimals=token_decimals)
+        return 1 / sol_price if sol_price else None
+    return get_lb_pair_price(lb_pair_data, token_x_decimals=token_decimals, token_y_decimals=9)
+
+
+async def resolve_dlmm_prices(pools_by_token: Dict[str, List[Dict]], accounts_response: list,
+                              accounts_token_offsets: Dict[str, int], lb_pairs: Dict[str, object]) -> Dict[str, object]:
+    """
+    Token prices in SOL of the Meteora DLMM pools that could end up as a token's dominant pool,
+    keyed by pool address. Prices are decoded from the LbPair accounts in `lb_pairs`, the pools
+    whose account could not be decoded are priced concurrently through the Meteora API.
+    A price that could not be resolved is None.
+    """
+    candidates = {}
+
+    for token_address, pools in pools_by_token.items():
+        account_token_offset = accounts_token_offsets[token_address]
+        account_response = accounts_response[account_token_offset:account_token_offset + len(pools) * 2]
+
+        native_amounts = []
+        for index, pool in enumerate(pools):
+            if pool['base_mint'] == SOL_NATIVE_ADDRESS:
+                native_index, token_index = index * 2, index * 2 + 1
+            else:
+                native_index, token_index = index * 2 + 1, index * 2
+            if account_response[native_index] is None or account_response[token_index] is None:
+                continue
+            native_amounts.append((pool, account_response[native_index][0], account_response[token_index][1]))
+
+        # every other protocol always yields a price, a DLMM pool holding less native
+        # than one of them can never be the dominant pool so its price is not needed
+        max_other_native_amount = max(
+            (amount for pool, amount, _ in native_amounts if pool['protocol'] != Protocols.METEORA_DLMM.value),
+            default=None
+        )
+        for pool, amount, token_decimals in native_amounts:
+            if pool['protocol'] != Protocols.METEORA_DLMM.value:
+                continue
+            if max_other_native_amount is not None and amount < max_other_native_amount:
+                continue
+            candidates[pool['pub_key']] = (pool, token_decimals)
+
+    prices = {}
+    for pair_address, (pool, token_decimals) in candidates.items():
+        lb_pair_data = lb_pairs.get(pair_address)
+        if isinstance(lb_pair_data, bytes):
+            prices[pair_address] = _dlmm_token_price(pool, lb_pair_data, token_decimals)
+
+    unresolved = [pair_address for pair_address in candidates if prices.get(pair_address) is None]
+    if not unresolved or not DLMM_PRICE_API_FALLBACK:
+        return prices
+
+    semaphore = asyncio.Semaphore(DLMM_PRICE_CONCURRENCY)
+
+    async def fetch_price(pair_address: str):
+        async with semaphore:
+            try:
+                price = await get_meteora_dlmm_pair_address_price(pair_address=pair_address)
+            except Exception as e:
+                logging.warning(f"Could not get Meteora DLMM price of pair {pair_address}: {e}")
+                return None
+        if price is None:
+            return None
+        if candidates[pair_address][0]['base_mint'] == SOL_NATIVE_ADDRESS:
+            return 1 / decimal.Decimal(price) if decimal.Decimal(price) else None
+        return price
+
+    logging.info(f"Pricing {len(unresolved)} Meteora DLMM pools through the API")
+    api_prices = await asyncio.gather(*(fetch_price(pair_address) for pair_address in unresolved))
+    prices.update(zip(unresolved, api_prices))
+    return prices
+
+
 async def get_dominant_pool_info_per_token(pools_by_token: Dict[str, List[Dict]]):
     accounts = []
     accounts_token_offsets = {}
@@ -236,10 +457,35 @@ async def get_dominant_pool_info_per_token(pools_by_token: Dict[str, List[Dict]]
                 ]
             )
 
-    accounts_response = await get_accounts_in_concurrent_batches(account_list=accounts)
+    # DLMM pools are priced from their LbPair account. The RPC can not return it as jsonParsed,
+    # so it is fetched as base64 in its own request, issued along with the vaults so that the
+    # batching RPC client sends both in the same POST
+    lb_pair_accounts = list(dict.fromkeys(
+        pool['pub_key']
+        for pools in pools_by_token.values()
+        for pool in pools
+        if pool['protocol'] == Protocols.METEORA_DLMM.value
+    ))
+
+    async def fetch_lb_pairs():
+        try:
+            return await get_raw_accounts_in_concurrent_batches(lb_pair_accounts, data_length=LB_PAIR_PRICE_DATA_LENGTH)
+        except Exception as e:
+            # only costs the on-chain price of the DLMM pools, the API fallback still applies
+            logging.warning(f"Could not fetch {len(lb_pair_accounts)} Meteora DLMM LbPair accounts: {e!r}")
+            return [None] * len(lb_pair_accounts)
+
+    accounts_response, lb_pairs_response = await asyncio.gather(
+        get_accounts_in_concurrent_batches(account_list=accounts),
+        fetch_lb_pairs(),
+    )
 
     assert len(accounts) == len(accounts_response)
 
+    lb_pairs = dict(zip(lb_pair_accounts, lb_pairs_response))
+
+    dlmm_prices = await resolve_dlmm_prices(pools_by_token, accounts_response, accounts_token_offsets, lb_pairs)
+
     info = {
         token_address: {}
         for token_address in pools_by_token.keys()
@@ -288,7 +534,7 @@ async def get_dominant_pool_info_per_token(pools_by_token: Dict[str, List[Dict]]
                 token_price_decimal = (1/((sqrt_price_decimal / (2 ** 64)) ** 2)) * ((10 ** token_decimals_decimal) / 10 ** 9)
                 total_liquidity = native_token_amount_decimal + token_amount_decimal * token_price_decimal
             elif pool['protocol'] == Protocols.METEORA_DLMM.value:
-                token_price = await get_meteora_dlmm_pair_address_price(pair_address=pool['pub_key'])
+                token_price = dlmm_prices.get(pool['pub_key'])
                 if token_price is None:
                     continue
                 token_price_decimal = decimal.Decimal(token_price)
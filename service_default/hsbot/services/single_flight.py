@@ -0,0 +1,101 @@
+import asyncio
+import copy
+import functools
+import os
+from collections import OrderedDict
+
+# number of keys per call whose stats are kept, the least recently used ones are dropped
+SINGLE_FLIGHT_STATS_KEYS = int(os.environ.get('SINGLE_FLIGHT_STATS_KEYS', 1000))
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one in-flight upstream call.
+
+    The first caller starts the call as a task, every caller arriving before it
+    completes awaits the same task. Each caller gets its own deep copy of the result,
+    callers are free to update it, and an exception is raised to all of them.
+    Cancelling one caller does not cancel the shared call.
+    """
+
+    def __init__(self, name: str, max_tracked_keys: int = SINGLE_FLIGHT_STATS_KEYS):
+        self.name = name
+        self.max_tracked_keys = max_tracked_keys
+        self._in_flight = {}
+        self._stats = OrderedDict()
+
+    def _key_stats(self, key) -> dict:
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = {'calls': 0, 'executions': 0, 'coalesced': 0}
+            if len(self._stats) > self.max_tracked_keys:
+                self._stats.popitem(last=False)
+        else:
+            self._stats.move_to_end(key)
+        return stats
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    async def do(self, key, call):
+        stats = self._key_stats(key)
+        stats['calls'] += 1
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            stats['executions'] += 1
+        else:
+            stats['coalesced'] += 1
+
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': len(self._in_flight),
+            'calls': sum(stats['calls'] for stats in self._stats.values()),
+            'executions': sum(stats['executions'] for stats in self._stats.values()),
+            'coalesced': sum(stats['coalesced'] for stats in self._stats.values()),
+            'keys': {repr(key): dict(stats) for key, stats in self._stats.items()}
+        }
+
+
+_single_flights = {}
+
+
+def _default_key(args, kwargs):
+    def hashable(value):
+        if isinstance(value, (list, tuple)):
+            return tuple(hashable(item) for item in value)
+        if isinstance(value, dict):
+            return tuple(sorted((name, hashable(item)) for name, item in value.items()))
+        return value
+
+    return hashable(args), hashable(kwargs)
+
+
+def coalesce(name: str, key=None):
+    """
+    Decorates a coroutine function so concurrent calls with the same key share one call.
+    `key` gets the call arguments and returns a hashable key, by default all arguments are used.
+    """
+    single_flight = _single_flights.setdefault(name, SingleFlight(name))
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            flight_key = key(*args, **kwargs) if key is not None else _default_key(args, kwargs)
+            return await single_flight.do(flight_key, lambda: func(*args, **kwargs))
+
+        wrapper.single_flight = single_flight
+        return wrapper
+
+    return decorator
+
+
+def single_flight_stats() -> dict:
+    return {name: single_flight.stats() for name, single_flight in _single_flights.items()}
@@ -1,17 +1,38 @@
+import httpx
 import solders.solders
+from solana.exceptions import SolanaRpcException, handle_async_exceptions
 from solana.rpc.async_api import AsyncClient, Pubkey
 from solana.rpc.commitment import Commitment
-from solana.rpc.types import TokenAccountOpts
+from solana.rpc.providers.async_http import AsyncHTTPProvider
+from solana.rpc.providers.core import _parse_raw
+from solana.rpc.types import DataSliceOpts, TokenAccountOpts
+from collections import deque
 from itertools import islice
 import logging
 import asyncio
+import json
 import os
 import decimal
+import time
+from .rate_limit import rate_limiter
 
 
 SOLANA_PUBLICNODE_TOKEN = os.environ.get("SOLANA_PUBLICNODE_TOKEN")
 PUBLICNODE_RPC_URL = f"https://solana-rpc.publicnode.com/{SOLANA_PUBLICNODE_TOKEN}"
 
+# comma separated RPC urls the reads are spread over, publicnode alone by default
+SOLANA_RPC_URLS = [url.strip() for url in os.environ.get('SOLANA_RPC_URLS', PUBLICNODE_RPC_URL).split(',') if url.strip()]
+SOLANA_RPC_TIMEOUT = float(os.environ.get('SOLANA_RPC_TIMEOUT', 10))
+# send a read to the next endpoint too when the first one has not answered within its p95 latency
+SOLANA_RPC_HEDGING = os.environ.get('SOLANA_RPC_HEDGING', 'true').lower() == 'true'
+SOLANA_RPC_HEDGE_MIN_DELAY = float(os.environ.get('SOLANA_RPC_HEDGE_MIN_DELAY', 0.05))
+# an endpoint failing this many times in a row is left out for SOLANA_RPC_EJECT_SECONDS
+SOLANA_RPC_EJECT_AFTER = int(os.environ.get('SOLANA_RPC_EJECT_AFTER', 3))
+SOLANA_RPC_EJECT_SECONDS = float(os.environ.get('SOLANA_RPC_EJECT_SECONDS', 30))
+# requests issued within one event loop tick are sent as one JSON-RPC batch of up to SOLANA_RPC_BATCH_SIZE calls
+SOLANA_RPC_BATCHING = os.environ.get('SOLANA_RPC_BATCHING', 'true').lower() == 'true'
+SOLANA_RPC_BATCH_SIZE = int(os.environ.get('SOLANA_RPC_BATCH_SIZE', 20))
+
 
 def iterate_in_batches(iterable, batch_size):
     iterator = iter(iterable)
@@ -19,6 +40,130 @@ def iterate_in_batches(iterable, batch_size):
         yield batch
 
 
+class BatchingAsyncHTTPProvider(AsyncHTTPProvider):
+    """
+    HTTP provider packing the requests issued within the same event loop ticks into one POST.
+
+    Every request is queued and the queue is flushed as a JSON-RPC batch once a loop
+    iteration goes by without new requests, so calls gathered at different await depths
+    still share the batch. Each request gets its position in the batch as id and the
+    answers are matched back by id whatever their order. An error of the whole POST fails every request of the batch, an
+    error answer only fails its own request. A lone request is sent as is.
+    """
+    MAX_FLUSH_TICKS = 10
+
+    def __init__(self, endpoint: str, timeout: float = SOLANA_RPC_TIMEOUT, max_batch_size: int = SOLANA_RPC_BATCH_SIZE):
+        super().__init__(endpoint, timeout=timeout)
+        self.max_batch_size = max_batch_size
+        self._queue = []
+        self._flush_scheduled = False
+        self._queued_at_last_tick = 0
+        self._batch_tasks = set()
+        self.batches = 0
+        self.batched_requests = 0
+
+    @handle_async_exceptions(SolanaRpcException, httpx.HTTPError)
+    async def make_request(self, body, parser):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((body, parser, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush, 0)
+        return await future
+
+    def _flush(self, ticks: int):
+        if len(self._queue) > self._queued_at_last_tick and ticks < self.MAX_FLUSH_TICKS:
+            self._queued_at_last_tick = len(self._queue)
+            asyncio.get_running_loop().call_soon(self._flush, ticks + 1)
+            return
+
+        self._flush_scheduled = False
+        self._queued_at_last_tick = 0
+        # requests cancelled while queued, e.g. lost hedges, are not sent at all
+        queue = [request for request in self._queue if not request[2].done()]
+        self._queue = []
+        for batch in iterate_in_batches(queue, self.max_batch_size):
+            task = asyncio.ensure_future(self._send(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send(self, batch: list):
+        try:
+            if len(batch) == 1:
+                body, parser, future = batch[0]
+                raw = await self.make_request_unparsed(body)
+                self._resolve(future, raw, parser)
+                return
+
+            answers = await self._post_batch([body for body, _, _ in batch])
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+        for request_id, (body, parser, future) in enumerate(batch):
+            if request_id not in answers:
+                if not future.done():
+                    future.set_exception(ValueError(f"RPC node left {type(body).__name__} out of its batch answer"))
+                continue
+            self._resolve(future, json.dumps(answers[request_id]), parser)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, raw: str, parser):
+        if future.done():
+            return
+        try:
+            future.set_result(_parse_raw(raw, parser))
+        except Exception as e:
+            future.set_exception(e)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # solders panics on some answers it can not map, e.g. an error without its `data`,
+            # and PanicException is no Exception: it would leave the caller waiting forever
+            future.set_exception(ValueError(f"Could not parse the RPC node answer: {e}"))
+
+    async def _post_batch(self, bodies: list) -> dict:
+        payload = []
+        for request_id, body in enumerate(bodies):
+            request = json.loads(body.to_json())
+            request['id'] = request_id
+            payload.append(request)
+
+        response = await self.session.post(**self._build_common_request_kwargs(), content=json.dumps(payload))
+        response.raise_for_status()
+        answers = response.json()
+        if not isinstance(answers, list):
+            raise ValueError(f"RPC node did not answer the batch with a list: {response.text[:200]}")
+        return {answer.get('id'): answer for answer in answers}
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'batched_requests': self.batched_requests,
+            'avg_batch_size': self.batched_requests / self.batches if self.batches else 0.0
+        }
+
+
+class BatchingAsyncClient(AsyncClient):
+    """
+    Solana AsyncClient sending its requests through a BatchingAsyncHTTPProvider.
+    """
+
+    def __init__(self, endpoint: str, commitment: Commitment = None, timeout: float = SOLANA_RPC_TIMEOUT):
+        super().__init__(endpoint, commitment, timeout=timeout)
+        # the provider built by AsyncClient has not opened any connection yet, it is simply replaced
+        self._provider = BatchingAsyncHTTPProvider(endpoint, timeout=timeout)
+
+
 class SolanaAsyncClientFactory:
     """
     Factory class to cache existing async solana web3 clients in order to reduce resource usage.
@@ -29,55 +174,264 @@ class SolanaAsyncClientFactory:
     def get_client(network_rpc_url: str = PUBLICNODE_RPC_URL, commitment: str = "confirmed"):
         instance_key = f"{network_rpc_url}:{commitment}"
         if instance_key not in SolanaAsyncClientFactory._instances:
-            _client = AsyncClient(network_rpc_url, Commitment(commitment))
+            client_class = BatchingAsyncClient if SOLANA_RPC_BATCHING else AsyncClient
+            _client = client_class(network_rpc_url, Commitment(commitment), timeout=SOLANA_RPC_TIMEOUT)
             SolanaAsyncClientFactory._instances[instance_key] = _client
 
         return SolanaAsyncClientFactory._instances[instance_key]
 
+    @staticmethod
+    async def close_all():
+        clients = list(SolanaAsyncClientFactory._instances.values())
+        SolanaAsyncClientFactory._instances.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception:
+                logging.exception("Could not close solana client")
+
+
+class RpcEndpoint:
+    """
+    Latency and health bookkeeping of one RPC url.
+    """
+    EWMA_ALPHA = 0.2
+    MIN_SAMPLES_FOR_P95 = 20
+
+    def __init__(self, url: str, commitment: str = "confirmed", samples: int = 200):
+        self.url = url
+        self.commitment = commitment
+        self.ewma_latency = None
+        self.latencies = deque(maxlen=samples)
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def client(self) -> AsyncClient:
+        return SolanaAsyncClientFactory.get_client(self.url, self.commitment)
+
+    @property
+    def ejected(self) -> bool:
+        return time.monotonic() < self.ejected_until
+
+    def record_latency(self, latency: float):
+        self.latencies.append(latency)
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency += self.EWMA_ALPHA * (latency - self.ewma_latency)
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.record_latency(latency)
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= SOLANA_RPC_EJECT_AFTER:
+            self.ejected_until = time.monotonic() + SOLANA_RPC_EJECT_SECONDS
+            logging.warning(f"Ejecting RPC endpoint {self.url} for {SOLANA_RPC_EJECT_SECONDS} seconds "
+                            f"after {self.consecutive_failures} failures")
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) >= self.MIN_SAMPLES_FOR_P95:
+            ordered = sorted(self.latencies)
+            delay = ordered[int(len(ordered) * 0.95) - 1]
+        elif self.ewma_latency is not None:
+            delay = self.ewma_latency * 2
+        else:
+            delay = SOLANA_RPC_TIMEOUT / 2
+        return max(delay, SOLANA_RPC_HEDGE_MIN_DELAY)
+
+    def stats(self) -> dict:
+        return {
+            'ewma_latency': self.ewma_latency,
+            'hedge_delay': self.hedge_delay(),
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejected': self.ejected
+        }
+
+
+class RpcPool:
+    """
+    Spreads idempotent reads over several RPC endpoints.
+
+    Every call goes to the healthy endpoint with the lowest EWMA latency and fails over to
+    the next one on error. With hedging, the call is also sent to the next endpoint once
+    the first has not answered within its p95 latency, the first answer wins and the other
+    request is cancelled. Endpoints failing repeatedly are ejected for a while; when every
+    endpoint is ejected they are all tried anyway.
+    """
+
+    def __init__(self, urls: list = None, hedging: bool = SOLANA_RPC_HEDGING, commitment: str = "confirmed"):
+        self.endpoints = [RpcEndpoint(url, commitment) for url in (urls or SOLANA_RPC_URLS)]
+        self.hedging = hedging
+        self.hedged_requests = 0
+
+    def _ranked_endpoints(self) -> list:
+        healthy = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+        if not healthy:
+            return sorted(self.endpoints, key=lambda endpoint: endpoint.ejected_until)
+        # endpoints without samples yet go first so they get measured
+        return sorted(healthy, key=lambda endpoint: endpoint.ewma_latency or 0.0)
+
+    @staticmethod
+    async def _attempt(endpoint: RpcEndpoint, method: str, args: tuple, kwargs: dict, sent: asyncio.Future):
+        await rate_limiter('solana_rpc').acquire()
+        started = time.monotonic()
+        sent.set_result(started)
+        try:
+            result = await getattr(endpoint.client, method)(*args, **kwargs)
+        except asyncio.CancelledError:
+            # lost against a hedged request, how long it took is not known
+            raise
+        except Exception:
+            endpoint.record_failure()
+            raise
+        endpoint.record_success(time.monotonic() - started)
+        return result
+
+    async def call(self, method: str, *args, **kwargs):
+        """
+        Calls `method` of the solana AsyncClient of the best endpoint, only use it for reads.
+        """
+        endpoints = self._ranked_endpoints()
+        launched = 0
+        pending = set()
+        # per attempt, resolved with the time its request went out
+        sent = []
+        last_error = None
+
+        def launch():
+            nonlocal launched
+            sent.append(asyncio.get_running_loop().create_future())
+            pending.add(asyncio.ensure_future(self._attempt(endpoints[launched], method, args, kwargs, sent[-1])))
+            launched += 1
+
+        launch()
+        try:
+            while pending:
+                can_hedge = self.hedging and len(pending) == 1 and launched < len(endpoints)
+                timeout = None
+                if can_hedge:
+                    if not sent[-1].done():
+                        # the hedge timer starts once the request is out, not while it waits for a token
+                        await asyncio.wait(pending | {sent[-1]}, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    timeout = max(sent[-1].result() + endpoints[launched - 1].hedge_delay() - time.monotonic(), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    self.hedged_requests += 1
+                    launch()
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    logging.warning(f"RPC {method} failed: {last_error!r}")
+
+                if not pending and launched < len(endpoints):
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise last_error
+
+    def stats(self) -> dict:
+        return {
+            'hedged_requests': self.hedged_requests,
+            'endpoints': {endpoint.url: endpoint.stats() for endpoint in self.endpoints}
+        }
+
+
+solana_rpc_pool = RpcPool()
+
 
 async def get_native_balance(wallet_address):
     if isinstance(wallet_address, str):
         wallet_address = Pubkey.from_string(wallet_address)
 
-    solana_client = SolanaAsyncClientFactory.get_client()
-    result = await solana_client.get_balance(wallet_address)
+    result = await solana_rpc_pool.call('get_balance', wallet_address)
     # logging.info(f"Wallet {wallet_address} has native balance: {result.value}")
     return decimal.Decimal(result.value / 10 ** 9)
 
 
+def _pubkeys(accounts: list) -> list:
+    return [account if isinstance(account, Pubkey) else Pubkey.from_string(account) for account in accounts]
+
+
 async def get_multiple_accounts(accounts: list):
-    solana_client = SolanaAsyncClientFactory.get_client()
-    accounts = [account if isinstance(account, Pubkey) else Pubkey.from_string(account) for account in accounts]
-    result = await solana_client.get_multiple_accounts_json_parsed(accounts)
+    """
+    Token accounts as jsonParsed. Every account must be one the RPC can parse: a single
+    account it returns as base64 instead makes the whole answer fail to deserialize.
+    """
+    result = await solana_rpc_pool.call('get_multiple_accounts_json_parsed', _pubkeys(accounts))
+    return result.value
+
+
+async def get_multiple_raw_accounts(accounts: list, data_length: int = None):
+    """
+    Accounts as raw bytes, for program state the RPC can not parse, e.g. a Meteora LbPair.
+    With `data_length` only the leading `data_length` bytes of every account are sent.
+    """
+    data_slice = DataSliceOpts(offset=0, length=data_length) if data_length is not None else None
+    result = await solana_rpc_pool.call('get_multiple_accounts', _pubkeys(accounts), encoding='base64', data_slice=data_slice)
     return result.value
 
 
+def _account_summary(account):
+    """
+    (ui amount, decimals) of a token account or None if the account does not exist.
+    """
+    if account is None:
+        return None
+    return (
+        account.data.parsed['info']['tokenAmount']['uiAmount'],
+        int(account.data.parsed['info']['tokenAmount']['decimals']),
+    )
+
+
+def _raw_account_data(account):
+    return bytes(account.data) if account is not None else None
+
+
+async def _get_in_concurrent_batches(account_list, fetch_batch) -> list:
+    """
+    One result per account of `account_list`, in order. A failing batch fails the whole
+    call, the results of the other batches would not line up with the accounts asked for.
+    """
+    tasks = [fetch_batch(batch) for batch in iterate_in_batches(account_list, batch_size=100)]
+    results = await asyncio.gather(*tasks)
+    return [account for result in results for account in result]
+
+
 async def get_accounts_in_concurrent_batches(account_list):
-    async def fetch_accounts_batch(batch_id: int, accounts_batch: list):
+    async def fetch_accounts_batch(accounts_batch: list):
         multiple_accounts_response = await get_multiple_accounts(accounts_batch)
+        return tuple(_account_summary(account) for account in multiple_accounts_response)
+
+    return await _get_in_concurrent_batches(account_list, fetch_accounts_batch)
 
-        multiple_accounts_data = tuple(
-            (
-                account.data.parsed['info']['tokenAmount']['uiAmount'],
-                int(account.data.parsed['info']['tokenAmount']['decimals']),
-            ) if account is not None else None
-            for account in multiple_accounts_response
-        )
-        return {
-            "batch_id": batch_id,
-            "accounts_batch_response": multiple_accounts_data
-        }
 
-    tasks = [
-        fetch_accounts_batch(index, batch)
-        for index, batch in enumerate(iterate_in_batches(account_list, batch_size=100))
-    ]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    return [account for result in results if isinstance(result, dict) for account in result["accounts_batch_response"]]
+async def get_raw_accounts_in_concurrent_batches(account_list, data_length: int = None):
+    """Raw data of the accounts, None for the accounts that do not exist."""
+    async def fetch_accounts_batch(accounts_batch: list):
+        multiple_accounts_response = await get_multiple_raw_accounts(accounts_batch, data_length)
+        return tuple(_raw_account_data(account) for account in multiple_accounts_response)
+
+    return await _get_in_concurrent_batches(account_list, fetch_accounts_batch)
 
 
 async def get_account_tokens_balances(account):
-    solana_client = SolanaAsyncClientFactory.get_client()
     token_programs_ids = (
         Pubkey.from_string('TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA'),
         Pubkey.from_string('TokenzQdBNbLqP5VEhdkAS6EPFLC1PHnBqCXEpPxuEb')
@@ -87,7 +441,8 @@ async def get_account_tokens_balances(account):
         account = Pubkey.from_string(account)
 
     async def fetch_accounts_tokens(program_id: str):
-        return await solana_client.get_token_accounts_by_owner_json_parsed(
+        return await solana_rpc_pool.call(
+            'get_token_accounts_by_owner_json_parsed',
             owner=account,
             opts=TokenAccountOpts(program_id=program_id)
         )
@@ -106,13 +461,11 @@ async def get_account_tokens_balances(account):
 
 
 async def get_token_supply(token_address: str) -> solders.solders.UiTokenAmount:
-    solana_client = SolanaAsyncClientFactory.get_client()
-
     try:
         if isinstance(token_address, str):
             token_address = Pubkey.from_string(token_address)
 
-        result = await solana_client.get_token_supply(token_address)
+        result = await solana_rpc_pool.call('get_token_supply', token_address)
         # logging.info(f"Token {token_address} has supply: {result.value}")
         return result.value
     except Exception as e:
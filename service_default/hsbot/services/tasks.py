@@ -1,6 +1,11 @@
+import asyncio
 import json
+import logging
 import os
 import datetime
+import time
+from google.api_core.retry import if_transient_error
+from google.api_core.retry_async import AsyncRetry
 from google.cloud import tasks_v2
 import grpc
 from google.cloud.tasks_v2.services.cloud_tasks.transports import CloudTasksGrpcAsyncIOTransport
@@ -8,6 +13,18 @@ from google.cloud.tasks_v2.services.cloud_tasks.transports import CloudTasksGrpc
 PROJECT_ID = os.getenv('GOOGLE_CLOUD_PROJECT')
 LOCATION = "europe-west1"
 
+# deletions of a chat due within this many seconds of each other are sent as one deleteMessages
+# call, a deletion is buffered and runs up to this many seconds later than asked
+DELETE_BATCH_WINDOW = float(os.environ.get('DELETE_BATCH_WINDOW', 2))
+# longest wait before the buffered deletions whose Cloud Task could not be created are tried again
+DELETE_RETRY_MAX_DELAY = float(os.environ.get('DELETE_RETRY_MAX_DELAY', 60))
+# deleteMessages takes up to 100 message ids
+DELETE_BATCH_SIZE = 100
+# Cloud Tasks created at once when a window is flushed
+TASK_CREATE_CONCURRENCY = int(os.environ.get('TASK_CREATE_CONCURRENCY', 10))
+# creating a task is retried on unavailable and internal errors, a duplicate deletion is harmless
+TASK_CREATE_RETRY = AsyncRetry(predicate=if_transient_error, initial=0.2, maximum=2, timeout=10)
+
 
 class CloudTaskAsyncClientFactory:
     """
@@ -27,34 +44,166 @@ class CloudTaskAsyncClientFactory:
         return cls._instance
 
 
-async def create_delete_message_task(user_id: str, chat_id: str, message_id: str, delay: int = 0):
-    task_client = CloudTaskAsyncClientFactory()
-    queue_name = "delete-tg-messages"
-    queue_path = task_client.queue_path(PROJECT_ID, LOCATION, queue_name)
-
+def _app_engine_task(relative_uri: str, payload: dict, schedule_time: datetime.datetime = None) -> dict:
     _task = {
         'app_engine_http_request': {
             'http_method': tasks_v2.HttpMethod.POST,
-            'relative_uri': '/worker/delete-tg-message',
-            'body': json.dumps(
-                {
-                    "user_id": user_id,
-                    "chat_id": chat_id,
-                    "message_id": message_id
-                }
-            ).encode(),
+            'relative_uri': relative_uri,
+            'body': json.dumps(payload).encode(),
             'headers': {
                 "Content-type": "application/json"
             }
         }
     }
 
-    if delay > 0:
-        eta = datetime.datetime.now(datetime.UTC) + datetime.timedelta(seconds=delay)
+    if schedule_time is not None:
         _task.update(
             {
-                'schedule_time': eta
+                'schedule_time': schedule_time
             }
         )
+    return _task
+
+
+async def create_delete_messages_task(chat_id: str, messages: list, schedule_time: datetime.datetime = None):
+    """
+    Schedules the deletion of up to DELETE_BATCH_SIZE messages of a chat, each message is
+    a dict holding its user_id and message_id.
+    """
+    task_client = CloudTaskAsyncClientFactory()
+    queue_name = "delete-tg-messages"
+    queue_path = task_client.queue_path(PROJECT_ID, LOCATION, queue_name)
+
+    _task = _app_engine_task(
+        '/worker/delete-tg-messages',
+        {
+            "chat_id": chat_id,
+            "messages": messages
+        },
+        schedule_time
+    )
+
+    await task_client.create_task(parent=queue_path, task=_task, retry=TASK_CREATE_RETRY)
+
+
+class DeleteMessageBatcher:
+    """
+    Groups the scheduled message deletions of a chat into one Cloud Task.
+
+    Deletions are buffered for up to `window` seconds, then the deletions of a chat due
+    within `window` seconds of each other are sent as Cloud Tasks of up to `batch_size`
+    messages, each scheduled at the latest due time of its messages. The handlers delete
+    one message at a time, so a task only carries several messages when a chat asks for
+    deletions close together, `avg_batch_size` in the stats tells how much that saves.
+
+    Deletions whose task could not be created are buffered again and retried with a
+    doubling delay. A deletion that must not wait in the buffer, such as the one of a
+    private key, is sent right away with `schedule_now`.
+    """
+
+    def __init__(self, window: float = DELETE_BATCH_WINDOW, batch_size: int = DELETE_BATCH_SIZE,
+                 create_concurrency: int = TASK_CREATE_CONCURRENCY, retry_max_delay: float = DELETE_RETRY_MAX_DELAY):
+        self.window = window
+        self.batch_size = batch_size
+        self.create_concurrency = create_concurrency
+        self.retry_max_delay = retry_max_delay
+        self._pending = {}
+        self._flusher = None
+        self.scheduled = 0
+        self.tasks_created = 0
+        self.tasks_failed = 0
+        self.messages_sent = 0
+
+    def _buffer(self, chat_id: str, deletions: list):
+        self._pending.setdefault(chat_id, []).extend(deletions)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    def schedule(self, user_id: str, chat_id: str, message_id: str, delay: int = 0):
+        self.scheduled += 1
+        self._buffer(str(chat_id), [(time.time() + delay, {"user_id": user_id, "message_id": message_id})])
+
+    async def schedule_now(self, user_id: str, chat_id: str, message_id: str, delay: int = 0):
+        """Creates the Cloud Task of the deletion right away, it is buffered and retried if that fails."""
+        self.scheduled += 1
+        deletion = (time.time() + delay, {"user_id": user_id, "message_id": message_id})
+        if await self._create_tasks([(str(chat_id), [deletion])]):
+            self._buffer(str(chat_id), [deletion])
+
+    def _batches(self, pending: dict) -> list:
+        batches = []
+        for chat_id, deletions in pending.items():
+            batch = []
+            for deletion in sorted(deletions, key=lambda deletion: deletion[0]):
+                if batch and (deletion[0] - batch[0][0] > self.window or len(batch) >= self.batch_size):
+                    batches.append((chat_id, batch))
+                    batch = []
+                batch.append(deletion)
+            batches.append((chat_id, batch))
+        return batches
+
+    async def _create_tasks(self, batches: list) -> list:
+        """Creates a Cloud Task per batch, returns the batches that failed."""
+        semaphore = asyncio.Semaphore(self.create_concurrency)
+
+        async def create_task(chat_id: str, batch: list):
+            schedule_time = datetime.datetime.fromtimestamp(batch[-1][0], datetime.UTC)
+            async with semaphore:
+                await create_delete_messages_task(chat_id, [message for _, message in batch], schedule_time)
+
+        results = await asyncio.gather(*(create_task(*batch) for batch in batches), return_exceptions=True)
+        failed = []
+        for (chat_id, batch), result in zip(batches, results):
+            if isinstance(result, Exception):
+                self.tasks_failed += 1
+                logging.error(f"Could not schedule the deletion of {len(batch)} messages in chat {chat_id}: {result!r}")
+                failed.append((chat_id, batch))
+            else:
+                self.tasks_created += 1
+                self.messages_sent += len(batch)
+        return failed
+
+    async def _flush_later(self):
+        delay = self.window
+        while True:
+            await asyncio.sleep(delay)
+            failed = await self.flush()
+            if not self._pending:
+                return
+            # deletions buffered meanwhile wait for the next window, failed ones back off
+            delay = min(delay * 2, self.retry_max_delay) if failed else self.window
+
+    async def flush(self) -> int:
+        """Creates the Cloud Tasks of every buffered deletion, returns how many failed and were buffered again."""
+        pending, self._pending = self._pending, {}
+        batches = self._batches(pending)
+        if not batches:
+            return 0
+
+        failed = await self._create_tasks(batches)
+        for chat_id, batch in failed:
+            self._pending.setdefault(chat_id, []).extend(batch)
+        return len(failed)
+
+    async def close(self):
+        """Stops waiting for the window and schedules whatever is buffered."""
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        self._flusher = None
+        await self.flush()
+        if self._pending:
+            lost = sum(len(deletions) for deletions in self._pending.values())
+            logging.error(f"Dropping {lost} buffered message deletions on shutdown")
+            self._pending = {}
+
+    def stats(self) -> dict:
+        return {
+            'buffered': sum(len(deletions) for deletions in self._pending.values()),
+            'scheduled': self.scheduled,
+            'tasks_created': self.tasks_created,
+            'tasks_failed': self.tasks_failed,
+            'avg_batch_size': self.messages_sent / self.tasks_created if self.tasks_created else 0.0
+        }
+
 
-    await task_client.create_task(parent=queue_path, task=_task)
+delete_message_batcher = DeleteMessageBatcher()
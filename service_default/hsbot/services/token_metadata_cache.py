@@ -0,0 +1,215 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+TOKEN_METADATA_CACHE_SIZE = int(os.environ.get('TOKEN_METADATA_CACHE_SIZE', 5000))
+# name, symbol and icon are only refreshed once a day, decimals and token program never change
+TOKEN_METADATA_TTL = int(os.environ.get('TOKEN_METADATA_TTL', 60 * 60 * 24))
+TOKEN_SUPPLY_TTL = int(os.environ.get('TOKEN_SUPPLY_TTL', 60 * 10))
+# keep the cached metadata in store['token_metadata'] as well, so it survives restarts
+TOKEN_METADATA_PERSIST = os.environ.get('TOKEN_METADATA_PERSIST', 'false').lower() == 'true'
+# persisted entries not fetched for this long are dropped by the sweep, the least recently fetched beyond the cap too
+TOKEN_METADATA_PERSIST_TTL = int(os.environ.get('TOKEN_METADATA_PERSIST_TTL', 60 * 60 * 24 * 7))
+TOKEN_METADATA_PERSIST_MAX_ENTRIES = int(os.environ.get('TOKEN_METADATA_PERSIST_MAX_ENTRIES', 20000))
+
+IMMUTABLE_FIELDS = ('decimals', 'token_program_id')
+
+
+class TokenMetadataCache:
+    """
+    LRU cache of the Helius token metadata, with an optional persistent tier in the store.
+
+    Every entry remembers when its metadata and its supply were fetched, the descriptive
+    fields expire after `metadata_ttl` and the supply after `supply_ttl`. An entry whose
+    metadata expired is a miss and gets refetched as a whole, one whose supply alone expired
+    only needs its supply refreshed through `put_supply`. Expired entries are only dropped
+    by the LRU so immutable fields are kept when a refetch does not return them.
+
+    The persistent tier is bounded by `sweep`, run along with the sweep of the message states.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_METADATA_CACHE_SIZE, metadata_ttl: int = TOKEN_METADATA_TTL,
+                 supply_ttl: int = TOKEN_SUPPLY_TTL, persist: bool = TOKEN_METADATA_PERSIST,
+                 persist_ttl: int = TOKEN_METADATA_PERSIST_TTL,
+                 persist_max_entries: int = TOKEN_METADATA_PERSIST_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.metadata_ttl = metadata_ttl
+        self.supply_ttl = supply_ttl
+        self.persist = persist
+        self.persist_ttl = persist_ttl
+        self.persist_max_entries = persist_max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.supply_refreshes = 0
+        self.persist_evictions = 0
+
+    @staticmethod
+    def _persistent_tier():
+        from hsbot.persistence_layer import store
+
+        if 'token_metadata' not in store:
+            store['token_metadata'] = {}
+        return store['token_metadata']
+
+    def _metadata_fresh(self, entry: dict, now: float) -> bool:
+        return now - entry['metadata_fetched_at'] <= self.metadata_ttl
+
+    def _supply_fresh(self, entry: dict, now: float) -> bool:
+        return now - entry['supply_fetched_at'] <= self.supply_ttl
+
+    def _fresh(self, entry: dict, now: float) -> bool:
+        return self._metadata_fresh(entry, now) and self._supply_fresh(entry, now)
+
+    def _lookup(self, token_address: str):
+        entry = self._entries.get(token_address)
+        if entry is None and self.persist:
+            entry = self._persistent_tier().get(token_address)
+            if entry is not None:
+                entry = dict(entry, metadata=dict(entry['metadata']))
+                self._remember(token_address, entry)
+        return entry
+
+    def _remember(self, token_address: str, entry: dict):
+        self._entries[token_address] = entry
+        self._entries.move_to_end(token_address)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, token_address: str, allow_stale: bool = False) -> dict | None:
+        entry = self._lookup(token_address)
+        if entry is None or not (allow_stale or self._fresh(entry, time.time())):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(token_address)
+        return dict(entry['metadata'])
+
+    def get_many(self, token_addresses: list, allow_stale: bool = False) -> tuple:
+        """
+        Returns the cached metadata by address and the list of addresses that missed.
+        """
+        found = {}
+        missing = []
+        for token_address in dict.fromkeys(token_addresses):
+            metadata = self.get(token_address, allow_stale)
+            if metadata is None:
+                missing.append(token_address)
+            else:
+                found[token_address] = metadata
+        return found, missing
+
+    def lookup_many(self, token_addresses: list) -> tuple:
+        """
+        Splits the addresses into the cached metadata that is fresh, the cached metadata
+        whose supply alone expired, both by address, and the list of addresses that missed.
+        """
+        now = time.time()
+        found = {}
+        supply_expired = {}
+        missing = []
+        for token_address in dict.fromkeys(token_addresses):
+            entry = self._lookup(token_address)
+            if entry is None or not self._metadata_fresh(entry, now):
+                self.misses += 1
+                missing.append(token_address)
+                continue
+
+            self._entries.move_to_end(token_address)
+            if self._supply_fresh(entry, now):
+                self.hits += 1
+                found[token_address] = dict(entry['metadata'])
+            else:
+                self.supply_refreshes += 1
+                supply_expired[token_address] = dict(entry['metadata'])
+        return found, supply_expired, missing
+
+    def put_supply(self, token_address: str, supply: int):
+        """Updates the supply of a cached entry, leaving its metadata and when it was fetched as they are."""
+        entry = self._lookup(token_address)
+        if entry is None:
+            return
+
+        entry = dict(entry, metadata=dict(entry['metadata'], supply=supply), supply_fetched_at=time.time())
+        self._remember(token_address, entry)
+        self._persist(token_address, entry)
+
+    def put_supplies(self, supplies: dict):
+        for token_address, supply in supplies.items():
+            self.put_supply(token_address, supply)
+        self._save(supplies)
+
+    def _persist(self, token_address: str, entry: dict):
+        if self.persist:
+            try:
+                self._persistent_tier()[token_address] = entry
+            except Exception:
+                logging.exception(f"Could not persist metadata of token {token_address}")
+
+    def _save(self, changed: dict):
+        if self.persist and changed:
+            from hsbot.persistence_layer import store
+            store.save()
+
+    def put(self, token_address: str, metadata: dict):
+        now = time.time()
+        metadata = dict(metadata)
+        previous_entry = self._lookup(token_address)
+        if previous_entry is not None:
+            for field in IMMUTABLE_FIELDS:
+                if metadata.get(field) is None:
+                    metadata[field] = previous_entry['metadata'].get(field)
+
+        entry = {'metadata': metadata, 'metadata_fetched_at': now, 'supply_fetched_at': now}
+        self._remember(token_address, entry)
+        self._persist(token_address, entry)
+
+    def put_many(self, tokens_metadata: dict):
+        for token_address, metadata in tokens_metadata.items():
+            self.put(token_address, metadata)
+        self._save(tokens_metadata)
+
+    def sweep(self) -> int:
+        """
+        Drops the persisted entries not fetched for `persist_ttl` seconds, then the least recently
+        fetched ones beyond `persist_max_entries`, returns how many were dropped.
+        An entry in use is refetched at least every `metadata_ttl` seconds, so when it was last
+        fetched tells when it was last used without reads having to write the store.
+        """
+        if not self.persist:
+            return 0
+
+        from hsbot.persistence_layer import store
+
+        store.sync()
+        tier = self._persistent_tier()
+        now = time.time()
+        by_fetch_time = sorted(
+            (max(entry['metadata_fetched_at'], entry['supply_fetched_at']), token_address)
+            for token_address, entry in tier.items()
+        )
+        expired = sum(1 for fetched_at, _ in by_fetch_time if now - fetched_at > self.persist_ttl)
+        dropped = by_fetch_time[:max(expired, len(by_fetch_time) - self.persist_max_entries)]
+
+        for _, token_address in dropped:
+            del tier[token_address]
+
+        if dropped:
+            self.persist_evictions += len(dropped)
+            store.save()
+            logging.info(f"Swept {len(dropped)} persisted token metadata entries")
+        return len(dropped)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'supply_refreshes': self.supply_refreshes,
+            'persist_evictions': self.persist_evictions
+        }
+
+
+token_metadata_cache = TokenMetadataCache()
@@ -3,8 +3,11 @@ import logging
 import decimal
 from hsbot.services.shyft import get_pools_by_token, get_dominant_pool_info_per_token
 from hsbot.services.helius import get_token_metadata, get_tokens_metadata
+from hsbot.services.circuit_breaker import CircuitOpenError
+from hsbot.services.single_flight import coalesce
 
 
+@coalesce('sol.fetch_single_token_info')
 async def fetch_single_token_info(token_address: str, allow_partial_svm_tokens=False) -> dict:
     """
         Returns a single token's information.
@@ -29,6 +32,8 @@ async def fetch_single_token_info(token_address: str, allow_partial_svm_tokens=F
         # 'name', 'address', 'icon', 'supply', 'decimals', 'symbol'
         token_info = await get_token_metadata(token_address)
         pools_by_token = await get_pools_by_token(token_address)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logging.exception(f'Failed to fetch info for svm token {token_address}: {str(e)}')
         raise ValueError(e)
@@ -82,12 +87,22 @@ async def fetch_multi_token_info(token_addresses: List[str], allow_partial_svm_t
         # 'name', 'address', 'icon', 'supply', 'decimals', 'symbol'
         tokens_info = await get_tokens_metadata(token_addresses)
         pools_by_token = await get_pools_by_token(token_addresses)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logging.exception(f'Failed to fetch info for svm tokens {token_addresses}: {str(e)}')
         raise ValueError(e)
 
     pool_info_per_token = await get_dominant_pool_info_per_token(pools_by_token=pools_by_token)
 
+    return merge_pool_info(token_addresses, tokens_info, pool_info_per_token, allow_partial_svm_tokens)
+
+
+def merge_pool_info(token_addresses: List[str], tokens_info: dict, pool_info_per_token: dict,
+                    allow_partial_svm_tokens=False) -> dict:
+    """
+        Completes the tokens' metadata with the price, liquidity and fdv of their dominant pool.
+        """
     for ta in token_addresses:
         token_pool_info = pool_info_per_token[ta]
         if not token_pool_info and not allow_partial_svm_tokens:
@@ -0,0 +1,153 @@
+import decimal
+import io
+import json
+import pickle
+import struct
+import zlib
+
+try:
+    from solders.pubkey import Pubkey
+except ImportError:  # the codec itself does not need solders, only stores holding Pubkey values do
+    Pubkey = None
+
+CORRUPTED_RECORD = object()
+
+
+class JsonCodec:
+    """
+    The original store format, Decimal and Pubkey values are written as strings
+    and read back as strings.
+    """
+    name = 'json'
+    binary = False
+    snapshot_suffix = '.json'
+
+    def dumps(self, value, pretty: bool = False) -> bytes:
+        return json.dumps(value, indent=4 if pretty else None, default=str).encode("utf-8")
+
+    def loads(self, content: bytes):
+        return json.loads(content)
+
+    def frame(self, record) -> bytes:
+        return self.dumps(record) + b"\n"
+
+    def unframe(self, content: bytes):
+        """
+        Yields (record, size) for every complete record of a journal chunk.
+        """
+        for line in content.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                return
+            if not line.strip():
+                yield None, len(line)
+                continue
+            try:
+                yield self.loads(line), len(line)
+            except json.JSONDecodeError:
+                yield CORRUPTED_RECORD, len(line)
+
+
+def _pubkey_from_bytes(raw: bytes):
+    return Pubkey.from_bytes(raw)
+
+
+def _reduce_pubkey(pubkey):
+    return _pubkey_from_bytes, (bytes(pubkey),)
+
+
+def _reduce_dict(value):
+    return dict, (), None, None, iter(value.items())
+
+
+def _reduce_list(value):
+    return list, (), None, iter(value)
+
+
+class _StoreUnpickler(pickle.Unpickler):
+    ALLOWED_GLOBALS = {
+        ('builtins', 'dict'): dict,
+        ('builtins', 'list'): list,
+        ('decimal', 'Decimal'): decimal.Decimal,
+        (__name__, '_pubkey_from_bytes'): _pubkey_from_bytes,
+    }
+
+    def find_class(self, module, name):
+        try:
+            return self.ALLOWED_GLOBALS[(module, name)]
+        except KeyError:
+            raise pickle.UnpicklingError(f"{module}.{name} is not allowed in store files")
+
+
+class BinaryCodec:
+    """
+    Compact binary format based on pickle protocol 5, restricted on load to plain
+    containers, Decimal and Pubkey, so those round-trip losslessly.
+    Payloads are zlib compressed when `compression_level` is above 0.
+
+    Every payload starts with one byte telling whether it is compressed.
+    Journal records are framed with their 4 byte big endian length.
+    """
+    name = 'binary'
+    binary = True
+    snapshot_suffix = '.bin'
+
+    _RAW = b'p'
+    _COMPRESSED = b'z'
+    _FRAME_HEADER = struct.Struct('>I')
+
+    def __init__(self, compression_level: int = 0, dict_types: tuple = (), list_types: tuple = ()):
+        self.compression_level = compression_level
+        # dict and list subclasses, like the tracked containers of the store, are stored as plain ones
+        self._dispatch_table = {}
+        self._dispatch_table.update((dict_type, _reduce_dict) for dict_type in dict_types)
+        self._dispatch_table.update((list_type, _reduce_list) for list_type in list_types)
+        if Pubkey is not None:
+            self._dispatch_table[Pubkey] = _reduce_pubkey
+
+    def dumps(self, value, pretty: bool = False) -> bytes:
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, protocol=5)
+        pickler.dispatch_table = self._dispatch_table
+        pickler.dump(value)
+        content = buffer.getvalue()
+
+        if self.compression_level > 0:
+            return self._COMPRESSED + zlib.compress(content, self.compression_level)
+        return self._RAW + content
+
+    def loads(self, content: bytes):
+        kind, content = content[:1], content[1:]
+        if kind == self._COMPRESSED:
+            content = zlib.decompress(content)
+        elif kind != self._RAW:
+            raise pickle.UnpicklingError(f"Unknown store payload kind {kind!r}")
+        return _StoreUnpickler(io.BytesIO(content)).load()
+
+    def frame(self, record) -> bytes:
+        payload = self.dumps(record)
+        return self._FRAME_HEADER.pack(len(payload)) + payload
+
+    def unframe(self, content: bytes):
+        """
+        Yields (record, size) for every complete record of a journal chunk.
+        """
+        offset = 0
+        while offset + self._FRAME_HEADER.size <= len(content):
+            length, = self._FRAME_HEADER.unpack_from(content, offset)
+            end = offset + self._FRAME_HEADER.size + length
+            if end > len(content):
+                return
+            try:
+                record = self.loads(content[offset + self._FRAME_HEADER.size:end])
+            except (pickle.UnpicklingError, zlib.error, EOFError, ValueError):
+                record = CORRUPTED_RECORD
+            yield record, end - offset
+            offset = end
+
+
+def get_codec(name: str, compression_level: int = 0, dict_types: tuple = (), list_types: tuple = ()):
+    if name == JsonCodec.name:
+        return JsonCodec()
+    if name == BinaryCodec.name:
+        return BinaryCodec(compression_level, dict_types, list_types)
+    raise ValueError(f"Unknown store codec '{name}'")
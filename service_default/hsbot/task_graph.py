@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+
+# stage timings of every graph, by graph name
+_graph_stats = {}
+
+
+class TaskGraph:
+    """
+    Runs named async stages concurrently, each one as soon as the stages it depends on are done.
+
+    A stage is a coroutine function getting the results of its dependencies as keyword
+    arguments, dependencies must be added before the stages using them so the graph can not
+    have cycles. The first failing stage fails the run with its exception and cancels the
+    stages still running. Every run records when each stage started and how long it took,
+    so the critical path shows which chain of stages the run waited on.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._stages = {}
+        self.timings = {}
+        self.duration = None
+
+    def add(self, name: str, func, depends_on: tuple = ()):
+        unknown = [dependency for dependency in depends_on if dependency not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage {name} of {self.name} depends on unknown stages {unknown}")
+        self._stages[name] = (func, tuple(depends_on))
+        return self
+
+    async def run(self) -> dict:
+        started = time.monotonic()
+        tasks = {}
+
+        async def run_stage(name: str, func, depends_on: tuple):
+            dependencies = {dependency: await tasks[dependency] for dependency in depends_on}
+            stage_started = time.monotonic()
+            result = await func(**dependencies)
+            self.timings[name] = {
+                'start': stage_started - started,
+                'duration': time.monotonic() - stage_started
+            }
+            return result
+
+        for name, (func, depends_on) in self._stages.items():
+            tasks[name] = asyncio.ensure_future(run_stage(name, func, depends_on))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+
+        self.duration = time.monotonic() - started
+        self._record()
+        logging.info(
+            f"{self.name} built in {self.duration:.3f} seconds, critical path: "
+            + " > ".join(f"{name} {self.timings[name]['duration']:.3f}" for name in self.critical_path())
+        )
+        return {name: task.result() for name, task in tasks.items()}
+
+    def critical_path(self) -> list:
+        """The chain of stages ending last, each one preceded by its dependency that ended last."""
+        def end(name):
+            return self.timings[name]['start'] + self.timings[name]['duration']
+
+        if not self.timings:
+            return []
+
+        path = [max(self.timings, key=end)]
+        while self._stages[path[0]][1]:
+            path.insert(0, max(self._stages[path[0]][1], key=end))
+        return path
+
+    def _record(self):
+        stats = _graph_stats.setdefault(self.name, {})
+        for name, timing in self.timings.items():
+            stage_stats = stats.setdefault(name, {'runs': 0, 'total': 0.0, 'max': 0.0})
+            stage_stats['runs'] += 1
+            stage_stats['total'] += timing['duration']
+            stage_stats['max'] = max(stage_stats['max'], timing['duration'])
+
+
+def task_graph_stats() -> dict:
+    return {
+        graph_name: {
+            name: dict(stage_stats, avg=stage_stats['total'] / stage_stats['runs'])
+            for name, stage_stats in stats.items()
+        }
+        for graph_name, stats in _graph_stats.items()
+    }
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import logging
+import os
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from hsbot.services.retry import remaining_budget
+
+# Telegram allows about 30 messages per second overall and 1 per second in a chat,
+# a chat may go a few messages over for a short burst
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+# times a request is sent again after Telegram answered it with retry_after
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 2))
+# chats whose buckets are kept, idle full buckets are dropped beyond this
+TELEGRAM_MAX_TRACKED_CHATS = int(os.environ.get('TELEGRAM_MAX_TRACKED_CHATS', 10000))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_CLEANUP = 2
+
+ENDPOINT_PRIORITIES = {
+    'answerCallbackQuery': PRIORITY_INTERACTIVE,
+    'editMessageText': PRIORITY_INTERACTIVE,
+    'editMessageReplyMarkup': PRIORITY_INTERACTIVE,
+    'sendMessage': PRIORITY_INTERACTIVE,
+    'sendAnimation': PRIORITY_INTERACTIVE,
+    'deleteMessage': PRIORITY_CLEANUP,
+    'deleteMessages': PRIORITY_CLEANUP,
+}
+# only sending and editing messages count towards the per chat limit
+CHAT_PACED_ENDPOINTS = frozenset({
+    'editMessageText', 'editMessageReplyMarkup', 'sendMessage', 'sendAnimation', 'sendPhoto', 'sendDocument',
+})
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float):
+        # `now` may be read before the bucket was created, a new bucket starts full
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def ready_at(self, now: float) -> float:
+        """When the next token is available, `now` if one is available already."""
+        self.refill(now)
+        return max(now + max(1 - self.tokens, 0) / self.rate, self.paused_until)
+
+    def idle(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst and self.paused_until <= now
+
+
+class TelegramScheduler(BaseRateLimiter):
+    """
+    Sends the Bot API requests of the bot in priority order within Telegram's rate limits.
+
+    Every request waits for its turn in a single queue: the dispatcher hands out the global
+    budget to the waiting request with the best priority whose chat has budget left, so
+    interactive replies and edits go before cleanup deletes and one chat being paced does
+    not hold back the others. A request answered with RetryAfter pauses its chat, or every
+    request when it is not paced per chat, and is queued again, unless the pause would not
+    fit in the request deadline. `rate_limit_args` can pass the priority of a single request.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(int(global_rate), 1))
+        self._chats = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._arrived = None
+        self._dispatcher = None
+        self.max_depth = 0
+        self.sent = 0
+        self.retried = 0
+        self.total_wait = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_DEFAULT: 0.0, PRIORITY_CLEANUP: 0.0}
+        self.requests = {PRIORITY_INTERACTIVE: 0, PRIORITY_DEFAULT: 0, PRIORITY_CLEANUP: 0}
+
+    async def initialize(self) -> None:
+        self._start()
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None and not self._dispatcher.done():
+            self._dispatcher.cancel()
+        self._dispatcher = None
+        for _, _, _, future in self._waiting:
+            future.cancel()
+        self._waiting = []
+
+    def _start(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._arrived = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= TELEGRAM_MAX_TRACKED_CHATS:
+                now = time.monotonic()
+                for idle_chat_id in [key for key, value in self._chats.items() if value.idle(now)]:
+                    del self._chats[idle_chat_id]
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _turn(self, priority: int, chat_id):
+        """Waits until the dispatcher lets the request go."""
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((priority, next(self._sequence), chat_id, future))
+        self.max_depth = max(self.max_depth, len(self._waiting))
+        self._arrived.set()
+        await future
+
+    async def _dispatch(self):
+        while True:
+            self._waiting = [waiter for waiter in self._waiting if not waiter[3].done()]
+            if not self._waiting:
+                self._arrived.clear()
+                await self._arrived.wait()
+                continue
+
+            now = time.monotonic()
+            global_ready_at = self._global.ready_at(now)
+            chosen = None
+            next_ready_at = None
+            for waiter in sorted(self._waiting):
+                chat_id = waiter[2]
+                ready_at = max(global_ready_at, self._chat_bucket(chat_id).ready_at(now)) \
+                    if chat_id is not None else global_ready_at
+                if ready_at <= now:
+                    chosen = waiter
+                    break
+                next_ready_at = ready_at if next_ready_at is None else min(next_ready_at, ready_at)
+
+            if chosen is None:
+                # sleep until a token is due, or until a request arrives that may be ready sooner
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), timeout=next_ready_at - now)
+                except TimeoutError:
+                    pass
+                continue
+
+            self._waiting.remove(chosen)
+            self._global.tokens -= 1
+            if chosen[2] is not None:
+                self._chat_bucket(chosen[2]).tokens -= 1
+            chosen[3].set_result(None)
+
+    def _pause(self, chat_id, seconds: float):
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+        bucket.paused_until = max(bucket.paused_until, time.monotonic() + seconds)
+        self._arrived.set()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if rate_limit_args is not None else ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_DEFAULT)
+        chat_id = data.get('chat_id') if endpoint in CHAT_PACED_ENDPOINTS else None
+
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.monotonic()
+            await self._turn(priority, chat_id)
+            self.requests[priority] = self.requests.get(priority, 0) + 1
+            self.total_wait[priority] = self.total_wait.get(priority, 0.0) + time.monotonic() - queued_at
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retried += 1
+                budget = remaining_budget()
+                if attempt == self.max_retries or (budget is not None and e.retry_after >= budget):
+                    logging.warning(f"Giving up on {endpoint} after Telegram asked to retry in {e.retry_after} seconds")
+                    raise
+                logging.info(f"Telegram asked to retry {endpoint} in {e.retry_after} seconds")
+                self._pause(chat_id, e.retry_after + 0.1)
+                continue
+            self.sent += 1
+            return result
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': len(self._waiting),
+            'max_depth': self.max_depth,
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'retried': self.retried,
+            'avg_wait': {
+                priority: self.total_wait[priority] / count if count else 0.0
+                for priority, count in self.requests.items()
+            }
+        }
+
+
+telegram_scheduler = TelegramScheduler()
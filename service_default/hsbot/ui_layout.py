@@ -234,6 +234,21 @@ def token_info_reply_text(name, symbol, contract_address, pair_address, token_pr
     return _reply_text
 
 
+def token_info_contract_address(text: str) -> str | None:
+    """
+    Contract address printed on the second line of a token_info_reply_text message.
+    """
+    lines = (text or "").splitlines()
+    return lines[1].strip() if len(lines) > 1 else None
+
+
+def token_list_message_type(text: str) -> str:
+    """
+    Message type ('sell' or 'positions') of a paginated token list message.
+    """
+    return 'sell' if " tokens found" in (text or "").split("\n", 1)[0] else 'positions'
+
+
 def wallet_reply_text(wallet_address, balance_sol):
     _reply_text = (
             f"<b>Your Wallet:  </b> \n \n "
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from telegram import Update
+from hsbot.persistence_layer import STORE_MULTIPROCESS
+
+# updates and callback queries seen within this many seconds are not handled again
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', 60 * 60))
+UPDATE_DEDUP_MAX_ENTRIES = int(os.environ.get('UPDATE_DEDUP_MAX_ENTRIES', 10000))
+# processes sharing the store share the window through this file, a single process keeps it in memory
+UPDATE_DEDUP_PATH = Path(__file__).parent / "update_dedup.sqlite3" if STORE_MULTIPROCESS else None
+
+
+def update_keys(update: Update) -> list:
+    keys = [f"update:{update.update_id}"]
+    if update.callback_query is not None:
+        keys.append(f"callback_query:{update.callback_query.id}")
+    return keys
+
+
+class UpdateDedup:
+    """
+    Bounded window of the update ids and callback query ids already taken in.
+
+    Telegram redelivers an update it did not get an answer for in time, the window makes
+    sure the redelivery is acked without running the handler again. The window is a small
+    SQLite table of its own rather than part of the store, so taking an update in does not
+    save the store: in memory by default, or in the file at `path` (WAL mode) to share it
+    between processes. Entries expire after `ttl` seconds and the entries seen first are
+    evicted beyond `max_entries`. A shared window may wait on the lock of another process,
+    so its queries run in a thread instead of on the event loop.
+    """
+
+    def __init__(self, ttl: int = UPDATE_DEDUP_TTL, max_entries: int = UPDATE_DEDUP_MAX_ENTRIES,
+                 path: Path = UPDATE_DEDUP_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.accepted = 0
+        self.duplicates = {'update': 0, 'callback_query': 0}
+        self._lock = threading.Lock()
+        self._shared = path is not None
+        self._connection = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path is not None:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS seen_updates (key TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS seen_updates_seen_at ON seen_updates (seen_at);
+            """
+        )
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, two processes can not both accept an update
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        connection.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.ttl,))
+        connection.execute(
+            "DELETE FROM seen_updates WHERE key IN ("
+            "SELECT key FROM seen_updates ORDER BY seen_at LIMIT max(0, (SELECT COUNT(*) FROM seen_updates) - ?))",
+            (self.max_entries,)
+        )
+
+    async def _run(self, func, *args):
+        if self._shared:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def _mark_seen(self, keys: list, now: float) -> set:
+        """Marks the keys as seen unless one of them was, returns those that were."""
+        with self._transaction() as connection:
+            seen = {key for key, in connection.execute(
+                f"SELECT key FROM seen_updates WHERE key IN ({', '.join('?' * len(keys))}) AND seen_at >= ?",
+                (*keys, now - self.ttl)
+            )}
+            if not seen:
+                connection.executemany("INSERT OR REPLACE INTO seen_updates VALUES (?, ?)", [(key, now) for key in keys])
+                self._evict(connection, now)
+        return seen
+
+    def _unmark_seen(self, keys: list):
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM seen_updates WHERE key = ?", [(key,) for key in keys])
+
+    async def accept(self, update: Update) -> bool:
+        """
+        Marks the update as seen, returns False if it or its callback query was seen already.
+        """
+        keys = update_keys(update)
+        seen = await self._run(self._mark_seen, keys, time.time())
+
+        if seen:
+            key = next(key for key in keys if key in seen)
+            self.duplicates[key.split(':', 1)[0]] += 1
+            logging.info(f"Dropping duplicate update {update.update_id} ({key})")
+            return False
+
+        self.accepted += 1
+        return True
+
+    async def forget(self, update: Update):
+        """Unmarks an update that was refused, so its redelivery is handled."""
+        await self._run(self._unmark_seen, update_keys(update))
+        self.accepted -= 1
+
+    def stats(self) -> dict:
+        # not counted while a query waits on another process, stats must not block the event loop
+        entries = None
+        if self._lock.acquire(blocking=False):
+            try:
+                entries = self._connection.execute("SELECT COUNT(*) FROM seen_updates").fetchone()[0]
+            finally:
+                self._lock.release()
+        return {
+            'entries': entries,
+            'accepted': self.accepted,
+            'duplicates': dict(self.duplicates)
+        }
+
+
+update_dedup = UpdateDedup()
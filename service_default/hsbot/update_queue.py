@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+from collections import deque
+from telegram import Update
+from hsbot.services.retry import request_deadline
+from hsbot.ui_layout import CallbackData
+
+# ack webhook updates as soon as they are queued and handle them in background workers
+WEBHOOK_ASYNC_INGESTION = os.environ.get('WEBHOOK_ASYNC_INGESTION', 'true').lower() == 'true'
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+# updates waiting for a worker, once full the webhook answers 503 and Telegram redelivers later
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 200))
+# updates of a single user waiting behind the one being handled, further ones are acked and dropped
+WEBHOOK_USER_QUEUE_SIZE = int(os.environ.get('WEBHOOK_USER_QUEUE_SIZE', 5))
+# seconds the queued updates get to be handled when the instance shuts down
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_DRAIN_TIMEOUT', 10))
+
+# clicks that only redraw a message, a newer click makes a pending one pointless
+REFRESH_CALLBACKS = frozenset({
+    CallbackData.REFRESH_TOKEN.value,
+    CallbackData.START_REFRESH.value,
+    CallbackData.SELL_REFRESH.value,
+    CallbackData.POSITIONS_REFRESH.value,
+})
+
+
+def update_user_id(update: Update):
+    """Lane of the update, updates without a user get a lane of their own."""
+    user = update.effective_user
+    return user.id if user is not None else f"update:{update.update_id}"
+
+
+def refresh_key(update: Update) -> tuple | None:
+    """The refreshed message and button of a refresh click, None for any other update."""
+    query = update.callback_query
+    if query is None or query.data not in REFRESH_CALLBACKS or query.message is None:
+        return None
+    return query.data, query.message.message_id
+
+
+class UpdateQueue:
+    """
+    Bounded queue of Telegram updates consumed by a pool of worker tasks.
+
+    The webhook only parses the update and queues it, so a slow upstream no longer holds
+    the webhook connection open until Telegram gives up and redelivers. When the queue is
+    full the update is refused instead of queued, the backpressure reaches Telegram as an
+    error answer and the update is redelivered once the workers caught up.
+
+    Updates are queued in one FIFO lane per user and a user has at most one update handled
+    at a time, so the updates of a user never interleave their changes to the user's state
+    while different users are handled in parallel. A user whose lane is not empty goes back
+    at the end of the line of users, one busy user can not hold every worker. A lane holds
+    up to `max_user_pending` updates: a refresh click replaces the pending clicks on the
+    same button of the same message, a full lane first drops its oldest refresh click and
+    otherwise drops the new update. A dropped update is still acked: refusing it would make
+    Telegram back off and redeliver for the whole bot, one user clicking away would slow
+    down every user and get the clicks redelivered. Only a full queue is refused.
+    """
+
+    def __init__(self, handler, workers: int = WEBHOOK_WORKERS, max_size: int = WEBHOOK_QUEUE_SIZE,
+                 max_user_pending: int = WEBHOOK_USER_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self.max_user_pending = max_user_pending
+        self._lanes = {}
+        self._ready = None
+        self._worker_tasks = []
+        self.pending = 0
+        self.busy_workers = 0
+        self.max_depth = 0
+        self.enqueued = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.stale_dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_handling = 0.0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._worker_tasks)
+
+    def start(self):
+        """Starts the workers on the running loop, if they are not running already."""
+        if self.running:
+            return
+        self._ready = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        self._worker_tasks = [loop.create_task(self._work(index)) for index in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Lets the workers finish the queued updates for up to `drain_timeout` seconds, then stops them."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=drain_timeout)
+        except TimeoutError:
+            logging.warning(f"Dropping {self.pending} queued updates on shutdown")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def submit(self, update: Update) -> bool:
+        """Queues the update, returns False when the queue is full. Dropped updates count as queued."""
+        if not self.running:
+            self.start()
+        if self.pending >= self.max_size:
+            self.rejected += 1
+            logging.warning(f"Update queue is full, refusing update {update.update_id}")
+            return False
+
+        user_id = update_user_id(update)
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = deque()
+            self._ready.put_nowait(user_id)
+
+        key = refresh_key(update)
+        if key is not None:
+            self._drop_refreshes(lane, lambda pending_key: pending_key == key)
+
+        if len(lane) >= self.max_user_pending:
+            self._drop_refreshes(lane, lambda pending_key: pending_key is not None, limit=1)
+        if len(lane) >= self.max_user_pending:
+            self.dropped += 1
+            logging.warning(f"Dropping update {update.update_id}, user {user_id} has {len(lane)} pending updates")
+            return True
+
+        lane.append((update, time.monotonic()))
+        self.pending += 1
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.pending)
+        return True
+
+    def _drop_refreshes(self, lane: deque, is_stale, limit: int = None):
+        kept = []
+        dropped = 0
+        for entry in lane:
+            if (limit is None or dropped < limit) and is_stale(refresh_key(entry[0])):
+                dropped += 1
+            else:
+                kept.append(entry)
+
+        if dropped:
+            # the worker handling the user holds the same deque, it is updated in place
+            lane.clear()
+            lane.extend(kept)
+            self.pending -= dropped
+            self.stale_dropped += dropped
+
+    async def _work(self, index: int):
+        while True:
+            user_id = await self._ready.get()
+            lane = self._lanes[user_id]
+            update, enqueued_at = lane.popleft()
+            self.pending -= 1
+            started = time.monotonic()
+            self.total_wait += started - enqueued_at
+            self.busy_workers += 1
+            try:
+                with request_deadline():
+                    await self.handler(update)
+            except Exception:
+                self.failed += 1
+                logging.error(f"Update worker {index} failed on update {update.update_id}: {traceback.format_exc()}")
+            finally:
+                self.busy_workers -= 1
+                self.processed += 1
+                self.total_handling += time.monotonic() - started
+                if lane:
+                    self._ready.put_nowait(user_id)
+                else:
+                    del self._lanes[user_id]
+                self._ready.task_done()
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.pending,
+            'max_depth': self.max_depth,
+            'users': len(self._lanes),
+            'workers': len(self._worker_tasks),
+            'busy_workers': self.busy_workers,
+            'enqueued': self.enqueued,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'stale_dropped': self.stale_dropped,
+            'processed': self.processed,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / self.processed if self.processed else 0.0,
+            'avg_handling': self.total_handling / self.processed if self.processed else 0.0
+        }
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 import logging
 import os
@@ -7,14 +8,42 @@ init_env_variables()
 
 from hsbot.bot_handlers import configure_bot
 
+from hsbot.message_cache import message_states
+from hsbot.persistence_layer import store
 from hsbot.routers import bot_webhook, worker
+from hsbot.services.http_client import HttpClientFactory
+from hsbot.services.price_oracle import sol_price_oracle
+from hsbot.services.sol_client import SolanaAsyncClientFactory
+from hsbot.services.tasks import delete_message_batcher
+from hsbot.telegram_scheduler import telegram_scheduler
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sol_price_oracle.start()
+    message_states.start()
+    if bot_webhook.WEBHOOK_ASYNC_INGESTION:
+        bot_webhook.update_queue.start()
+    yield
+    # queued updates are handled before the clients they need are closed
+    await bot_webhook.update_queue.stop()
+    # deletions still waiting for their window are handed to Cloud Tasks
+    await delete_message_batcher.close()
+    await telegram_scheduler.shutdown()
+    await sol_price_oracle.stop()
+    await message_states.stop()
+    # make sure debounced store writes hit the disk before the instance goes away
+    await store.close()
+    await HttpClientFactory.close_all()
+    await SolanaAsyncClientFactory.close_all()
 
 
 app = FastAPI(
     description="Telegram bot",
     version="0.0.1",
     docs_url="/documentation",
-    redoc_url="/redocs"
+    redoc_url="/redocs",
+    lifespan=lifespan
 )
 
 # Init logging
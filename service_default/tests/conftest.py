@@ -0,0 +1,12 @@
+import pytest
+from hsbot.persistence_layer import PersistentDict
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    def make(backend='json', save_mode='sync', multiprocess=False, codec='json'):
+        # a fresh instance per test instead of the process wide singleton
+        store = object.__new__(PersistentDict)
+        store._init_instance(str(tmp_path / "db.json"), backend, save_mode, multiprocess, codec)
+        return store
+    return make
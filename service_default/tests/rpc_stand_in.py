@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+
+NODE_BEHIND = {"numSlotsBehind": 42}
+
+
+class StandInRpcError(Exception):
+    """Raised by a handler to answer its request with a JSON-RPC error, `data` None leaves it out."""
+
+    def __init__(self, code: int = -32005, message: str = "Node is behind by 42 slots", data=NODE_BEHIND):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+class StandInRpc:
+    """
+    Local HTTP server standing in for a Solana RPC node.
+
+    Every JSON-RPC request, single or batched, is answered with the result `handler`
+    returns for it, or with an error answer when it raises StandInRpcError. `delay`
+    holds every answer back and `status` other than 200 fails every POST, so tests
+    can make the node slow or broken while it runs.
+    """
+
+    def __init__(self, handler, delay: float = 0.0):
+        self.handler = handler
+        self.delay = delay
+        self.status = 200
+        self.posts = []
+        self._server = None
+        self._writers = set()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self) -> list:
+        return [request for post in self.posts for request in (post if isinstance(post, list) else [post])]
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+        # clients may still hold keep-alive connections, wait_closed waits for them since 3.12
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+
+    def _answer(self, request: dict) -> dict:
+        try:
+            result = self.handler(request['method'], request['params'])
+        except StandInRpcError as e:
+            error = {'code': e.code, 'message': e.message}
+            if e.data is not None:
+                error['data'] = e.data
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': error}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                headers = dict(
+                    line.split(": ", 1) for line in head.decode().split("\r\n")[1:] if ": " in line
+                )
+                lengths = [value for name, value in headers.items() if name.lower() == 'content-length']
+                payload = json.loads(await reader.readexactly(int(lengths[0])))
+                self.posts.append(payload)
+
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+
+                if self.status != 200:
+                    body = b"{}"
+                elif isinstance(payload, list):
+                    body = json.dumps([self._answer(request) for request in payload]).encode()
+                else:
+                    body = json.dumps(self._answer(payload)).encode()
+
+                writer.write(
+                    f"HTTP/1.1 {self.status} Stand-in\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
@@ -0,0 +1,43 @@
+import asyncio
+import httpx
+import pytest
+from hsbot.services.circuit_breaker import CLOSED, OPEN, CircuitBreaker, CircuitOpenError
+
+
+def status_error(status_code: int) -> httpx.HTTPStatusError:
+    request = httpx.Request('GET', 'https://quote-api.jup.ag/v6/quote')
+    response = httpx.Response(status_code, request=request)
+    return httpx.HTTPStatusError(f"{status_code}", request=request, response=response)
+
+
+def call_failing(breaker: CircuitBreaker, error: Exception):
+    async def fail():
+        raise error
+
+    with pytest.raises(type(error)):
+        asyncio.run(breaker.call(fail))
+
+
+def test_rejected_requests_leave_the_circuit_closed():
+    breaker = CircuitBreaker('jupiter', failure_threshold=5, recovery_timeout=30)
+
+    for _ in range(10):
+        call_failing(breaker, status_error(400))
+    call_failing(breaker, ValueError("Could not parse the quote"))
+
+    assert breaker.state == CLOSED
+    assert breaker.stats()['failures'] == 0
+
+
+def test_transient_failures_open_the_circuit():
+    breaker = CircuitBreaker('jupiter', failure_threshold=3, recovery_timeout=30)
+
+    call_failing(breaker, status_error(503))
+    call_failing(breaker, httpx.ConnectTimeout("timed out"))
+    # a rejected request in between does not reset the run of failures
+    call_failing(breaker, status_error(400))
+    call_failing(breaker, status_error(429))
+
+    assert breaker.state == OPEN
+    call_failing(breaker, CircuitOpenError('jupiter', 30))
+    assert breaker.stats()['rejected'] == 1
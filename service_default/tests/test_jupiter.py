@@ -0,0 +1,63 @@
+import asyncio
+from hsbot.services import jupiter
+from hsbot.services.jupiter import QuoteCache, SwapType, cached_jupiter_quote, get_jupiter_quote, prefetch_jupiter_quotes
+
+BONK = "DezXAZ8z7PnrnRJjz3wXBoRgixCa6xjnB7YaB1pPB263"
+
+
+def quote_request(sol_amount: float) -> dict:
+    return dict(swap_type=SwapType.BUY_TOKEN, mint_address=BONK, mint_amount=int(sol_amount * 10 ** 9), slippage_bps=50)
+
+
+def age_quotes(cache: QuoteCache, seconds: float):
+    for key, (cached_at, quote) in list(cache._entries.items()):
+        cache._entries[key] = (cached_at - seconds, quote)
+
+
+def test_buy_button_is_served_a_prefetched_quote_past_its_ttl(monkeypatch):
+    requested = []
+
+    async def request_jupiter_quote(swap_type, mint_address, mint_amount, *args):
+        requested.append(mint_amount)
+        return {'inAmount': str(mint_amount), 'outAmount': str(mint_amount * 1000)}
+
+    monkeypatch.setattr(jupiter, 'request_jupiter_quote', request_jupiter_quote)
+    monkeypatch.setattr(jupiter, 'jupiter_quote_cache', QuoteCache(ttl=5, stale_ttl=60))
+
+    async def scenario():
+        # the token card prefetches both presets
+        prefetch_jupiter_quotes(quote_request(0.5), quote_request(1))
+        await asyncio.sleep(0)
+        age_quotes(jupiter.jupiter_quote_cache, 30)
+
+        # the press takes the quote from the cache, the card renders with a new one
+        pressed = cached_jupiter_quote(**quote_request(1))
+        rendered = await get_jupiter_quote(**quote_request(0.5))
+        return pressed, rendered
+
+    pressed, rendered = asyncio.run(scenario())
+
+    assert pressed['outAmount'] == str(10 ** 12)
+    assert rendered['outAmount'] == str(5 * 10 ** 11)
+    assert requested == [5 * 10 ** 8, 10 ** 9, 5 * 10 ** 8]
+
+
+def test_buy_button_without_a_cached_quote_prefetches_it(monkeypatch):
+    requested = []
+
+    async def request_jupiter_quote(swap_type, mint_address, mint_amount, *args):
+        requested.append(mint_amount)
+        return {'outAmount': '1'}
+
+    monkeypatch.setattr(jupiter, 'request_jupiter_quote', request_jupiter_quote)
+    monkeypatch.setattr(jupiter, 'jupiter_quote_cache', QuoteCache(ttl=5, stale_ttl=60))
+
+    async def scenario():
+        missed = cached_jupiter_quote(**quote_request(1))
+        await asyncio.sleep(0)
+        return missed, cached_jupiter_quote(**quote_request(1))
+
+    missed, pressed_again = asyncio.run(scenario())
+
+    assert missed is None and pressed_again == {'outAmount': '1'}
+    assert requested == [10 ** 9]
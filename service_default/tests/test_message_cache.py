@@ -0,0 +1,81 @@
+import time
+import pytest
+from hsbot import message_cache
+from hsbot.message_cache import MessageStateCache
+
+
+@pytest.fixture
+def store(make_store, monkeypatch):
+    store = make_store('json')
+    store['users'] = {'1': {'messages': {}}, '2': {'messages': {}}}
+    store.save()
+    monkeypatch.setattr(message_cache, 'store', store)
+    return store
+
+
+def test_get_does_not_dirty_the_store(store):
+    cache = MessageStateCache(ttl=60, touch_interval=30)
+    cache.put('1', '10', {'page': 1})
+    store.save()
+
+    assert cache.get('1', '10')['page'] == 1
+    assert not store._dirty
+
+
+def test_get_touches_stale_access_time(store):
+    cache = MessageStateCache(ttl=60, touch_interval=30)
+    cache.put('1', '10', {'page': 1})
+    store['users']['1']['messages']['10']['accessed_at'] = time.time() - 40
+    store.save()
+
+    assert cache.get('1', '10') is not None
+    assert ('users', '1') in store._dirty
+    assert time.time() - store['users']['1']['messages']['10']['accessed_at'] < 1
+
+
+def test_get_evicts_expired_states_of_the_user(store):
+    cache = MessageStateCache(ttl=60)
+    cache.put('1', '10', {'page': 1})
+    cache.put('1', '11', {'page': 2})
+    store['users']['1']['messages']['11']['accessed_at'] = time.time() - 120
+
+    assert cache.get('1', '10') is not None
+    assert '11' not in store['users']['1']['messages']
+    assert cache.evictions == 1
+
+
+def test_sweep_evicts_inactive_users(store):
+    cache = MessageStateCache(ttl=60)
+    cache.put('1', '10', {'page': 1})
+    cache.put('2', '20', {'page': 1})
+    store['users']['2']['messages']['20']['accessed_at'] = time.time() - 120
+    store.save()
+
+    assert cache.sweep() == 1
+    assert store['users']['2']['messages'] == {}
+    assert '10' in store['users']['1']['messages']
+    assert not store._dirty
+
+
+def test_state_without_access_time_is_kept(store):
+    cache = MessageStateCache(ttl=60)
+    # written before access times were kept
+    store['users']['1']['messages']['10'] = {'page': 1}
+
+    assert cache.get('1', '10') == {'page': 1, 'accessed_at': pytest.approx(time.time(), abs=1)}
+    assert cache.evictions == 0
+
+
+def test_sweep_leaves_documents_that_are_not_loaded_alone(make_store, monkeypatch):
+    store = make_store('sqlite')
+    store['users'] = {'1': {'messages': {}}, '2': {'messages': {}}}
+    store.save()
+    lazy_store = make_store('sqlite')
+    monkeypatch.setattr(message_cache, 'store', lazy_store)
+
+    cache = MessageStateCache(ttl=60)
+    cache.put('1', '10', {'page': 1})
+    lazy_store['users']['1']['messages']['10']['accessed_at'] = time.time() - 120
+
+    assert cache.sweep() == 1
+    assert dict.keys(lazy_store['users']) == {'1'}
@@ -0,0 +1,249 @@
+import asyncio
+import threading
+import pytest
+from hsbot import persistence_layer
+
+
+class FailingCommit:
+    """Wraps a backend commit so that the next `failures` commits raise."""
+
+    def __init__(self, commit, failures: int = 1):
+        self.commit = commit
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, payload, durable=False):
+        self.calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("No space left on device")
+        return self.commit(payload, durable)
+
+
+@pytest.mark.parametrize("backend", ['json', 'journal', 'sqlite'])
+def test_failed_commit_keeps_changes_dirty(make_store, backend):
+    store = make_store(backend)
+    store['users'] = {'1': {'name': 'a'}}
+    store.save()
+
+    store._backend.commit = FailingCommit(store._backend.commit)
+    store['users']['1']['name'] = 'b'
+    store['users']['2'] = {'name': 'c'}
+    with pytest.raises(OSError):
+        store.save()
+    assert ('users', '1') in store._dirty and ('users', '2') in store._dirty
+
+    store.save()
+    assert not store._dirty
+
+    reloaded = make_store(backend)
+    assert reloaded['users']['1'] == {'name': 'b'}
+    assert reloaded['users']['2'] == {'name': 'c'}
+
+
+def test_changes_made_during_failed_commit_are_kept(make_store):
+    store = make_store('journal')
+    store['users'] = {'1': {'name': 'a'}}
+    store.save()
+
+    commit = store._backend.commit
+
+    def commit_while_changing(payload, durable=False):
+        store['users']['3'] = {'name': 'd'}
+        raise OSError("Disk quota exceeded")
+
+    store._backend.commit = commit_while_changing
+    store['users']['1']['name'] = 'b'
+    with pytest.raises(OSError):
+        store.save()
+    assert list(store._dirty) == [('users', '1'), ('users', '3')]
+
+    store._backend.commit = commit
+    store.save()
+    reloaded = make_store('journal')
+    assert reloaded['users']['1'] == {'name': 'b'}
+    assert reloaded['users']['3'] == {'name': 'd'}
+
+
+def test_sqlite_failed_statement_rolls_back(make_store):
+    store = make_store('sqlite')
+    store['users'] = {'1': {'name': 'a'}}
+    store.save()
+
+    with pytest.raises(Exception):
+        store._backend.commit([
+            ("INSERT OR REPLACE INTO documents (collection, key, value) VALUES (?, ?, ?)", ('users', '1', '{}')),
+            ("INSERT INTO missing_table VALUES (1)", ()),
+        ])
+    assert not store._backend._connection.in_transaction
+    assert store._backend.load_document('users', '1') == {'name': 'a'}
+
+
+def test_debounced_flush_retries_after_failure(make_store, monkeypatch):
+    monkeypatch.setattr(persistence_layer, 'STORE_FLUSH_INTERVAL_MS', 10)
+    store = make_store('sqlite', save_mode='debounced')
+    failing_commit = FailingCommit(store._backend.commit, failures=2)
+    store._backend.commit = failing_commit
+
+    async def scenario():
+        store['users'] = {'1': {'name': 'a'}}
+        store.save()
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not store._dirty and store._flusher.done():
+                break
+        await store.close()
+
+    asyncio.run(scenario())
+    assert failing_commit.calls == 3
+    assert make_store('sqlite')['users']['1'] == {'name': 'a'}
+
+
+def test_close_keeps_the_changes_of_a_write_in_flight(make_store, monkeypatch):
+    monkeypatch.setattr(persistence_layer, 'STORE_FLUSH_INTERVAL_MS', 10)
+    store = make_store('sqlite', save_mode='debounced')
+    commit = store._backend.commit
+    committing, release = threading.Event(), threading.Event()
+
+    def slow_failing_commit(payload, durable=False):
+        # the flusher's write is still in its thread when close() is called, then fails
+        store._backend.commit = commit
+        committing.set()
+        release.wait(5)
+        raise OSError("No space left on device")
+
+    store._backend.commit = slow_failing_commit
+
+    async def scenario():
+        store['users'] = {'1': {'name': 'a'}}
+        store.save()
+        await asyncio.to_thread(committing.wait, 5)
+        closing = asyncio.ensure_future(store.close())
+        await asyncio.sleep(0.05)
+        release.set()
+        await closing
+
+    asyncio.run(scenario())
+    assert not store._dirty
+    assert make_store('sqlite')['users']['1'] == {'name': 'a'}
+
+
+@pytest.mark.parametrize("codec", ['json', 'binary'])
+def test_sqlite_round_trip(make_store, codec):
+    store = make_store('sqlite', codec=codec)
+    store['users'] = {'1': {'wallet': {'public_key': 'abc'}, 'settings': {'slippage': 50}, 'messages': {}}}
+    store['referral_codes_to_users'] = {'code': '1'}
+    store['allowed_users'] = {}
+    store['default_settings'] = {'slippage': 50, 'buy_1': 0.5}
+    store['version'] = 3
+    store.save()
+
+    reloaded = make_store('sqlite', codec=codec)
+    assert reloaded['users']['1'] == {'wallet': {'public_key': 'abc'}, 'settings': {'slippage': 50}, 'messages': {}}
+    assert reloaded['referral_codes_to_users'] == {'code': '1'}
+    assert reloaded['allowed_users'] == {}
+    assert reloaded['default_settings'] == {'slippage': 50, 'buy_1': 0.5}
+    assert reloaded['version'] == 3
+
+    del reloaded['users']['1']
+    del reloaded['referral_codes_to_users']
+    reloaded.save()
+    assert '1' not in make_store('sqlite', codec=codec)['users']
+    assert make_store('sqlite', codec=codec)['referral_codes_to_users'] is None
+
+
+def test_sqlite_lazily_loaded_document_is_written_back_alone(make_store):
+    store = make_store('sqlite')
+    store['users'] = {'1': {'settings': {'slippage': 50}}, '2': {'settings': {'slippage': 10}}}
+    store.save()
+
+    reloaded = make_store('sqlite')
+    users = reloaded['users']
+    assert dict.keys(users) == set()
+    users['1']['settings']['slippage'] = 75
+    assert list(reloaded._dirty) == [('users', '1')]
+    reloaded.save()
+    # the other user was neither loaded nor written
+    assert dict.keys(users) == {'1'}
+
+    fresh = make_store('sqlite')
+    assert fresh['users']['1'] == {'settings': {'slippage': 75}}
+    assert fresh['users']['2'] == {'settings': {'slippage': 10}}
+
+
+@pytest.mark.parametrize("backend", ['journal', 'sqlite'])
+def test_processes_sharing_a_store_converge_after_sync(make_store, backend):
+    first = make_store(backend, multiprocess=True)
+    first['users'] = {'1': {'settings': {'slippage': 50}}}
+    first.save()
+    second = make_store(backend, multiprocess=True)
+
+    first['users']['1']['settings']['slippage'] = 75
+    first['users']['2'] = {'settings': {'slippage': 10}}
+    first.save()
+    second['users']['3'] = {'settings': {'slippage': 20}}
+    second.save()
+    del first['users']['2']
+    first.save()
+
+    second.sync()
+    first.sync()
+    for store in (first, second):
+        assert store['users']['1'] == {'settings': {'slippage': 75}}
+        assert store['users']['3'] == {'settings': {'slippage': 20}}
+        assert '2' not in store['users']
+
+
+@pytest.mark.parametrize("backend", ['journal', 'sqlite'])
+def test_sync_keeps_unsaved_local_changes(make_store, backend):
+    first = make_store(backend, multiprocess=True)
+    first['users'] = {'1': {'awaiting_input': None}, '2': {'awaiting_input': None}}
+    first.save()
+    second = make_store(backend, multiprocess=True)
+    second['users']['1']['awaiting_input'] = 'buy_x'
+
+    first['users']['1']['awaiting_input'] = 'sell_x'
+    first['users']['2']['awaiting_input'] = 'sell_x'
+    first.save()
+    second.sync()
+
+    assert second['users']['1'] == {'awaiting_input': 'buy_x'}
+    assert second['users']['2'] == {'awaiting_input': 'sell_x'}
+    second.save()
+    first.sync()
+    assert first['users']['1'] == {'awaiting_input': 'buy_x'}
+
+
+def test_sync_reloads_a_journal_compacted_by_another_process(make_store):
+    first = make_store('journal', multiprocess=True)
+    first['users'] = {'1': {'referral_code': 'a'}}
+    first.save()
+    second = make_store('journal', multiprocess=True)
+
+    first._backend._compact_records = 1
+    first['users']['2'] = {'referral_code': 'b'}
+    first.save()
+    assert first._backend._journal_path.stat().st_size == 0
+
+    second.sync()
+    assert second['users'] == {'1': {'referral_code': 'a'}, '2': {'referral_code': 'b'}}
+    second['users']['3'] = {'referral_code': 'c'}
+    second.save()
+    first.sync()
+    assert first['users']['3'] == {'referral_code': 'c'}
+
+
+def test_json_backend_can_not_be_shared(make_store):
+    with pytest.raises(ValueError):
+        make_store('json', multiprocess=True)
+
+
+def test_assigned_values_are_copied(make_store):
+    store = make_store('json')
+    settings = {'y': 1}
+    store['settings'] = settings
+    settings['y'] = 99
+    store['settings']['x'] = 2
+    store.save()
+
+    assert make_store('json')['settings'] == {'y': 1, 'x': 2}
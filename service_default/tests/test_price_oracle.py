@@ -0,0 +1,51 @@
+import asyncio
+import decimal
+import httpx
+import pytest
+from hsbot.services import jupiter
+from hsbot.services.price_oracle import SolPriceOracle
+
+
+def jupiter_answers(monkeypatch, payload: dict):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=payload)))
+    monkeypatch.setattr(jupiter, 'get_http_client', lambda name: client)
+
+
+@pytest.mark.parametrize("payload", [
+    {},
+    {'data': {}},
+    {'data': {jupiter.SOL_NATIVE_ADDRESS: None}},
+    {'data': {jupiter.SOL_NATIVE_ADDRESS: {'id': jupiter.SOL_NATIVE_ADDRESS, 'price': None}}},
+])
+def test_jupiter_answer_without_a_price_is_an_error(monkeypatch, payload):
+    jupiter_answers(monkeypatch, payload)
+
+    with pytest.raises(ValueError, match="Jupiter did not answer with a SOL price"):
+        asyncio.run(jupiter.get_sol_usd_price())
+
+
+def test_oracle_falls_back_to_the_next_source(monkeypatch):
+    jupiter_answers(monkeypatch, {'data': {}})
+
+    async def kraken_price():
+        return decimal.Decimal('151.2')
+
+    oracle = SolPriceOracle(sources=(('jupiter', jupiter.get_sol_usd_price), ('kraken', kraken_price)))
+
+    assert asyncio.run(oracle.refresh()) == decimal.Decimal('151.2')
+    assert oracle.source == 'kraken'
+
+
+def test_oracle_reports_why_every_source_failed(monkeypatch):
+    jupiter_answers(monkeypatch, {'data': {}})
+
+    async def no_price():
+        return None
+
+    oracle = SolPriceOracle(sources=(('jupiter', jupiter.get_sol_usd_price), ('kraken', no_price)))
+
+    with pytest.raises(ValueError) as error:
+        asyncio.run(oracle.refresh())
+    assert "jupiter: ValueError('Jupiter did not answer with a SOL price" in str(error.value)
+    assert "kraken: no price" in str(error.value)
+    assert oracle.price is None
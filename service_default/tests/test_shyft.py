@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import copy
+import json
+from pathlib import Path
+import pytest
+from solders.rpc.responses import GetMultipleAccountsJsonParsedResp, GetMultipleAccountsResp
+from hsbot.services import shyft, sol_client
+from hsbot.services.meteora_dlmm import LB_PAIR_PRICE_DATA_LENGTH, decode_lb_pair_active_bin, get_lb_pair_price
+from rpc_stand_in import StandInRpc
+
+# getMultipleAccounts jsonParsed answer for a token vault, an LbPair and a missing account,
+# the RPC returns the LbPair, which it can not parse, as base64
+MIXED_ANSWER = json.loads((Path(__file__).parent / "fixtures" / "get_multiple_accounts_json_parsed_mixed.json").read_text())
+TOKEN_VAULT, LB_PAIR, _ = MIXED_ANSWER['result']['value']
+
+BONK = "DezXAZ8z7PnrnRJjz3wXBoRgixCa6xjnB7YaB1pPB263"
+PAIR = "5rCf1DM8LjKTw4YqhnoLcngyZYeNnQqztScTogYHAS6"
+BONK_VAULT = "3XdE3Uq6QGWWHCNJd1nSyQ1pRj7EnTbnHDAWixN7s9zS"
+SOL_VAULT = "AUh6E8jSgMjwsUnmQgVULJsCDTiCDt1pTGTd7jxkKBSB"
+
+
+def sol_vault() -> dict:
+    account = copy.deepcopy(TOKEN_VAULT)
+    account['data']['parsed']['info']['mint'] = shyft.SOL_NATIVE_ADDRESS
+    account['data']['parsed']['info']['tokenAmount'] = {
+        "amount": "812500000000", "decimals": 9, "uiAmount": 812.5, "uiAmountString": "812.5"
+    }
+    return account
+
+
+def lb_pair_bytes() -> bytes:
+    return base64.b64decode(LB_PAIR['data'][0])
+
+
+def test_json_parsed_answer_with_an_lb_pair_does_not_deserialize():
+    with pytest.raises(Exception):
+        GetMultipleAccountsJsonParsedResp.from_json(json.dumps(MIXED_ANSWER))
+
+
+def test_lb_pair_decodes_from_a_base64_answer():
+    answer = dict(MIXED_ANSWER, result=dict(MIXED_ANSWER['result'], value=[LB_PAIR, None]))
+    accounts = GetMultipleAccountsResp.from_json(json.dumps(answer)).value
+
+    assert decode_lb_pair_active_bin(accounts[0].data) == (-2500, 25)
+    assert accounts[1] is None
+
+
+def test_dlmm_pool_is_priced_from_its_lb_pair(monkeypatch):
+    accounts = {BONK_VAULT: TOKEN_VAULT, SOL_VAULT: sol_vault()}
+
+    def handler(method, params):
+        assert method == 'getMultipleAccounts'
+        pubkeys, config = params
+        if config['encoding'] == 'jsonParsed':
+            assert PAIR not in pubkeys
+            value = [accounts.get(pubkey) for pubkey in pubkeys]
+        else:
+            assert pubkeys == [PAIR]
+            data_slice = config['dataSlice']
+            data = lb_pair_bytes()[data_slice['offset']:data_slice['offset'] + data_slice['length']]
+            value = [dict(LB_PAIR, data=[base64.b64encode(data).decode(), "base64"])]
+        return {"context": {"apiVersion": "2.1.13", "slot": 312345678}, "value": value}
+
+    async def price_through_api(pair_address):
+        raise AssertionError("the Meteora API must not be needed")
+
+    monkeypatch.setattr(shyft, 'get_meteora_dlmm_pair_address_price', price_through_api)
+    pool = {
+        'pub_key': PAIR,
+        'protocol': shyft.Protocols.METEORA_DLMM.value,
+        'base_mint': BONK,
+        'quote_mint': shyft.SOL_NATIVE_ADDRESS,
+        'base_vault': BONK_VAULT,
+        'quote_vault': SOL_VAULT,
+    }
+
+    async def scenario():
+        async with StandInRpc(handler) as rpc:
+            monkeypatch.setattr(sol_client, 'solana_rpc_pool', sol_client.RpcPool([rpc.url], hedging=False))
+            try:
+                info = await shyft.get_dominant_pool_info_per_token({BONK: [pool]})
+            finally:
+                await sol_client.SolanaAsyncClientFactory.close_all()
+            return info, rpc
+
+    info, rpc = asyncio.run(scenario())
+
+    assert info[BONK]['token_price'] == get_lb_pair_price(lb_pair_bytes(), token_x_decimals=5, token_y_decimals=9)
+    assert info[BONK]['native_token_amount'] == 812.5
+    # the vaults and the LbPair went out as two requests of one batched POST
+    assert len(rpc.posts) == 1 and len(rpc.requests) == 2
+    assert [request['params'][1].get('dataSlice') for request in rpc.requests] == \
+        [None, {'offset': 0, 'length': LB_PAIR_PRICE_DATA_LENGTH}]
@@ -0,0 +1,150 @@
+import asyncio
+import time
+import pytest
+from hsbot.services import sol_client
+from hsbot.services.sol_client import RpcPool, SolanaAsyncClientFactory
+from rpc_stand_in import StandInRpc, StandInRpcError
+
+CONTEXT = {"apiVersion": "2.1.13", "slot": 312345678}
+WALLET = "3XdE3Uq6QGWWHCNJd1nSyQ1pRj7EnTbnHDAWixN7s9zS"
+
+
+def balance_handler(lamports: int):
+    def handler(method, params):
+        assert method == 'getBalance'
+        return {"context": CONTEXT, "value": lamports}
+    return handler
+
+
+def run(scenario):
+    async def run_and_close():
+        try:
+            return await scenario()
+        finally:
+            await SolanaAsyncClientFactory.close_all()
+    return asyncio.run(run_and_close())
+
+
+def test_reads_go_to_the_endpoint_with_the_lowest_ewma_latency():
+    async def scenario():
+        async with StandInRpc(balance_handler(1), delay=0.1) as slow, StandInRpc(balance_handler(2)) as fast:
+            pool = RpcPool([slow.url, fast.url], hedging=False)
+            results = [(await pool.call('get_balance', sol_client.Pubkey.from_string(WALLET))).value for _ in range(5)]
+            return pool, slow, fast, results
+
+    pool, slow, fast, results = run(scenario)
+
+    # the slow endpoint is measured once, every later read goes to the fast one
+    assert results == [1, 2, 2, 2, 2]
+    assert len(slow.posts) == 1 and len(fast.posts) == 4
+    assert pool.endpoints[0].ewma_latency > pool.endpoints[1].ewma_latency
+
+
+def test_slow_read_is_hedged_to_the_next_endpoint():
+    async def scenario():
+        async with StandInRpc(balance_handler(1), delay=1) as slow, StandInRpc(balance_handler(2)) as fast:
+            pool = RpcPool([slow.url, fast.url], hedging=True)
+            # the slow endpoint looks fastest so it is tried first, its hedge delay is the 50ms minimum
+            pool.endpoints[0].record_latency(0.01)
+            pool.endpoints[1].record_latency(0.02)
+
+            started = time.monotonic()
+            result = await pool.call('get_balance', sol_client.Pubkey.from_string(WALLET))
+            return pool, result, time.monotonic() - started
+
+    pool, result, elapsed = run(scenario)
+
+    assert result.value == 2
+    assert pool.hedged_requests == 1
+    assert elapsed < 0.5
+    # the cancelled request of the slow endpoint is no latency sample
+    assert list(pool.endpoints[0].latencies) == [0.01]
+
+
+def test_wait_for_a_rate_limit_token_does_not_trigger_a_hedge(monkeypatch):
+    class SlowFirstToken:
+        acquired = 0
+
+        async def acquire(self):
+            self.acquired += 1
+            if self.acquired == 1:
+                await asyncio.sleep(0.6)
+
+    limiter = SlowFirstToken()
+    monkeypatch.setattr(sol_client, 'rate_limiter', lambda name: limiter)
+
+    async def scenario():
+        async with StandInRpc(balance_handler(1), delay=0.05) as first, StandInRpc(balance_handler(2)) as second:
+            pool = RpcPool([first.url, second.url], hedging=True)
+            # a 300ms hedge delay, shorter than the wait for the token but longer than the answer
+            pool.endpoints[0].record_latency(0.15)
+            pool.endpoints[1].record_latency(0.16)
+            result = await pool.call('get_balance', sol_client.Pubkey.from_string(WALLET))
+            return pool, result, second
+
+    pool, result, second = run(scenario)
+
+    assert result.value == 1
+    assert pool.hedged_requests == 0 and not second.posts
+
+
+def test_failing_endpoint_is_ejected():
+    async def scenario():
+        async with StandInRpc(balance_handler(1)) as broken, StandInRpc(balance_handler(2)) as healthy:
+            broken.status = 500
+            pool = RpcPool([broken.url, healthy.url], hedging=False)
+            results = [(await pool.call('get_balance', sol_client.Pubkey.from_string(WALLET))).value for _ in range(5)]
+            return pool, broken, results
+
+    pool, broken, results = run(scenario)
+
+    # every read fails over, after SOLANA_RPC_EJECT_AFTER failures the broken endpoint is left out
+    assert results == [2] * 5
+    assert len(broken.posts) == sol_client.SOLANA_RPC_EJECT_AFTER
+    assert pool.endpoints[0].ejected and not pool.endpoints[1].ejected
+
+
+def test_failed_account_batch_is_raised(monkeypatch):
+    accounts = [str(sol_client.Pubkey.new_unique()) for _ in range(150)]
+
+    def handler(method, params):
+        pubkeys, _ = params
+        if accounts[120] in pubkeys:
+            raise StandInRpcError()
+        return {"context": CONTEXT, "value": [None] * len(pubkeys)}
+
+    async def scenario():
+        async with StandInRpc(handler) as rpc:
+            monkeypatch.setattr(sol_client, 'solana_rpc_pool', RpcPool([rpc.url], hedging=False))
+            assert await sol_client.get_accounts_in_concurrent_batches(accounts[:100]) == [None] * 100
+            with pytest.raises(Exception):
+                await sol_client.get_accounts_in_concurrent_batches(accounts)
+
+    run(scenario)
+
+
+def test_unparseable_answer_in_a_batch_fails_only_its_request(monkeypatch):
+    broken, fine = (str(sol_client.Pubkey.new_unique()) for _ in range(2))
+
+    def handler(method, params):
+        pubkeys, _ = params
+        if broken in pubkeys:
+            # solders panics on an error answer without `data`
+            raise StandInRpcError(message="Node is behind", data=None)
+        return {"context": CONTEXT, "value": [None] * len(pubkeys)}
+
+    async def scenario():
+        async with StandInRpc(handler) as rpc:
+            monkeypatch.setattr(sol_client, 'solana_rpc_pool', RpcPool([rpc.url], hedging=False))
+            results = await asyncio.wait_for(asyncio.gather(
+                sol_client.get_multiple_accounts([broken]),
+                sol_client.get_multiple_accounts([fine]),
+                return_exceptions=True,
+            ), timeout=5)
+            return results, rpc
+
+    (failed, answered), rpc = run(scenario)
+
+    assert isinstance(failed, ValueError)
+    assert answered == [None]
+    assert len(rpc.posts) == 1 and len(rpc.requests) == 2
@@ -0,0 +1,110 @@
+import decimal
+import os
+import pickle
+import pytest
+from solders.pubkey import Pubkey
+from hsbot.helpers import portfolio_from_store, positions_from_store
+from hsbot.store_codec import BinaryCodec
+from hsbot.ui_layout import portfolio_overview_reply_text
+
+WALLET = "DezXAZ8z7PnrnRJjz3wXBoRgixCa6xjnB7YaB1pPB263"
+TOKEN = "EKpQGSJtjMFqKZ9KQanSqYXRcF8fBopzLHYxdM65zcjm"
+
+
+def token_amounts() -> dict:
+    return {
+        'name': 'dogwifhat', 'symbol': 'WIF', 'decimals': 6, 'pair_address': WALLET,
+        'supply': decimal.Decimal('998840000000000'),
+        'token_price_usd': decimal.Decimal('1.734512345678901234567890'),
+        'fdv_usd': decimal.Decimal('1732500000.123456'),
+        'liquidity_usd': decimal.Decimal('12450000.5'),
+        'token_balance': decimal.Decimal('1523.000001'),
+        'token_balance_sol': decimal.Decimal('15.78'),
+        'token_balance_usd': decimal.Decimal('2641.66'),
+    }
+
+
+@pytest.mark.parametrize("compression_level", [0, 6])
+def test_binary_codec_round_trips_decimal_and_pubkey(compression_level):
+    codec = BinaryCodec(compression_level)
+    value = {'wallet': {'public_key': Pubkey.from_string(WALLET)}, 'amounts': [decimal.Decimal('0.1'), 1, 'x']}
+
+    loaded = codec.loads(codec.dumps(value))
+
+    assert loaded == value
+    assert isinstance(loaded['wallet']['public_key'], Pubkey)
+    assert str(loaded['amounts'][0]) == '0.1'
+
+
+def test_binary_codec_refuses_globals_it_does_not_know():
+    codec = BinaryCodec()
+
+    with pytest.raises(pickle.UnpicklingError, match="posix.system is not allowed"):
+        codec.loads(b'p' + pickle.dumps(os.system))
+
+
+def test_binary_journal_replay_skips_a_corrupted_and_a_torn_record(make_store):
+    store = make_store('journal', codec='binary')
+    store['users'] = {'1': {'balance': decimal.Decimal('1.5')}}
+    store.save()
+    store['users']['2'] = {'balance': decimal.Decimal('2.5')}
+    store.save()
+
+    codec = store._backend._codec
+    valid_record = codec.frame({'p': ['users', '3'], 'v': {'balance': decimal.Decimal('3.5')}})
+    torn_record = codec.frame({'p': ['users', '4'], 'v': {'balance': decimal.Decimal('4.5')}})
+    with open(store._backend._journal_path, "ab") as journal:
+        # a payload that does not unpickle and one that does, but into something that is not a record
+        journal.write(codec._FRAME_HEADER.pack(8) + b'pgarbage')
+        journal.write(codec.frame({'p': ['users', '1']})[:-3] + b'...')
+        journal.write(valid_record)
+        journal.write(torn_record[:len(torn_record) // 2])
+
+    reloaded = make_store('journal', codec='binary')
+    assert reloaded['users'] == {
+        '1': {'balance': decimal.Decimal('1.5')},
+        '2': {'balance': decimal.Decimal('2.5')},
+        '3': {'balance': decimal.Decimal('3.5')},
+    }
+
+    # the next append replaces the torn record
+    reloaded['users']['5'] = {'balance': decimal.Decimal('5.5')}
+    reloaded.save()
+    assert set(make_store('journal', codec='binary')['users']) == {'1', '2', '3', '5'}
+
+
+@pytest.mark.parametrize("codec", ['json', 'binary'])
+def test_stored_portfolio_is_displayed_the_same_with_both_codecs(make_store, codec):
+    portfolio = {
+        'native_token': decimal.Decimal('1.234567891'),
+        'native_token_usd_worth': decimal.Decimal('209.876543'),
+        'tokens': {TOKEN: token_amounts()},
+        'sol_worth': decimal.Decimal('17.014567891'),
+        'usd_worth': decimal.Decimal('2851.536543'),
+    }
+    store = make_store('sqlite', codec=codec)
+    store['users'] = {'1': {
+        'wallet': {'public_key': Pubkey.from_string(WALLET), 'private_key': 'base58-secret'},
+        'portfolio': portfolio,
+        'messages': {'10': {'wallet_positions': [{'token_address': TOKEN, **token_amounts()}]}},
+    }}
+    store.save()
+
+    user = make_store('sqlite', codec=codec)['users']['1']
+    stored_portfolio = portfolio_from_store(user['portfolio'])
+
+    assert stored_portfolio == portfolio
+    stored_positions = positions_from_store(user['messages']['10']['wallet_positions'])
+    assert stored_positions == [{'token_address': TOKEN, **token_amounts()}]
+    assert user['wallet']['private_key'] == 'base58-secret'
+    text = portfolio_overview_reply_text(
+        wallet_address=user['wallet']['public_key'],
+        native_balance=stored_portfolio['native_token'],
+        native_balance_usd=stored_portfolio['native_token_usd_worth'],
+        portfolio_balance_sol=stored_portfolio['sol_worth'],
+        portfolio_balance_usd=stored_portfolio['usd_worth'],
+        welcome=False
+    )
+    assert f"<code>{WALLET}</code>" in text
+    assert "Balance: 1.23457 SOL (USD $209.88)" in text
+    assert "Portfolio balance: 17.01457 SOL (USD $2851.54)" in text
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+from hsbot.services import tasks
+from hsbot.services.tasks import DeleteMessageBatcher
+
+
+class TaskRecorder:
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.tasks = []
+
+    async def __call__(self, chat_id, messages, schedule_time):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Cloud Tasks unavailable")
+        self.tasks.append((chat_id, [message['message_id'] for message in messages], schedule_time.timestamp()))
+
+
+def test_deletions_of_a_chat_due_close_together_share_a_task(monkeypatch):
+    recorder = TaskRecorder()
+    monkeypatch.setattr(tasks, 'create_delete_messages_task', recorder)
+    monkeypatch.setattr(tasks.time, 'time', lambda: 1000.0)
+    batcher = DeleteMessageBatcher(window=2)
+
+    async def scenario():
+        batcher.schedule(user_id='1', chat_id=1, message_id='10', delay=3)
+        batcher.schedule(user_id='1', chat_id=1, message_id='11', delay=4)
+        batcher.schedule(user_id='1', chat_id=1, message_id='12', delay=30)
+        batcher.schedule(user_id='2', chat_id=2, message_id='20', delay=3)
+        await batcher.close()
+
+    asyncio.run(scenario())
+
+    assert sorted(recorder.tasks) == [('1', ['10', '11'], 1004.0), ('1', ['12'], 1030.0), ('2', ['20'], 1003.0)]
+    assert batcher.stats()['avg_batch_size'] == 4 / 3
+
+
+def test_failed_tasks_are_buffered_and_retried(monkeypatch):
+    recorder = TaskRecorder(failures=2)
+    monkeypatch.setattr(tasks, 'create_delete_messages_task', recorder)
+    batcher = DeleteMessageBatcher(window=0.01)
+
+    async def scenario():
+        batcher.schedule(user_id='1', chat_id=1, message_id='10')
+        while batcher.stats()['tasks_created'] == 0:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+
+    assert [(chat_id, messages) for chat_id, messages, _ in recorder.tasks] == [('1', ['10'])]
+    assert batcher.stats()['tasks_failed'] == 2 and batcher.stats()['buffered'] == 0
+
+
+def test_schedule_now_creates_the_task_without_buffering(monkeypatch):
+    recorder = TaskRecorder()
+    monkeypatch.setattr(tasks, 'create_delete_messages_task', recorder)
+    batcher = DeleteMessageBatcher(window=60)
+
+    async def scenario():
+        await batcher.schedule_now(user_id='1', chat_id=1, message_id='10', delay=30)
+        return batcher.stats()
+
+    stats = asyncio.run(scenario())
+
+    assert [(chat_id, messages) for chat_id, messages, _ in recorder.tasks] == [('1', ['10'])]
+    assert recorder.tasks[0][2] > datetime.datetime.now(datetime.UTC).timestamp() + 25
+    assert stats['buffered'] == 0 and stats['tasks_created'] == 1
+
+
+def test_schedule_now_buffers_a_deletion_it_could_not_send(monkeypatch):
+    recorder = TaskRecorder(failures=1)
+    monkeypatch.setattr(tasks, 'create_delete_messages_task', recorder)
+    batcher = DeleteMessageBatcher(window=60)
+
+    async def scenario():
+        await batcher.schedule_now(user_id='1', chat_id=1, message_id='10', delay=30)
+        buffered = batcher.stats()['buffered']
+        await batcher.close()
+        return buffered
+
+    assert asyncio.run(scenario()) == 1
+    assert [(chat_id, messages) for chat_id, messages, _ in recorder.tasks] == [('1', ['10'])]
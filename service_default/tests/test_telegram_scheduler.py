@@ -0,0 +1,92 @@
+import asyncio
+import time
+import pytest
+from telegram.error import RetryAfter
+from hsbot.services.retry import request_deadline
+from hsbot.telegram_scheduler import PRIORITY_CLEANUP, PRIORITY_INTERACTIVE, TelegramScheduler
+
+
+def run(scenario, scheduler: TelegramScheduler):
+    async def run_and_shutdown():
+        await scheduler.initialize()
+        try:
+            return await scenario()
+        finally:
+            await scheduler.shutdown()
+    return asyncio.run(run_and_shutdown())
+
+
+def test_retry_after_pauses_the_chat_and_requeues_the_request():
+    scheduler = TelegramScheduler(global_rate=100, chat_rate=100, chat_burst=5)
+    sent = []
+
+    async def send(chat_id, text):
+        if text == 'first' and not any(entry[1] == 'first' for entry in sent):
+            sent.append((chat_id, 'first', time.monotonic()))
+            raise RetryAfter(0.3)
+        sent.append((chat_id, text, time.monotonic()))
+        return text
+
+    def request(chat_id, text):
+        return scheduler.process_request(send, (chat_id, text), {}, 'sendMessage', {'chat_id': chat_id}, None)
+
+    async def scenario():
+        paused = asyncio.ensure_future(request(1, 'first'))
+        await asyncio.sleep(0.05)
+        # the paused chat waits, another chat is not held back
+        return await asyncio.gather(request(1, 'second'), request(2, 'other'), paused)
+
+    results = run(scenario, scheduler)
+
+    assert results == ['second', 'other', 'first']
+    refused_at = sent[0][2]
+    # the refused request is queued again at once, ahead of the later request of its chat
+    assert [(chat_id, text) for chat_id, text, _ in sent] == [(1, 'first'), (2, 'other'), (1, 'first'), (1, 'second')]
+    assert sent[1][2] - refused_at < 0.2
+    assert all(sent_at - refused_at >= 0.3 for chat_id, _, sent_at in sent if chat_id == 1 and sent_at > refused_at)
+    assert scheduler.stats()['retried'] == 1 and scheduler.stats()['sent'] == 3
+
+
+def test_retry_after_beyond_the_request_deadline_is_raised():
+    scheduler = TelegramScheduler()
+    calls = []
+
+    async def send():
+        calls.append(time.monotonic())
+        raise RetryAfter(5)
+
+    async def scenario():
+        with request_deadline(1.0):
+            with pytest.raises(RetryAfter):
+                await scheduler.process_request(send, (), {}, 'sendMessage', {'chat_id': 1}, None)
+
+    run(scenario, scheduler)
+
+    assert len(calls) == 1
+
+
+def test_paced_chat_does_not_hold_back_the_others():
+    scheduler = TelegramScheduler(global_rate=100, chat_rate=5, chat_burst=1)
+    sent = []
+
+    async def send(chat_id, text):
+        sent.append(text)
+
+    def request(chat_id, text, endpoint='sendMessage', priority=None):
+        return scheduler.process_request(send, (chat_id, text), {}, endpoint, {'chat_id': chat_id}, priority)
+
+    async def scenario():
+        # every request is queued before the dispatcher hands out the first turn
+        await asyncio.gather(
+            request(1, 'a1'), request(1, 'a2'), request(1, 'a3'),
+            request(2, 'b1'),
+            request(3, 'cleanup', endpoint='deleteMessage'),
+            request(3, 'c1', priority=PRIORITY_CLEANUP),
+            request(4, 'd1', priority=PRIORITY_INTERACTIVE),
+        )
+
+    run(scenario, scheduler)
+
+    # one turn per chat bucket first, by priority then arrival, the cleanup requests after
+    # the other ready ones, then the rest of chat 1 as its bucket refills
+    assert sent == ['a1', 'b1', 'd1', 'cleanup', 'c1', 'a2', 'a3']
@@ -0,0 +1,58 @@
+import time
+import pytest
+from hsbot import persistence_layer
+from hsbot.services.token_metadata_cache import TokenMetadataCache
+
+METADATA = {'name': 'Token', 'symbol': 'TKN', 'supply': 1000, 'decimals': 6, 'token_program_id': 'program'}
+
+
+def test_expired_supply_is_refreshed_alone():
+    cache = TokenMetadataCache(metadata_ttl=3600, supply_ttl=60, persist=False)
+    cache.put('mint', METADATA)
+    cache._entries['mint']['supply_fetched_at'] = time.time() - 120
+    metadata_fetched_at = cache._entries['mint']['metadata_fetched_at']
+
+    found, supply_expired, missing = cache.lookup_many(['mint', 'other'])
+    assert found == {}
+    assert supply_expired == {'mint': METADATA}
+    assert missing == ['other']
+
+    cache.put_supply('mint', 2000)
+    found, supply_expired, missing = cache.lookup_many(['mint'])
+    assert found['mint']['supply'] == 2000
+    assert found['mint']['name'] == 'Token'
+    assert cache._entries['mint']['metadata_fetched_at'] == metadata_fetched_at
+
+
+def test_expired_metadata_is_a_miss():
+    cache = TokenMetadataCache(metadata_ttl=3600, supply_ttl=60, persist=False)
+    cache.put('mint', METADATA)
+    cache._entries['mint']['metadata_fetched_at'] = time.time() - 7200
+
+    assert cache.lookup_many(['mint']) == ({}, {}, ['mint'])
+    assert cache.get('mint', allow_stale=True) == METADATA
+
+
+@pytest.fixture
+def store(make_store, monkeypatch):
+    store = make_store('sqlite')
+    monkeypatch.setattr(persistence_layer, 'store', store)
+    return store
+
+
+def test_sweep_bounds_the_persisted_metadata(store, make_store):
+    cache = TokenMetadataCache(persist=True, persist_ttl=3600, persist_max_entries=2)
+    cache.put_many({mint: dict(METADATA, name=mint) for mint in ('old', 'a', 'b', 'c')})
+    store['token_metadata']['old']['metadata_fetched_at'] = time.time() - 7200
+    store['token_metadata']['old']['supply_fetched_at'] = time.time() - 7200
+    # a refreshed supply counts as a use
+    store['token_metadata']['a']['metadata_fetched_at'] = time.time() - 1800
+    store['token_metadata']['b']['metadata_fetched_at'] = time.time() - 1200
+    store['token_metadata']['b']['supply_fetched_at'] = time.time() - 1200
+    store.save()
+
+    assert cache.sweep() == 2
+    assert set(store['token_metadata']) == {'a', 'c'}
+    assert cache.stats()['persist_evictions'] == 2
+    assert set(make_store('sqlite')['token_metadata']) == {'a', 'c'}
+    assert cache.sweep() == 0
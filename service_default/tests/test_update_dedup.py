@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+from telegram import Update
+from hsbot import update_dedup as update_dedup_module
+from hsbot.update_dedup import UpdateDedup
+
+
+def message_update(update_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1760000000,
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "User"},
+            "text": "/start",
+        },
+    }, None)
+
+
+def callback_update(update_id: int, query_id: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": query_id,
+            "chat_instance": "1",
+            "from": {"id": 7, "is_bot": False, "first_name": "User"},
+            "data": "refresh_token",
+        },
+    }, None)
+
+
+def accept(dedup: UpdateDedup, update: Update) -> bool:
+    return asyncio.run(dedup.accept(update))
+
+
+def test_redelivered_update_and_callback_query_are_refused():
+    dedup = UpdateDedup()
+
+    assert accept(dedup, callback_update(1, "q1"))
+    assert not accept(dedup, callback_update(1, "q1"))
+    # the same click redelivered under a new update id
+    assert not accept(dedup, callback_update(2, "q1"))
+    assert accept(dedup, message_update(3))
+
+    assert dedup.stats() == {'entries': 3, 'accepted': 2, 'duplicates': {'update': 1, 'callback_query': 1}}
+
+
+def test_forgotten_update_is_accepted_again():
+    dedup = UpdateDedup()
+
+    assert accept(dedup, message_update(1))
+    asyncio.run(dedup.forget(message_update(1)))
+
+    assert accept(dedup, message_update(1))
+
+
+def test_expired_and_oldest_entries_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(update_dedup_module.time, 'time', lambda: now[0])
+    dedup = UpdateDedup(ttl=60, max_entries=3)
+
+    for update_id in (5, 1, 4, 2):
+        accept(dedup, message_update(update_id))
+        now[0] += 1
+
+    # the entries are evicted in the order they were seen, not by update id
+    assert not accept(dedup, message_update(1))
+    assert accept(dedup, message_update(5))
+
+    now[0] += 60
+    assert accept(dedup, message_update(2))
+    assert dedup.stats()['entries'] == 2
+
+
+def test_window_file_is_shared_between_instances(tmp_path):
+    path = tmp_path / "update_dedup.sqlite3"
+    first, second = UpdateDedup(path=path), UpdateDedup(path=path)
+
+    assert accept(first, message_update(1))
+    assert not accept(second, message_update(1))
+    assert accept(second, message_update(2))
+    assert not accept(first, message_update(2))
+
+
+def test_shared_window_waits_for_another_process_off_the_event_loop(tmp_path):
+    path = tmp_path / "update_dedup.sqlite3"
+    dedup = UpdateDedup(path=path)
+    other_process = sqlite3.connect(path, isolation_level=None)
+    other_process.execute("BEGIN IMMEDIATE")
+
+    async def scenario():
+        accepting = asyncio.ensure_future(dedup.accept(message_update(1)))
+        for _ in range(5):
+            await asyncio.sleep(0.02)
+        waited = not accepting.done()
+        other_process.execute("COMMIT")
+        return waited, await accepting
+
+    assert asyncio.run(scenario()) == (True, True)
@@ -0,0 +1,110 @@
+import asyncio
+from telegram import Update
+from hsbot.ui_layout import CallbackData
+from hsbot.update_queue import UpdateQueue
+
+
+def message_update(update_id: int, user_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1760000000,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": "/start",
+        },
+    }, None)
+
+
+def refresh_update(update_id: int, user_id: int, message_id: int) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "1",
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "data": CallbackData.REFRESH_TOKEN.value,
+            "message": {
+                "message_id": message_id,
+                "date": 1760000000,
+                "chat": {"id": user_id, "type": "private"},
+                "text": "token",
+            },
+        },
+    }, None)
+
+
+def test_update_beyond_a_full_user_lane_is_acked_and_dropped():
+    handled = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update):
+            await release.wait()
+            handled.append(update.update_id)
+
+        queue = UpdateQueue(handler, workers=2, max_size=10, max_user_pending=2)
+        # the first update is taken by a worker, the next two fill the lane of the user
+        accepted = [queue.submit(message_update(1, user_id=7))]
+        await asyncio.sleep(0)
+        accepted += [queue.submit(message_update(update_id, user_id=7)) for update_id in (2, 3, 4)]
+        accepted.append(queue.submit(message_update(5, user_id=8)))
+
+        release.set()
+        await queue.stop()
+        return accepted, queue.stats()
+
+    accepted, stats = asyncio.run(scenario())
+
+    # acked, a refusal would make Telegram back off for every user
+    assert accepted == [True, True, True, True, True]
+    assert sorted(handled) == [1, 2, 3, 5]
+    assert stats['dropped'] == 1 and stats['rejected'] == 0
+
+
+def test_full_user_lane_drops_its_oldest_refresh_click():
+    handled = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update):
+            await release.wait()
+            handled.append(update.update_id)
+
+        queue = UpdateQueue(handler, workers=1, max_size=10, max_user_pending=2)
+        queue.submit(message_update(1, user_id=7))
+        await asyncio.sleep(0)
+        queue.submit(refresh_update(2, user_id=7, message_id=100))
+        queue.submit(message_update(3, user_id=7))
+        queue.submit(message_update(4, user_id=7))
+
+        release.set()
+        await queue.stop()
+        return queue.stats()
+
+    stats = asyncio.run(scenario())
+
+    assert handled == [1, 3, 4]
+    assert stats['stale_dropped'] == 1 and stats['dropped'] == 0
+
+
+def test_update_beyond_a_full_queue_is_refused():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update):
+            await release.wait()
+
+        queue = UpdateQueue(handler, workers=1, max_size=2, max_user_pending=5)
+        accepted = [queue.submit(message_update(update_id, user_id=update_id)) for update_id in range(1, 5)]
+        release.set()
+        await queue.stop()
+        return accepted, queue.stats()
+
+    accepted, stats = asyncio.run(scenario())
+
+    assert accepted == [True, True, False, False]
+    assert stats['rejected'] == 2 and stats['processed'] == 2